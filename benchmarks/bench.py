@@ -0,0 +1,337 @@
+"""Benchmarks for indexing, compression, Release generation and signing.
+
+Synthetic pools of minimal (but valid) .debs are generated, spread over
+several components and architectures, then indexed with index_all() and
+released with generate_release(), signed with a throwaway key. Stage
+times come from repo_lib.instrument. Each pool size runs in its own
+process so peak memory is that of one size only.
+
+Run from the source tree:
+
+    python3 -m benchmarks.bench --sizes 100,1000,10000
+
+Results are compared with benchmarks/baseline.json; --check exits
+non-zero when a size got slower (or bigger) than the baseline by more
+than --tolerance. The baseline is only meaningful on the machine that
+wrote it: refresh it with --write-baseline there after intended changes.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from os.path import dirname, exists, join
+
+from repo_lib import Repository, instrument
+
+BASELINE = join(dirname(os.path.abspath(__file__)), "baseline.json")
+
+COMPONENTS = ("main", "contrib", "non-free")
+ARCHS = ("amd64", "arm64", "all")
+
+# metrics compared with the baseline by --check; lower is better for all
+CHECKED = ("index_s", "compress_cpu_s", "release_s", "sign_s", "peak_rss_kb")
+
+
+def _ar_member(name: str, data: bytes) -> bytes:
+    header = (
+        f"{name:<16}{0:<12}{0:<6}{0:<6}{'100644':<8}{len(data):<10}`\n"
+    ).encode()
+    return header + data + (b"\n" if len(data) % 2 else b"")
+
+
+def _tar_gz(files: dict[str, bytes]) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz", compresslevel=1) as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def synthetic_deb(
+    path: str, name: str, version: str, arch: str, payload: bytes,
+) -> None:
+    """Write a minimal .deb: a control file and one data file."""
+    control = (
+        f"Package: {name}\n"
+        f"Version: {version}\n"
+        f"Architecture: {arch}\n"
+        "Maintainer: Benchmark <bench@example.com>\n"
+        f"Installed-Size: {len(payload) // 1024 + 1}\n"
+        "Section: misc\n"
+        "Priority: optional\n"
+        "Description: synthetic benchmark package\n"
+        " Generated by benchmarks/bench.py.\n"
+    ).encode()
+    with open(path, "wb") as fob:
+        fob.write(b"!<arch>\n")
+        fob.write(_ar_member("debian-binary", b"2.0\n"))
+        fob.write(
+            _ar_member("control.tar.gz", _tar_gz({"./control": control})),
+        )
+        fob.write(
+            _ar_member(
+                "data.tar.gz", _tar_gz({f"./usr/share/{name}/data": payload}),
+            ),
+        )
+
+
+def generate_pool(
+    root: str, count: int, payload_size: int, seed: int = 0,
+) -> int:
+    """Fill root/pool with count .debs; return their total size in bytes.
+
+    Packages are spread round-robin over COMPONENTS and ARCHS, in
+    pool/<component>/<first letter>/<name>/ like a Debian mirror. Each
+    payload is random, so the .debs do not compress away to nothing.
+    """
+    rng = random.Random(seed)  # noqa: S311 - test data, not secrets
+    total = 0
+    for i in range(count):
+        name = f"pkg{i:06d}"
+        component = COMPONENTS[i % len(COMPONENTS)]
+        arch = ARCHS[i % len(ARCHS)]
+        directory = join(root, "pool", component, name[0], name)
+        os.makedirs(directory, exist_ok=True)
+        path = join(directory, f"{name}_1.0-1_{arch}.deb")
+        synthetic_deb(path, name, "1.0-1", arch, rng.randbytes(payload_size))
+        total += os.path.getsize(path)
+    return total
+
+
+def _stage_totals(stage: str) -> tuple[float, float]:
+    wall = cpu = 0.0
+    for record in instrument.records():
+        if record["stage"] == stage:
+            wall += float(record["wall_s"])  # type: ignore[arg-type]
+            cpu += float(record["cpu_s"])  # type: ignore[arg-type]
+    return wall, cpu
+
+
+def run_one(args: argparse.Namespace, count: int) -> dict[str, float]:
+    """Benchmark one pool size in this process; return its metrics."""
+    root = tempfile.mkdtemp(prefix="repo-bench-")
+    gnupghome = ""
+    try:
+        start = time.perf_counter()
+        pool_bytes = generate_pool(root, count, args.payload)
+        generate_s = time.perf_counter() - start
+
+        repo = Repository(
+            root,
+            "bench",
+            "pool",
+            "1.0",
+            "bench",
+            quiet=True,
+            backend=args.backend,
+            jobs=args.jobs,
+        )
+        instrument.enable()
+        start = time.perf_counter()
+        repo.index_all()
+        index_s = time.perf_counter() - start
+        _, compress_cpu_s = _stage_totals("compress")
+        instrument.reset()
+
+        uid = ""
+        if args.sign:
+            from repo_lib.gpg import gen_repo_key  # noqa: PLC0415
+
+            gnupghome, uid = gen_repo_key(root)
+        instrument.enable()
+        start = time.perf_counter()
+        repo.generate_release(uid, gnupghome)
+        release_s = time.perf_counter() - start
+        sign_s, _ = _stage_totals("gpg")
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "debs": count,
+            "pool_mb": round(pool_bytes / 2**20, 3),
+            "generate_s": round(generate_s, 4),
+            "index_s": round(index_s, 4),
+            "index_debs_per_s": round(count / index_s, 1),
+            "index_mb_per_s": round(pool_bytes / 2**20 / index_s, 2),
+            "compress_cpu_s": round(compress_cpu_s, 4),
+            "release_s": round(release_s, 4),
+            "sign_s": round(sign_s, 4),
+            "peak_rss_kb": usage.ru_maxrss,
+        }
+    finally:
+        if gnupghome:
+            from repo_lib.gpg import cleanup_key  # noqa: PLC0415
+
+            cleanup_key(gnupghome)
+        if args.keep:
+            print(f"Kept: {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+
+def _child_args(args: argparse.Namespace, count: int) -> list[str]:
+    return [
+        sys.executable,
+        "-m",
+        "benchmarks.bench",
+        "--run-one",
+        str(count),
+        "--payload",
+        str(args.payload),
+        "--backend",
+        args.backend,
+        "--jobs",
+        str(args.jobs),
+        *([] if args.sign else ["--no-sign"]),
+        *(["--keep"] if args.keep else []),
+    ]
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    """Return a line per metric that regressed beyond tolerance."""
+    regressions = []
+    for size, metrics in results.items():
+        for metric in CHECKED:
+            old = baseline.get(size, {}).get(metric)
+            new = metrics.get(metric)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{size} debs: {metric} {old} -> {new} ({ratio:.2f}x)",
+                )
+    return regressions
+
+
+def _print_table(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+) -> None:
+    for size, metrics in results.items():
+        print(f"{size} debs ({metrics['pool_mb']} MiB):")
+        for metric, value in metrics.items():
+            old = baseline.get(size, {}).get(metric)
+            versus = f"  (baseline {old}, {value / old:.2f}x)" if old else ""
+            print(f"  {metric:<18} {value}{versus}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m benchmarks.bench",
+        description="Benchmark repo indexing, release and signing",
+    )
+    parser.add_argument(
+        "--sizes", default="100,1000,10000",
+        help="Comma separated pool sizes, in .debs - default: %(default)s",
+    )
+    parser.add_argument(
+        "--payload", default=4096, type=int, metavar="BYTES",
+        help="Random payload per .deb - default: %(default)s",
+    )
+    parser.add_argument(
+        "--backend", default="native", choices=("native", "apt-ftparchive"),
+        help="Index backend - default: %(default)s",
+    )
+    parser.add_argument(
+        "-j", "--jobs", default=0, type=int, metavar="N",
+        help=".debs read concurrently (0: one per CPU) - default: 0",
+    )
+    parser.add_argument(
+        "--no-sign", dest="sign", action="store_false",
+        help="Do not sign the Release (no gpg key generation)",
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE, metavar="FILE",
+        help="Baseline results to compare with - default:"
+        " benchmarks/baseline.json",
+    )
+    parser.add_argument(
+        "--write-baseline", action="store_true",
+        help="Store these results as the baseline",
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help="Exit non-zero if anything regressed beyond --tolerance",
+    )
+    parser.add_argument(
+        "--tolerance", default=0.25, type=float,
+        help="Allowed slowdown, as a fraction - default: %(default)s",
+    )
+    parser.add_argument(
+        "--output", default="", metavar="FILE",
+        help="Also write the results as JSON to FILE",
+    )
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="Keep the generated repositories (paths go to stderr)",
+    )
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        print(json.dumps(run_one(args, args.run_one)))
+        return
+
+    results: dict[str, dict[str, float]] = {}
+    for size in filter(None, args.sizes.split(",")):
+        print(f"Benchmarking {size} .debs...", file=sys.stderr)
+        output = subprocess.run(
+            _child_args(args, int(size)),
+            capture_output=True,
+            text=True,
+            check=False,
+            cwd=dirname(dirname(os.path.abspath(__file__))),
+        )
+        if output.returncode != 0:
+            sys.exit(f"error: {size} .debs: {output.stderr}")
+        results[size] = json.loads(output.stdout)
+
+    baseline: dict[str, dict[str, float]] = {}
+    if exists(args.baseline):
+        with open(args.baseline) as fob:
+            baseline = json.load(fob).get("results", {})
+    _print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w") as fob:
+            json.dump({"results": results}, fob, indent=2)
+    if args.write_baseline:
+        merged = {**baseline, **results}
+        with open(args.baseline, "w") as fob:
+            json.dump(
+                {
+                    "machine": os.uname().machine,
+                    "cpus": os.cpu_count(),
+                    "backend": args.backend,
+                    "payload": args.payload,
+                    "results": merged,
+                },
+                fob,
+                indent=2,
+            )
+            fob.write("\n")
+        print(f"Baseline written: {args.baseline}", file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION: {line}")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
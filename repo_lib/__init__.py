@@ -9,39 +9,109 @@
 
 """repo_lib - Generation of required components for an apt repository."""
 
+import contextlib
 import logging
 import os
+import queue
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections.abc import Iterable, Iterator
 from datetime import UTC, datetime
 from os.path import exists, isdir, join
+from typing import TYPE_CHECKING, Any
+
+from repo_lib import instrument
+from repo_lib.packages import (
+    PackagesCache,
+    arch_matches,
+    deb_archs,
+    iter_stanzas,
+    parallel_map,
+    stanza_filename,
+    walk_debs,
+)
+
+if TYPE_CHECKING:
+    from repo_lib.compress import HashedWriter
+    from repo_lib.gpg import SigningSession
+    from repo_lib.manifest import Manifest
 
 logger = logging.getLogger(__name__)
 
-level = os.getenv("REPO_LOG_LEVEL", "").lower()
-env_debug = os.getenv("DEBUG")
 
-# allow 'DEBUG' env var to override 'REPO_LOG_LEVEL'
-if "DEBUG" in os.environ:
-    level = "debug"
+def setup_logging() -> None:
+    """Configure logging from REPO_LOG_LEVEL, or DEBUG if that is set.
 
-loglevel = logging.INFO  # default logging / fallback if unknown log level
-logformat = (
-    "%(asctime)s - [%(levelname)-7s] %(filename)s:%(lineno)4d %(message)s"
-)
+    Called by the repo script; importing repo_lib configures nothing.
+    """
+    level = os.getenv("REPO_LOG_LEVEL", "").lower()
+
+    # allow 'DEBUG' env var to override 'REPO_LOG_LEVEL'
+    if "DEBUG" in os.environ:
+        level = "debug"
 
-if level == "debug":
-    loglevel = logging.DEBUG
+    loglevel = logging.INFO  # default logging / fallback if unknown level
     logformat = (
-        "%(asctime)s - [%(levelname)-7s]"
-        " %(filename)s:%(lineno)4d %(funcName)15s(): - %(message)s"
+        "%(asctime)s - [%(levelname)-7s] %(filename)s:%(lineno)4d %(message)s"
     )
-elif level in ("warn", "warning", "default"):
-    loglevel = logging.WARNING
-elif level in ("err", "error", "fatal"):
-    loglevel = logging.ERROR
 
-logging.basicConfig(format=logformat, level=loglevel)
+    if level == "debug":
+        loglevel = logging.DEBUG
+        logformat = (
+            "%(asctime)s - [%(levelname)-7s]"
+            " %(filename)s:%(lineno)4d %(funcName)15s(): - %(message)s"
+        )
+    elif level in ("warn", "warning", "default"):
+        loglevel = logging.WARNING
+    elif level in ("err", "error", "fatal"):
+        loglevel = logging.ERROR
+
+    logging.basicConfig(format=logformat, level=loglevel)
+
+
+CACHE_DIR = ".cache"
+
+# Packages generators: apt-ftparchive subprocess or in-process .deb reader
+BACKENDS = ("apt-ftparchive", "native")
+
+# above this many new or changed .debs a single apt-ftparchive run over the
+# whole component is cheaper than one run per file
+INCREMENTAL_SCAN_LIMIT = 32
+
+# apt-ftparchive output is read and written on in chunks of this size
+STREAM_CHUNK = 256 * 1024
+# lines of apt-ftparchive output shown in the debug log
+LOG_LINES = 20
+# stanzas queued per binary-<arch> index when several are written at once
+# (bounds memory use; see Repository._write_indexes)
+INDEX_QUEUE_STANZAS = 256
+
+# generations of by-hash index files kept for Acquire-By-Hash clients
+BY_HASH_KEEP = 3
+
+# concurrent .deb downloads for the 'direct' download engine
+DOWNLOAD_JOBS = 8
+
+# previous dists/<release> trees kept after a staged publish, so clients
+# that fetched the old InRelease can still fetch the files it lists
+STAGED_KEEP = 2
+
+# versions of each package (per component and arch) 'repo gc' keeps
+GC_KEEP = 3
+
+# seconds without pool changes that end a 'repo watch' batch, and the
+# longest a batch waits for that
+WATCH_DEBOUNCE = 2.0
+WATCH_MAX_DELAY = 30.0
+
+# signing key algorithms --gen-key offers; ed25519 generates in
+# milliseconds where rsa4096 can take minutes on an entropy-starved VM
+KEY_ALGOS = ("rsa4096", "rsa3072", "ed25519")
+KEY_ALGO = "rsa4096"
 
 
 class RepoError(Exception):
@@ -60,15 +130,69 @@ def run_cmd(
     cmd: list[str],
     rm_file: str = "",
     env: dict[str, str] | None = None,
+    cwd: str | None = None,
 ) -> str:
     logger.debug("Running command: %s", " ".join(cmd))
-    output = subprocess.run(
-        cmd, capture_output=True, text=True, check=False, env=env,
-    )
-    if output.returncode != 0:
-        rm_files([rm_file])
-        raise RepoError(output.stderr)
-    return output.stdout
+    # stderr goes to a temporary file so stdout can be read to the end
+    # before waiting, which lets wait_child() collect the child's rusage
+    with (
+        instrument.measure(os.path.basename(cmd[0]), " ".join(cmd[1:])),
+        tempfile.TemporaryFile("w+") as stderr,
+        subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            text=True,
+            env=env,
+            cwd=cwd,
+        ) as proc,
+    ):
+        stdout = proc.stdout.read() if proc.stdout else ""
+        if instrument.wait_child(proc) != 0:
+            rm_files([rm_file])
+            stderr.seek(0)
+            raise RepoError(stderr.read())
+    return stdout
+
+
+class _IndexThread(threading.Thread):
+    """Write one binary-<arch> index from stanzas put on a queue.
+
+    A None ends the index, which is committed unless aborted is set.
+    """
+
+    def __init__(self, repo: "Repository", component: str, arch: str) -> None:
+        super().__init__(name=f"index-{component}-{arch}", daemon=True)
+        self.repo = repo
+        self.component = component
+        self.arch = arch
+        self.stanzas: queue.Queue[str | None] = queue.Queue(
+            INDEX_QUEUE_STANZAS,
+        )
+        self.aborted = False
+        self.error: BaseException | None = None
+        self.finished = False
+
+    def _chunks(self) -> Iterator[str]:
+        while (stanza := self.stanzas.get()) is not None:
+            yield stanza
+        self.finished = True
+        if self.aborted:
+            raise RepoError("reading stanzas failed")
+
+    def run(self) -> None:
+        try:
+            with instrument.measure(
+                "index", f"{self.component}/binary-{self.arch}", thread=True,
+            ):
+                self.repo._write_index(  # noqa: SLF001
+                    self.component, self.arch, self._chunks(),
+                )
+        except Exception as e:  # noqa: BLE001 - raised again by the caller
+            self.error = e
+            # keep draining so the producer never blocks on a full queue
+            while not self.finished and self.stanzas.get() is not None:
+                pass
 
 
 class Repository:
@@ -80,15 +204,53 @@ class Repository:
         version: str,
         origin: str,
         quiet: bool = False,
+        *,
+        incremental: bool = False,
+        cache_dir: str = "",
+        backend: str = "apt-ftparchive",
+        jobs: int = 1,
+        codecs: tuple[str, ...] | None = None,
+        by_hash_keep: int = BY_HASH_KEEP,
+        pdiff_keep: int = 0,
+        exclude: Iterable[str] = (),
     ) -> None:
         if not exists(path):
             raise RepoError(f"repository {path} does not exist")
+        if backend not in BACKENDS:
+            raise RepoError(
+                f"unknown index backend '{backend}' (valid options:"
+                f" {', '.join(BACKENDS)})",
+            )
         self.path = path
         self.release = release
         self.pool = pool
         self.version = version
         self.origin = origin
         self.quiet = quiet
+        self.incremental = incremental
+        self.cache_dir = cache_dir or join(path, CACHE_DIR)
+        self.backend = backend
+        self.jobs = jobs if jobs > 0 else os.cpu_count() or 1
+        # None: repo_lib.compress.DEFAULT_CODECS (gz, bz2, xz)
+        self.codecs = codecs
+        self.by_hash_keep = max(by_hash_keep, 0)
+        self.pdiff_keep = max(pdiff_keep, 0)
+        # .debs (relative to path) left out of every index, though still in
+        # the pool; see pool_gc
+        self.exclude = frozenset(exclude)
+        # where index files are written; see staged()
+        self.dist_dir = join(path, "dists", release)
+        # the manifest is shared by indexes written concurrently
+        self._manifest_lock = threading.Lock()
+
+    @staticmethod
+    def _archive_args(command: str, input_str: str, arch: str) -> list[str]:
+        archive_cmd: list[str] = [
+            "/usr/bin/apt-ftparchive", command, input_str,
+        ]
+        if arch:
+            archive_cmd.insert(1, f"--arch={arch}")
+        return archive_cmd
 
     def _archive_cmd(
         self, command: str, input_str: str, arch: str = "",
@@ -96,21 +258,229 @@ class Repository:
         logger.debug(
             "command=%r, input_str=%r, arch=%r", command, input_str, arch,
         )
-        cwd = os.getcwd()
-        os.chdir(self.path)
-        archive_cmd: list[str] = [
-            "/usr/bin/apt-ftparchive", command, input_str,
-        ]
-        if arch:
-            archive_cmd.insert(1, f"--arch={arch}")
-        try:
-            apt_archive_out = run_cmd(archive_cmd)
-        finally:
-            os.chdir(cwd)
-        log_stdout = "\n".join(apt_archive_out.split("\n")[:20]) + "\n..."
-        logger.debug("stdout (abridged):\n%s", log_stdout)
+        # cwd is passed to the child rather than set with os.chdir(), which
+        # would race when several runs happen at once (see jobs)
+        apt_archive_out = run_cmd(
+            self._archive_args(command, input_str, arch), cwd=self.path,
+        )
+        log_stdout = "\n".join(
+            apt_archive_out.split("\n", LOG_LINES)[:LOG_LINES],
+        )
+        logger.debug("stdout (abridged):\n%s\n...", log_stdout)
         return apt_archive_out
 
+    def _archive_stream(
+        self, command: str, input_str: str, arch: str = "",
+    ) -> Iterator[str]:
+        """Yield apt-ftparchive output in chunks, as it is produced.
+
+        Unlike _archive_cmd() the output is never held in memory as a
+        whole, so memory use does not grow with the size of the pool.
+        stderr goes to a temporary file, so a chatty run can not fill the
+        pipe and stall while stdout is being read.
+        """
+        logger.debug(
+            "command=%r, input_str=%r, arch=%r", command, input_str, arch,
+        )
+        archive_cmd = self._archive_args(command, input_str, arch)
+        logger.debug("Running command: %s", " ".join(archive_cmd))
+        head: list[str] = []
+        with (
+            instrument.measure("apt-ftparchive", " ".join(archive_cmd[1:])),
+            tempfile.TemporaryFile("w+") as stderr,
+            subprocess.Popen(
+                archive_cmd,
+                cwd=self.path,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                text=True,
+            ) as proc,
+        ):
+            while proc.stdout and (chunk := proc.stdout.read(STREAM_CHUNK)):
+                if len(head) < LOG_LINES and logger.isEnabledFor(
+                    logging.DEBUG,
+                ):
+                    head.extend(chunk.split("\n", LOG_LINES - len(head)))
+                yield chunk
+            if instrument.wait_child(proc) != 0:
+                stderr.seek(0)
+                raise RepoError(stderr.read())
+        logger.debug(
+            "stdout (abridged):\n%s\n...", "\n".join(head[:LOG_LINES]),
+        )
+
+    def _incremental_packages(
+        self,
+        component: str,
+        debs: list[tuple[str, os.stat_result]],
+        archs: list[str],
+    ) -> list[tuple[str, str]]:
+        """Return (filename, stanza) for component from the stanza cache.
+
+        debs is the walked component (see walk_debs); stanzas are returned
+        for those matching any of archs, in Filename order as apt-ftparchive
+        sorts them. Only .deb files that are new, or whose size, mtime or
+        inode changed since the last run, are passed to apt-ftparchive;
+        every other stanza comes from the cache. Joined, the stanzas are
+        byte-identical to a full 'apt-ftparchive packages' run over the
+        component.
+        """
+        component_dir = join(self.pool, component)
+        cache = PackagesCache(
+            join(self.cache_dir, f"packages-{component}.json"),
+        )
+        cache.prune(filename for filename, _ in debs)
+        debs = [
+            (filename, stat)
+            for filename, stat in sorted(debs)
+            if any(arch_matches(filename, arch) for arch in archs)
+        ]
+        stale = [
+            (filename, stat)
+            for filename, stat in debs
+            if cache.get(filename, stat) is None
+        ]
+        logger.debug(
+            "%d of %d .deb file(s) need (re)indexing", len(stale), len(debs),
+        )
+        if len(stale) > INCREMENTAL_SCAN_LIMIT * self.jobs:
+            fresh = {
+                stanza_filename(stanza): stanza
+                for stanza in iter_stanzas(
+                    self._archive_stream(
+                        "packages",
+                        component_dir,
+                        arch=archs[0] if len(archs) == 1 else "",
+                    ),
+                )
+            }
+            for filename, stat in stale:
+                cache.put(filename, stat, fresh.get(filename, ""))
+        else:
+            for (filename, stat), stanza in zip(
+                stale,
+                parallel_map(
+                    lambda deb: self._archive_cmd("packages", deb[0]),
+                    stale,
+                    self.jobs,
+                ),
+                strict=True,
+            ):
+                cache.put(filename, stat, stanza)
+        cache.save()
+        return [
+            (filename, str(cache.get(filename, stat)))
+            for filename, stat in debs
+        ]
+
+    def _native_packages(
+        self,
+        component: str,
+        debs: list[tuple[str, os.stat_result]],
+        archs: list[str],
+    ) -> Iterator[tuple[str, str]]:
+        """Yield (filename, stanza) for component, read in-process.
+
+        debs is the walked component (see walk_debs); stanzas are yielded
+        for those matching any of archs. Stanzas are generated one .deb at
+        a time in Filename order, so the full Packages content is never
+        held in memory. With jobs > 1 the .debs are read and hashed by a
+        thread pool; results are still yielded in Filename order. With
+        incremental set, unchanged .debs are served from the stanza cache.
+        """
+        from repo_lib.deb import deb_stanza  # noqa: PLC0415
+
+        debs = sorted(debs)
+        cache = None
+        if self.incremental:
+            cache = PackagesCache(
+                join(self.cache_dir, f"packages-{component}-native.json"),
+            )
+            cache.prune(filename for filename, _ in debs)
+        debs = [
+            (filename, stat)
+            for filename, stat in debs
+            if any(arch_matches(filename, arch) for arch in archs)
+        ]
+
+        def stanza(deb: tuple[str, os.stat_result]) -> str:
+            filename, stat = deb
+            cached = cache.get(filename, stat) if cache else None
+            if cached is not None:
+                return cached
+            return deb_stanza(join(self.path, filename), filename)
+
+        for (filename, stat), text in zip(
+            debs, parallel_map(stanza, debs, self.jobs), strict=True,
+        ):
+            if cache:
+                cache.put(filename, stat, text)
+            yield filename, text
+        if cache:
+            cache.save()
+
+    def _stanzas(
+        self,
+        component: str,
+        debs: list[tuple[str, os.stat_result]],
+        archs: list[str],
+    ) -> Iterator[tuple[str, str]]:
+        """Yield (filename, stanza) for the .debs of component in archs.
+
+        Each matching .deb is read once however many archs are given, so
+        Architecture: all packages can be shared between binary-* indexes.
+        """
+        if self.backend == "native":
+            yield from self._native_packages(component, debs, archs)
+        elif self.incremental:
+            yield from self._incremental_packages(component, debs, archs)
+        else:
+            for stanza in iter_stanzas(
+                self._archive_stream(
+                    "packages",
+                    join(self.pool, component),
+                    arch=archs[0] if len(archs) == 1 else "",
+                ),
+            ):
+                filename = stanza_filename(stanza)
+                if filename not in self.exclude and any(
+                    arch_matches(filename, arch) for arch in archs
+                ):
+                    yield filename, stanza
+
+    def _packages(self, component: str, arch: str) -> Iterator[str]:
+        """Yield the Packages content for component/arch in chunks."""
+        if self.backend == "native" or self.incremental or self.exclude:
+            debs = self._walk(component)
+            for _, stanza in self._stanzas(component, debs, [arch]):
+                yield stanza
+        else:
+            yield from self._archive_stream(
+                "packages", join(self.pool, component), arch=arch,
+            )
+
+    def _walk(self, component: str) -> list[tuple[str, os.stat_result]]:
+        """Return walk_debs() of component, as a list, less exclude."""
+        with instrument.measure("walk", component):
+            return [
+                (filename, stat)
+                for filename, stat in walk_debs(
+                    self.path, join(self.pool, component),
+                )
+                if filename not in self.exclude
+            ]
+
+    def components(self) -> list[str]:
+        """Return the components in the pool (its subdirectories), sorted."""
+        pool_dir = join(self.path, self.pool)
+        if not isdir(pool_dir):
+            raise RepoError(f"pool '{pool_dir}' does not exist")
+        return sorted(
+            name
+            for name in os.listdir(pool_dir)
+            if isdir(join(pool_dir, name))
+        )
+
     def index(self, component: str, arch: str) -> None:
         logger.debug("(component=%r, arch=%r)", component, arch)
         component_dir = join(self.pool, component)
@@ -118,50 +488,340 @@ class Repository:
             raise RepoError(
                 f"component '{join(self.path, component_dir)}' does not exist",
             )
+        with instrument.measure("index", f"{component}/binary-{arch}"):
+            self._write_index(
+                component, arch, self._packages(component, arch),
+            )
+
+    def index_all(self, archs: list[str] | None = None) -> None:
+        """Index every component of the pool for every architecture.
+
+        archs defaults to the architectures named by the .debs in the pool
+        (see deb_archs), shared by all components so that each component
+        gets a binary-<arch> index per architecture of the release. The
+        pool is walked once and every .deb read once; the stanzas of
+        Architecture: all packages are reused for each binary-* index.
+        """
+        components = self.components()
+        if not components:
+            raise RepoError(
+                f"no components found in '{join(self.path, self.pool)}'",
+            )
+        walked = {component: self._walk(component) for component in components}
+        if not archs:
+            archs = deb_archs(
+                filename for debs in walked.values() for filename, _ in debs
+            )
+        if not archs:
+            raise RepoError(
+                f"no .deb files found in '{join(self.path, self.pool)}'",
+            )
+        logger.info(
+            "Indexing %s for %s",
+            ", ".join(components),
+            ", ".join(archs),
+        )
+        for component in components:
+            stanzas = self._stanzas(component, walked[component], archs)
+            if len(archs) > 1:
+                self._write_indexes(component, archs, stanzas)
+                continue
+            with instrument.measure("index", f"{component}/binary-{archs[0]}"):
+                self._write_index(
+                    component, archs[0], (stanza for _, stanza in stanzas),
+                )
 
-        output_dir = join(
-            self.path, "dists", self.release, component, f"binary-{arch}",
+    def _write_indexes(
+        self,
+        component: str,
+        archs: list[str],
+        stanzas: Iterable[tuple[str, str]],
+    ) -> None:
+        """Write the binary-<arch> indexes of component for all archs at once.
+
+        stanzas is read once and each stanza handed to the index thread of
+        every arch it matches, over a bounded queue, so memory use does
+        not grow with the size of the pool. If reading stanzas fails, no
+        index is committed.
+        """
+        threads = [_IndexThread(self, component, arch) for arch in archs]
+        for thread in threads:
+            thread.start()
+        try:
+            for filename, stanza in stanzas:
+                for thread in threads:
+                    if arch_matches(filename, thread.arch):
+                        thread.stanzas.put(stanza)
+        except BaseException:
+            for thread in threads:
+                thread.aborted = True
+            raise
+        finally:
+            for thread in threads:
+                thread.stanzas.put(None)
+            for thread in threads:
+                thread.join()
+        for thread in threads:
+            if thread.error:
+                raise thread.error
+
+    def publish(
+        self,
+        gpgkey: str = "",
+        gnupghome: str = "",
+        archs: list[str] | None = None,
+        *,
+        staged: bool = False,
+        keep: int = STAGED_KEEP,
+    ) -> None:
+        """Index every component/arch (see index_all), then the Release.
+
+        With staged set the new tree is built aside and swapped in whole;
+        see staged().
+        """
+        with self.staged(keep) if staged else contextlib.nullcontext():
+            self.index_all(archs)
+            self.generate_release(gpgkey, gnupghome)
+
+    @contextlib.contextmanager
+    def staged(self, keep: int = STAGED_KEEP) -> Iterator[str]:
+        """Build a new dists/<release> aside and swap it in on success.
+
+        Within the block dist_dir is a fresh generation directory, seeded
+        with hard links to the live tree so incremental state (by-hash,
+        PDiffs) carries over. On a clean exit dists/<release> becomes a
+        symlink to it, replaced atomically, and all but the newest keep
+        previous generations are removed; on error the generation is
+        discarded and the live tree is left as it was. Yields the
+        generation directory.
+        """
+        from repo_lib.staging import (  # noqa: PLC0415
+            activate,
+            link_tree,
+            new_generation,
+            prune_generations,
         )
 
+        dists_dir = join(self.path, "dists")
+        live = join(dists_dir, self.release)
+        generation = new_generation(dists_dir, self.release)
+        logger.debug("Staging: %s", generation)
+        if isdir(live):
+            link_tree(live, generation)
+        else:
+            os.makedirs(generation)
+        self.dist_dir = generation
+        try:
+            yield generation
+        except BaseException:
+            shutil.rmtree(generation, ignore_errors=True)
+            raise
+        else:
+            activate(dists_dir, self.release, generation)
+            prune_generations(dists_dir, self.release, max(keep, 0))
+        finally:
+            self.dist_dir = live
+
+    def _write_index(
+        self, component: str, arch: str, chunks: Iterable[str],
+    ) -> None:
+        """Write the binary-<arch> index files of component from chunks."""
+        output_dir = join(self.dist_dir, component, f"binary-{arch}")
+
         os.makedirs(output_dir, exist_ok=True)
 
-        output = self._archive_cmd("packages", component_dir, arch=arch)
+        from repo_lib.compress import (  # noqa: PLC0415
+            DEFAULT_CODECS,
+            HashedWriter,
+            MultiCompressor,
+            check_codecs,
+        )
+
         packages_file = join(output_dir, "Packages")
-        logger.debug("Writing: %s", packages_file)
-        with open(packages_file, "w") as fob:
-            if output:
-                output += "\n"
-            fob.write(output)
-
-        for archive in ["gzip", "bzip2", "xz"]:
-            run_cmd(
-                [
-                    join("/usr/bin", archive),
-                    "-k",
-                    join(output_dir, "Packages"),
-                ],
-            )
+        codecs = DEFAULT_CODECS if self.codecs is None else self.codecs
+        check_codecs(codecs)
+        logger.debug("Writing: %s (+ %s)", packages_file, ", ".join(codecs))
+        # keep the previous generation around to diff against
+        old_packages = f"{packages_file}.old"
+        rm_files([old_packages])
+        if self.pdiff_keep and exists(packages_file):
+            os.link(packages_file, old_packages)
+        # Packages and its compressed variants are generated in one pass;
+        # each codec runs in its own thread while the stanzas stream in
+        with (
+            HashedWriter(packages_file) as fob,
+            MultiCompressor(packages_file, codecs) as compressed,
+        ):
+            written = False
+            for chunk in chunks:
+                if chunk:
+                    data = chunk.encode()
+                    fob.write(data)
+                    compressed.write(data)
+                    written = True
+            if written:
+                fob.write(b"\n")
+                compressed.write(b"\n")
+        self._update_by_hash(output_dir, [fob, *compressed.outputs.values()])
+
+        from repo_lib.pdiff import update_pdiffs  # noqa: PLC0415
+
+        try:
+            diff_index = update_pdiffs(fob, old_packages, self.pdiff_keep)
+        finally:
+            rm_files([old_packages])
+        if diff_index:
+            self._update_by_hash(f"{packages_file}.diff", [diff_index])
 
         release_file = join(output_dir, "Release")
         logger.debug("Writing: %s", release_file)
-        with open(release_file, "w") as fob:
-            fob.writelines(
-                [
-                    f"Archive: {self.release}\n",
-                    f"Origin: {self.origin}\n",
-                    f"Label: {self.origin}\n",
-                    f"Version: {self.version}\n",
-                    # TODO implement "Acquire-By-Hash"
-                    # > f"Acquire-By-Hash: yes\n",
-                    f"Component: {component}\n",
-                    f"Architecture: {arch}\n",
-                ],
+        with HashedWriter(release_file) as release:
+            release.write(
+                "".join(
+                    [
+                        f"Archive: {self.release}\n",
+                        f"Origin: {self.origin}\n",
+                        f"Label: {self.origin}\n",
+                        f"Version: {self.version}\n",
+                        *(
+                            ["Acquire-By-Hash: yes\n"]
+                            if self.by_hash_keep
+                            else []
+                        ),
+                        f"Component: {component}\n",
+                        f"Architecture: {arch}\n",
+                    ],
+                ).encode(),
             )
 
-    def generate_release(self, gpgkey: str = "", gnupghome: str = "") -> None:
+        # record sizes and digests of everything written for
+        # generate_release(); done last as by-hash linking touches mtimes
+        with self._manifest_lock:
+            manifest = self._manifest()
+            manifest.set_settings(self.index_settings())
+            for output in [
+                fob,
+                *compressed.outputs.values(),
+                *([diff_index] if diff_index else []),
+                release,
+            ]:
+                manifest.record(output)
+            manifest.save()
+
+    def index_settings(self) -> dict[str, Any]:
+        """Return the options that shape the index files, as JSON data."""
+        return {
+            "origin": self.origin,
+            "version": self.version,
+            "backend": self.backend,
+            "incremental": self.incremental,
+            "codecs": None if self.codecs is None else list(self.codecs),
+            "by_hash_keep": self.by_hash_keep,
+            "pdiff_keep": self.pdiff_keep,
+        }
+
+    def recorded_settings(self) -> dict[str, Any]:
+        """Return the index_settings() the indexes were last written with.
+
+        Empty if they were never recorded.
+        """
+        return self._manifest().settings
+
+    def _manifest(self) -> "Manifest":
+        from repo_lib.manifest import Manifest  # noqa: PLC0415
+
+        return Manifest(
+            join(self.cache_dir, f"manifest-{self.release}.json"),
+            self.dist_dir,
+        )
+
+    def _update_by_hash(
+        self, output_dir: str, outputs: list["HashedWriter"],
+    ) -> None:
+        """Link index files into output_dir/by-hash/SHA256/<digest>.
+
+        Every file linked (or re-linked) by one index run gets the same
+        mtime, which marks it as part of that generation; files outside
+        the newest by_hash_keep generations are pruned. With by_hash_keep
+        set to 0 the by-hash tree is removed instead, so the Release file
+        no longer advertises Acquire-By-Hash.
+        """
+        if not self.by_hash_keep:
+            if exists(join(output_dir, "by-hash")):
+                logger.debug("Removing: %s", join(output_dir, "by-hash"))
+                shutil.rmtree(join(output_dir, "by-hash"))
+            return
+        by_hash_dir = join(output_dir, "by-hash", "SHA256")
+        os.makedirs(by_hash_dir, exist_ok=True)
+        generation = time.time_ns()
+        for output in outputs:
+            target = join(by_hash_dir, output.sha256.hexdigest())
+            if not exists(target):
+                try:
+                    os.link(output.path, target)
+                except OSError:
+                    shutil.copy2(output.path, target)
+            os.utime(target, ns=(generation, generation))
+
+        mtimes = {
+            name: os.stat(join(by_hash_dir, name)).st_mtime_ns
+            for name in os.listdir(by_hash_dir)
+        }
+        keep = sorted(set(mtimes.values()), reverse=True)[: self.by_hash_keep]
+        rm_files(
+            [
+                join(by_hash_dir, name)
+                for name, mtime in mtimes.items()
+                if mtime not in keep
+            ],
+        )
+
+    def _by_hash_complete(self) -> bool:
+        """Return True if every indexed binary-* dir has a by-hash tree."""
+        dist_path = self.dist_dir
+        found = False
+        for component in os.listdir(dist_path):
+            component_path = join(dist_path, component)
+            if not isdir(component_path):
+                continue
+            for binary in os.listdir(component_path):
+                binary_path = join(component_path, binary)
+                if not exists(join(binary_path, "Packages")):
+                    continue
+                if not isdir(join(binary_path, "by-hash", "SHA256")):
+                    return False
+                found = True
+        return found
+
+    def generate_release(
+        self,
+        gpgkey: str = "",
+        gnupghome: str = "",
+        *,
+        signer: "SigningSession | None" = None,
+        components: list[str] | None = None,
+    ) -> None:
+        """Write the Release; sign it with gpgkey, or signer if given.
+
+        Pass one signer (a gpg.SigningSession) to sign many releases
+        with the same key; see generate_releases(). components is the
+        pool listing for the Components field, read if not given.
+        """
+        if gpgkey and not signer:
+            from repo_lib.gpg import SigningSession  # noqa: PLC0415
+
+            signer = SigningSession(gpgkey, gnupghome)
+        with instrument.measure("release", self.release):
+            self._generate_release(signer, components)
+
+    def _generate_release(
+        self,
+        signer: "SigningSession | None",
+        components: list[str] | None,
+    ) -> None:
         def get_archs() -> set[str]:
             archs = set()
-            dist_path = join(self.path, "dists", self.release)
+            dist_path = self.dist_dir
             for component in os.listdir(dist_path):
                 component_path = join(dist_path, component)
                 if not isdir(component_path):
@@ -172,51 +832,58 @@ class Repository:
             logger.debug("Return: archs=%r", archs)
             return archs
 
-        components_dir = join(self.path, self.pool)
-        release_dir = join("dists", self.release)
+        if components is None:
+            components = os.listdir(join(self.path, self.pool))
 
         release_files: dict[str, str] = {}
         for rel_file in (
             "Release",
             "Release.gpg",
             "InRelease",
-            "InRelease.tmp",
         ):
-            rel_path = join(self.path, release_dir, rel_file)
+            rel_path = join(self.dist_dir, rel_file)
             release_files[rel_file] = rel_path
         rm_files(list(release_files.values()))
 
-        hashes = self._archive_cmd("release", release_dir)
+        # digests come from the manifest written by index(); only files
+        # not recorded there, or changed since, are hashed here
+        manifest = self._manifest()
+        hashes = manifest.release_hashes()
+        manifest.save()
         day = datetime.now(UTC).strftime("%d %b %Y")
         date_time = datetime.now(UTC).strftime(
             "%a, %d %b %Y %H:%M:%S UTC",
         )
         logger.debug("Writing: %s", release_files["Release"])
+        text = "".join(
+            [
+                f"Origin: {self.origin}\n",
+                f"Label: {self.origin}\n",
+                f"Suite: {self.release}\n",
+                f"Version: {self.version}\n",
+                f"Codename: {self.release}\n",
+                # TODO url for pkg changelogs & other metadata
+                # > f"Changelogs: CHANGELOG_URL_GOES_HERE",
+                f"Date: {date_time}\n",
+                *(
+                    ["Acquire-By-Hash: yes\n"]
+                    if self._by_hash_complete()
+                    else []
+                ),
+                # TODO need to look at this more closely; my reading
+                #   suggests that this might make 'apt update' quicker
+                # > f"No-Support-for-Architecture-all: Packages\n",
+                f"Architectures: {' '.join(get_archs())}\n",
+                f"Components: {' '.join(components)}\n",
+                f"Description: {self.origin} {self.release}"
+                f" {self.version} Released {day}\n",
+                f"{hashes}\n",
+            ],
+        )
         with open(release_files["Release"], "w") as fob:
-            fob.writelines(
-                [
-                    f"Origin: {self.origin}\n",
-                    f"Label: {self.origin}\n",
-                    f"Suite: {self.release}\n",
-                    f"Version: {self.version}\n",
-                    f"Codename: {self.release}\n",
-                    # TODO url for pkg changelogs & other metadata
-                    # > f"Changelogs: CHANGELOG_URL_GOES_HERE",
-                    f"Date: {date_time}\n",
-                    # TODO implement "Acquire-By-Hash"
-                    # > f"Acquire-By-Hash: yes\n",
-                    # TODO need to look at this more closely; my reading
-                    #   suggests that this might make 'apt update' quicker
-                    # > f"No-Support-for-Architecture-all: Packages\n",
-                    f"Architectures: {' '.join(get_archs())}\n",
-                    f"Components: {' '.join(os.listdir(components_dir))}\n",
-                    f"Description: {self.origin} {self.release}"
-                    f" {self.version} Released {day}\n",
-                    f"{hashes}\n",
-                ],
-            )
+            fob.write(text)
 
-        if not gpgkey:
+        if not signer:
             gpg_warn = "gpg key not supplied so release file/s unsigned"
             logger.warning(gpg_warn)
             if not self.quiet:
@@ -225,43 +892,41 @@ class Repository:
                     file=sys.stderr,
                 )
         else:
-            logger.debug("Writing: %s", release_files["InRelease.tmp"])
-            with (
-                open(
-                    release_files["InRelease.tmp"], "w",
-                ) as inrelease_fob,
-                open(release_files["Release"]) as release_fob,
-            ):
-                inrelease_fob.writelines(release_fob)
-
-            gpg_env: dict[str, str] | None = None
-            if gnupghome:
-                gpg_env = {**os.environ, "GNUPGHOME": gnupghome}
-
-            gpg_cmd = [
-                "/usr/bin/gpg",
-                "--armor",
-                "--sign",
-                "--local-user",
-                gpgkey,
-            ]
-            for gpg_args in (
-                [
-                    "--detach-sign",
-                    "--output",
-                    release_files["Release.gpg"],
-                    release_files["Release"],
-                ],
-                [
-                    "--clearsign",
-                    "--output",
-                    release_files["InRelease"],
-                    release_files["InRelease.tmp"],
-                ],
-            ):
-                run_cmd([*gpg_cmd, *gpg_args], env=gpg_env)
+            signer.sign(release_files["Release"], text)
         log_msg = ["Release file generated"]
-        if gpgkey:
+        if signer:
             log_msg.append(", InRelease file generated and both signed")
-            os.remove(release_files["InRelease.tmp"])
         logger.debug("".join(log_msg))
+
+
+def generate_releases(
+    repos: list[Repository],
+    gpgkey: str = "",
+    gnupghome: str = "",
+    *,
+    signer: "SigningSession | None" = None,
+    jobs: int = 0,
+) -> None:
+    """Generate the Release of several suites at once.
+
+    Each pool is listed once for all the suites that share it, and one
+    signing session signs them all. Suites are generated up to jobs
+    (0: all of them) at a time; each only reads its own dists/<release>.
+    """
+    if gpgkey and not signer:
+        from repo_lib.gpg import SigningSession  # noqa: PLC0415
+
+        signer = SigningSession(gpgkey, gnupghome)
+    listings: dict[str, list[str]] = {}
+    for repo in repos:
+        pool_dir = join(repo.path, repo.pool)
+        if pool_dir not in listings:
+            listings[pool_dir] = os.listdir(pool_dir)
+
+    def release(repo: Repository) -> None:
+        repo.generate_release(
+            signer=signer, components=listings[join(repo.path, repo.pool)],
+        )
+
+    for _ in parallel_map(release, repos, jobs or len(repos)):
+        pass
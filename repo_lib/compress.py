@@ -0,0 +1,287 @@
+"""Concurrent single-pass compression of index files (Packages.gz etc)."""
+from __future__ import annotations
+
+import bz2
+import hashlib
+import logging
+import lzma
+import os
+import queue
+import subprocess
+import threading
+import zlib
+from typing import TYPE_CHECKING, Protocol, Self
+
+from repo_lib import RepoError, instrument, rm_files
+
+if TYPE_CHECKING:
+    from types import TracebackType
+
+logger = logging.getLogger(__name__)
+
+# codec name -> file extension
+CODECS = {
+    "gz": ".gz",
+    "bz2": ".bz2",
+    "xz": ".xz",
+    "zst": ".zst",
+}
+DEFAULT_CODECS = ("gz", "bz2", "xz")
+
+# digests recorded for every file written (those listed in Release files)
+DIGESTS = ("md5", "sha1", "sha256", "sha512")
+
+# data is handed to the codec threads in blocks of this size
+BLOCK_SIZE = 256 * 1024
+# blocks queued per codec before write() blocks (bounds memory use)
+QUEUE_BLOCKS = 16
+
+
+class HashedWriter:
+    """Binary output file written via a temporary file and hashed on the way.
+
+    The data only replaces path on commit(), so readers never see a
+    partially written file and existing hard links to path keep the old
+    content. size and hashes (one hashlib object per name in DIGESTS)
+    describe the committed file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.fob = open(self.tmp_path, "wb")  # noqa: SIM115
+        self.size = 0
+        self.hashes = {algo: hashlib.new(algo) for algo in DIGESTS}
+
+    @property
+    def sha256(self) -> hashlib._Hash:
+        return self.hashes["sha256"]
+
+    def hexdigests(self) -> dict[str, str]:
+        return {
+            algo: digest.hexdigest() for algo, digest in self.hashes.items()
+        }
+
+    def write(self, data: bytes) -> None:
+        self.fob.write(data)
+        self.size += len(data)
+        for digest in self.hashes.values():
+            digest.update(data)
+
+    def rehash(self) -> None:
+        """Hash the temporary file from disk (written by someone else)."""
+        self.fob.flush()
+        self.size = 0
+        self.hashes = {algo: hashlib.new(algo) for algo in DIGESTS}
+        with open(self.tmp_path, "rb") as fob:
+            while data := fob.read(BLOCK_SIZE):
+                self.size += len(data)
+                for digest in self.hashes.values():
+                    digest.update(data)
+
+    def commit(self) -> None:
+        self.fob.close()
+        logger.debug("Writing: %s", self.path)
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        self.fob.close()
+        rm_files([self.tmp_path])
+
+    def __enter__(self) -> Self:
+        """Return self; the file is committed on a clean exit."""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Commit the file, or discard it on error."""
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class _Compressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+    def flush(self) -> bytes: ...
+
+
+class _ZstdProcess:
+    """zstd binary wrapped in the compress()/flush() compressor interface."""
+
+    def __init__(self, output: HashedWriter) -> None:
+        self.output = output
+        self.proc = subprocess.Popen(
+            ["/usr/bin/zstd", "-q", "-c", "-19"],
+            stdin=subprocess.PIPE,
+            stdout=output.fob,
+            stderr=subprocess.PIPE,
+        )
+
+    def compress(self, data: bytes) -> bytes:
+        if self.proc.stdin:
+            self.proc.stdin.write(data)
+        return b""
+
+    def flush(self) -> bytes:
+        _, stderr = self.proc.communicate()
+        if self.proc.returncode != 0:
+            raise RepoError(stderr.decode(errors="replace"))
+        # zstd wrote straight to the file, bypassing the hashing writer
+        self.output.rehash()
+        return b""
+
+
+def _compressor(codec: str, output: HashedWriter) -> _Compressor:
+    if codec == "gz":
+        # gzip -9n equivalent: no name or timestamp in the header
+        return zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(9)
+    if codec == "xz":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    # zst: Python 3.14+ stdlib, else the zstandard module, else zstd binary;
+    # level 19 as used by apt's own zstd compressor settings
+    try:
+        from compression import zstd  # type: ignore[import-not-found]  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        return zstd.ZstdCompressor(level=19)  # type: ignore[no-any-return]
+    try:
+        import zstandard  # type: ignore[import-not-found]  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        return zstandard.ZstdCompressor(level=19).compressobj()  # type: ignore[no-any-return]
+    return _ZstdProcess(output)
+
+
+def check_codecs(codecs: tuple[str, ...] | list[str]) -> None:
+    """Raise RepoError if any of codecs is not supported."""
+    unknown = [codec for codec in codecs if codec not in CODECS]
+    if unknown:
+        raise RepoError(
+            f"unsupported compression '{', '.join(unknown)}' (valid"
+            f" options: {', '.join(CODECS)})",
+        )
+
+
+class _CodecThread(threading.Thread):
+    """Compress blocks from a queue into one output file."""
+
+    def __init__(self, path: str, codec: str) -> None:
+        super().__init__(name=f"compress-{codec}", daemon=True)
+        self.codec = codec
+        self.output = HashedWriter(path)
+        self.blocks: queue.Queue[bytes | None] = queue.Queue(QUEUE_BLOCKS)
+        self.error: BaseException | None = None
+
+    def run(self) -> None:
+        finished = False
+        try:
+            with instrument.measure(
+                "compress", self.output.path, thread=True,
+            ) as stage:
+                compressor = _compressor(self.codec, self.output)
+                while (block := self.blocks.get()) is not None:
+                    stage.read_bytes += len(block)
+                    self.output.write(compressor.compress(block))
+                finished = True
+                self.output.write(compressor.flush())
+                stage.write_bytes = self.output.size
+        except Exception as e:  # noqa: BLE001 - raised again by close()
+            self.error = e
+            # keep draining so the producer never blocks on a full queue
+            while not finished and self.blocks.get() is not None:
+                pass
+
+
+class MultiCompressor:
+    """File-like sink that writes <path>.<ext> for several codecs at once.
+
+    Data written is read once and handed to one thread per codec, so the
+    compressors run concurrently and the total time is that of the
+    slowest codec. Output goes to temporary files which replace the
+    existing ones only when close() succeeds; outputs then maps each
+    compressed file's path to its (committed) HashedWriter. Compressed
+    variants of path for codecs that are not selected are removed, so no
+    stale copy is left behind when the codec set changes.
+    """
+
+    def __init__(
+        self, path: str, codecs: tuple[str, ...] | list[str],
+    ) -> None:
+        check_codecs(codecs)
+        self.path = path
+        self.buffer = bytearray()
+        self.outputs: dict[str, HashedWriter] = {}
+        self.threads = [
+            _CodecThread(f"{path}{CODECS[codec]}", codec) for codec in codecs
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _dispatch(self, block: bytes | None) -> None:
+        for thread in self.threads:
+            thread.blocks.put(block)
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_SIZE:
+            self._dispatch(bytes(self.buffer))
+            self.buffer.clear()
+
+    def _finish(self) -> None:
+        if self.buffer:
+            self._dispatch(bytes(self.buffer))
+            self.buffer.clear()
+        self._dispatch(None)
+        for thread in self.threads:
+            thread.join()
+
+    def abort(self) -> None:
+        self._finish()
+        for thread in self.threads:
+            thread.output.discard()
+
+    def close(self) -> None:
+        self._finish()
+        errors = [thread.error for thread in self.threads if thread.error]
+        if errors:
+            for thread in self.threads:
+                thread.output.discard()
+            raise RepoError(
+                f"compressing {self.path} failed: {errors[0]}",
+            ) from errors[0]
+        selected = {thread.codec for thread in self.threads}
+        for thread in self.threads:
+            thread.output.commit()
+            self.outputs[thread.output.path] = thread.output
+        rm_files(
+            [
+                f"{self.path}{ext}"
+                for codec, ext in CODECS.items()
+                if codec not in selected
+            ],
+        )
+
+    def __enter__(self) -> Self:
+        """Return self; output is committed on a clean exit."""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Commit the compressed files, or discard them on error."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,260 @@
+"""In-process .deb control extraction for the native Packages backend."""
+from __future__ import annotations
+
+import bz2
+import hashlib
+import io
+import logging
+import lzma
+import subprocess
+import tarfile
+import zlib
+from typing import IO
+
+from repo_lib import RepoError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+
+# what a damaged control.tar.* raises while being decompressed, untarred
+# or decoded (bz2 raises OSError)
+CORRUPT_ERRORS = (
+    lzma.LZMAError,
+    zlib.error,
+    EOFError,
+    OSError,
+    tarfile.TarError,
+    UnicodeDecodeError,
+)
+
+# (Packages field, hashlib name) in the order apt-ftparchive writes them
+HASHES = (
+    ("MD5sum", "md5"),
+    ("SHA1", "sha1"),
+    ("SHA256", "sha256"),
+    ("SHA512", "sha512"),
+)
+
+# field order used by apt-ftparchive (apt-pkg's TFRewritePackageOrder);
+# fields not listed here follow in the order they appear in the control file
+FIELD_ORDER = (
+    "Package",
+    "Package-Type",
+    "Architecture",
+    "Subarchitecture",
+    "Version",
+    "Revision",
+    "Package-Revision",
+    "Package_Revision",
+    "Kernel-Version",
+    "Built-Using",
+    "Built-For-Profiles",
+    "Multi-Arch",
+    "Status",
+    "Priority",
+    "Class",
+    "Essential",
+    "Installer-Menu-Item",
+    "Section",
+    "Source",
+    "Origin",
+    "Maintainer",
+    "Original-Maintainer",
+    "Bugs",
+    "Config-Version",
+    "Conffiles",
+    "Triggers-Awaited",
+    "Triggers-Pending",
+    "Installed-Size",
+    "Provides",
+    "Pre-Depends",
+    "Depends",
+    "Recommends",
+    "Suggests",
+    "Optional",
+    "Conflicts",
+    "Breaks",
+    "Replaces",
+    "Enhances",
+    "Filename",
+    "MSDOS-Filename",
+    "Size",
+    "MD5sum",
+    "SHA1",
+    "SHA256",
+    "SHA512",
+    "Homepage",
+    "Description",
+    "Tag",
+    "Task",
+)
+_FIELD_RANK = {name.lower(): rank for rank, name in enumerate(FIELD_ORDER)}
+
+
+class _HashingReader:
+    """File wrapper that hashes everything read through it."""
+
+    def __init__(self, fob: IO[bytes]) -> None:
+        self.fob = fob
+        self.size = 0
+        self.hashes = {field: hashlib.new(algo) for field, algo in HASHES}
+
+    def read(self, size: int) -> bytes:
+        data = self.fob.read(size)
+        self.size += len(data)
+        for digest in self.hashes.values():
+            digest.update(data)
+        return data
+
+    def skip(self, size: int) -> int:
+        """Read past size bytes; return how many there were."""
+        skipped = 0
+        while skipped < size:
+            data = self.read(min(size - skipped, CHUNK_SIZE))
+            if not data:
+                break
+            skipped += len(data)
+        return skipped
+
+    def drain(self) -> None:
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    # Python 3.14+ ships zstd in the stdlib; otherwise use the zstandard
+    # module if present and fall back to the zstd binary.
+    try:
+        from compression import zstd  # type: ignore[import-not-found]  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        return bytes(zstd.decompress(data))
+    try:
+        import zstandard  # type: ignore[import-not-found]  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        return bytes(decompressor.decompress(data))
+    result = subprocess.run(
+        ["/usr/bin/zstd", "-dc"], input=data, capture_output=True, check=False,
+    )
+    if result.returncode != 0:
+        raise RepoError(result.stderr.decode(errors="replace"))
+    return result.stdout
+
+
+def _decompress(member: str, data: bytes) -> bytes:
+    if member.endswith(".gz"):
+        return zlib.decompress(data, wbits=zlib.MAX_WBITS | 16)
+    if member.endswith(".xz"):
+        return lzma.decompress(data)
+    if member.endswith(".zst"):
+        return _zstd_decompress(data)
+    if member.endswith(".bz2"):
+        return bz2.decompress(data)
+    if member.endswith(".tar"):
+        return data
+    raise RepoError(f"unsupported control member compression: {member}")
+
+
+def _control_from_tar(member: str, data: bytes) -> str:
+    with tarfile.open(
+        fileobj=io.BytesIO(_decompress(member, data)),
+    ) as tar:
+        for tarinfo in tar:
+            if tarinfo.name in ("./control", "control") and tarinfo.isfile():
+                control = tar.extractfile(tarinfo)
+                if control is not None:
+                    return control.read().decode()
+    raise RepoError(f"no control file in {member}")
+
+
+def read_deb(path: str) -> tuple[str, int, dict[str, str]]:
+    """Return (control, size, digests) for the .deb at path.
+
+    The file is read exactly once: the ar archive is parsed as it streams
+    through the MD5, SHA1, SHA256 and SHA512 hashers, so the control file
+    is pulled out of control.tar.* without a second pass over the package.
+    digests is keyed on the Packages field name (e.g. 'SHA256'). A
+    truncated .deb, or a damaged control member, raises RepoError.
+    """
+    control = ""
+    with open(path, "rb") as fob:
+        reader = _HashingReader(fob)
+        if reader.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise RepoError(f"{path} is not a Debian package (bad ar magic)")
+        # every member is walked, so a truncated data.tar is noticed too
+        while header := reader.read(AR_HEADER_SIZE):
+            if len(header) < AR_HEADER_SIZE:
+                raise RepoError(f"{path}: truncated ar header")
+            try:
+                member = header[:16].decode().strip().rstrip("/")
+                size = int(header[48:58])
+            except ValueError as e:  # also UnicodeDecodeError
+                raise RepoError(f"{path}: corrupt ar header") from e
+            if member.startswith("control.tar") and not control:
+                data = reader.read(size)
+                if len(data) != size:
+                    raise RepoError(f"{path}: truncated {member}")
+                try:
+                    control = _control_from_tar(member, data)
+                except CORRUPT_ERRORS as e:
+                    raise RepoError(f"{path}: corrupt {member}") from e
+            elif reader.skip(size) != size:
+                raise RepoError(f"{path}: truncated {member}")
+            if size % 2:
+                reader.skip(1)
+        if not control:
+            raise RepoError(f"{path}: no control.tar member found")
+        reader.drain()
+    digests = {
+        field: digest.hexdigest() for field, digest in reader.hashes.items()
+    }
+    return control, reader.size, digests
+
+
+def parse_control(control: str) -> list[tuple[str, str]]:
+    """Split a deb822 control paragraph into (field, value) pairs.
+
+    Continuation lines are kept verbatim as part of the value.
+    """
+    fields: list[tuple[str, str]] = []
+    for line in control.strip("\n").split("\n"):
+        if line[:1] in (" ", "\t") and fields:
+            name, value = fields[-1]
+            fields[-1] = (name, f"{value}\n{line}")
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            fields.append((name.strip(), value.strip()))
+    return fields
+
+
+def deb_stanza(path: str, filename: str) -> str:
+    """Return the Packages stanza for the .deb at path.
+
+    filename is the value written to the Filename field, i.e. the path
+    relative to the repository root. The stanza ends with a blank line,
+    as in apt-ftparchive output.
+    """
+    control, size, digests = read_deb(path)
+    fields = [
+        (name, value)
+        for name, value in parse_control(control)
+        if name.lower() not in ("filename", "size", "status")
+        and name not in digests
+    ]
+    fields += [("Filename", filename), ("Size", str(size))]
+    fields += [(field, digests[field]) for field, _ in HASHES]
+    unknown = len(FIELD_ORDER)
+    fields.sort(key=lambda field: _FIELD_RANK.get(field[0].lower(), unknown))
+    lines = [
+        f"{name}: {value}" if value[:1] != "\n" else f"{name}:{value}"
+        for name, value in fields
+    ]
+    return "\n".join(lines) + "\n\n"
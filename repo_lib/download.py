@@ -1,18 +1,86 @@
 """Dependency resolution and pool population for a Debian package repo."""
 from __future__ import annotations
 
+import contextlib
+import errno
+import fcntl
+import functools
+import hashlib
+import http.client
+import json
 import logging
 import os
+import re
 import shutil
 import subprocess
-from os.path import exists, join
+import tempfile
+import urllib.error
+import urllib.request
+from collections import Counter
+from os.path import dirname, exists, join
+from typing import TYPE_CHECKING, NamedTuple
 
-from repo_lib import RepoError
+from repo_lib import DOWNLOAD_JOBS, RepoError, instrument, rm_files
+from repo_lib.packages import parallel_map
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
 
 logger = logging.getLogger(__name__)
 
 APT_CACHE = "/var/cache/apt/archives"
 
+# pool population strategies: apt-get into its cache then copy, or fetch
+# straight into the pool from the URIs apt-get prints
+ENGINES = ("apt", "direct")
+
+# 'URI' filename size hash, as printed by apt-get --print-uris
+_PRINT_URIS_RE = re.compile(
+    r"^'(?P<uri>[^']+)' (?P<filename>\S+) (?P<size>\d+)(?: (?P<hash>\S+))?$",
+)
+
+# 'Inst name [old version] (version release(s) [arch])' from apt-get -s
+_INST_RE = re.compile(
+    r"^Inst (?P<name>\S+) (?:\[[^\]]*\] )?"
+    r"\((?P<version>\S+) .*\[(?P<arch>[^\]]+)\]\)",
+)
+
+# apt hash type (as in --print-uris output) -> hashlib name
+HASH_TYPES = {
+    "MD5Sum": "md5",
+    "SHA1": "sha1",
+    "SHA256": "sha256",
+    "SHA512": "sha512",
+}
+
+# dependency closure: apt-cache depends --recurse, or repo_lib.resolver
+RESOLVERS = ("apt", "native")
+
+# how copy_debs_to_pool places cached .debs into the pool (see PoolLinker)
+LINK_MODES = ("auto", "reflink", "hardlink", "copy")
+AUTO_ORDER = ("reflink", "hardlink", "copy")
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# errors meaning "this filesystem (pair) can not do that", not real failures
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EPERM,
+    errno.ENOSYS,
+}
+
+# dpkg's database of package states, relative to the target root
+DPKG_STATUS = join("var", "lib", "dpkg", "status")
+# Status 'want flag status' wants that still mean "keep it installed"
+_KEEP_WANTS = ("install", "hold")
+
+URI_SCHEMES = ("http", "https", "file")
+FETCH_CHUNK = 256 * 1024
+FETCH_TIMEOUT = 60
+FETCH_RETRIES = 2
+
 
 def _run(cmd: list[str], chroot: str = "") -> str:
     """Run a command on the host or inside a chroot; return stdout."""
@@ -60,8 +128,74 @@ def resolve_deps(packages: list[str], chroot: str = "") -> set[str]:
     return deps
 
 
+def dpkg_arch(chroot: str = "") -> str:
+    """Return the native dpkg architecture of the environment."""
+    return _run(["/usr/bin/dpkg", "--print-architecture"], chroot).strip()
+
+
+def resolve_deps_native(
+    packages: list[str],
+    chroot: str = "",
+    arch: str = "",
+    installed: set[str] | None = None,
+) -> set[str]:
+    """Return the Depends/Pre-Depends closure, resolved in-process.
+
+    Like resolve_deps(), but computed from the environment's apt lists
+    (see repo_lib.resolver) with version constraints and alternatives
+    honoured: of 'a | b' only one is followed, preferring one that is
+    already installed.
+    """
+    from repo_lib.resolver import Resolver, load_lists  # noqa: PLC0415
+
+    lists = load_lists(chroot or "/", arch or dpkg_arch(chroot))
+    return Resolver(lists, installed or ()).resolve(packages)
+
+
+def read_dpkg_status(path: str) -> set[str]:
+    """Return the names of the installed packages listed in a status file.
+
+    The file is read line by line and only the Package and Status fields
+    are looked at. A package counts when it is fully installed and not
+    selected for removal, so 'deinstall', 'purge' and config-files-only
+    entries are left out.
+    """
+    installed = set()
+    name = status = ""
+    with open(path, encoding="utf-8", errors="replace") as fob:
+        for line in fob:
+            if line.startswith("Package:"):
+                name = line[8:].strip()
+            elif line.startswith("Status:"):
+                status = line[7:].strip()
+            elif line == "\n":
+                if name and _status_installed(status):
+                    installed.add(name)
+                name = status = ""
+    if name and _status_installed(status):
+        installed.add(name)
+    return installed
+
+
+def _status_installed(status: str) -> bool:
+    fields = status.split()
+    return (
+        bool(fields)
+        and fields[0] in _KEEP_WANTS
+        and fields[-1] == "installed"
+    )
+
+
 def installed_packages(chroot: str = "") -> set[str]:
-    """Return the names of all packages installed in the environment."""
+    """Return the names of all packages installed in the environment.
+
+    dpkg's status file under chroot (or /) is parsed directly, without
+    running anything in the chroot; dpkg-query is only used when there
+    is no such file.
+    """
+    status_file = join(chroot or "/", DPKG_STATUS)
+    if exists(status_file):
+        return read_dpkg_status(status_file)
     cmd = [
         "/usr/bin/dpkg-query",
         "--showformat=${Package}\\n",
@@ -71,6 +205,38 @@ def installed_packages(chroot: str = "") -> set[str]:
     return {line.strip() for line in output.splitlines() if line.strip()}
 
 
+def deb_filename(name: str, version: str, arch: str) -> str:
+    """Return the file name apt gives the .deb of name/version/arch.
+
+    apt stores an epoch's ':' as '%3a' in archive file names.
+    """
+    return f"{name}_{version.replace(':', '%3a')}_{arch}.deb"
+
+
+def simulate_install(
+    packages: list[str], chroot: str = "",
+) -> set[tuple[str, str, str]]:
+    """Return the (name, version, arch) apt-get would install for packages.
+
+    This is exactly the set 'apt-get install --download-only' fetches,
+    read from the 'Inst' lines of a simulated install.
+    """
+    cmd = [
+        "/usr/bin/apt-get",
+        "install",
+        "--simulate",
+        "-y",
+        *sorted(packages),
+    ]
+    debs = set()
+    for line in _run(cmd, chroot).splitlines():
+        match = _INST_RE.match(line)
+        if match:
+            name = match.group("name").split(":", 1)[0]
+            debs.add((name, match.group("version"), match.group("arch")))
+    return debs
+
+
 def download_packages(packages: list[str], chroot: str = "") -> None:
     """Download packages into the apt cache via apt-get --download-only."""
     cmd = [
@@ -83,52 +249,446 @@ def download_packages(packages: list[str], chroot: str = "") -> None:
     _run(cmd, chroot)
 
 
-def copy_debs_to_pool(pool_component: str, chroot: str = "") -> int:
+class DebUri(NamedTuple):
+    """One package download, as listed by apt-get --print-uris."""
+
+    uri: str
+    filename: str
+    size: int
+    hash_type: str  # hashlib name, e.g. 'sha256'
+    digest: str
+
+
+def parse_print_uris(output: str) -> list[DebUri]:
+    """Parse apt-get --print-uris output into DebUri entries.
+
+    Lines that are not download entries (e.g. notices) are ignored.
+    Entries without a hash, or with a hash type hashlib does not know,
+    raise RepoError: every download is verified.
+    """
+    uris = []
+    for line in output.splitlines():
+        match = _PRINT_URIS_RE.match(line.strip())
+        if not match:
+            continue
+        hash_type, _, digest = (match.group("hash") or "").partition(":")
+        if hash_type not in HASH_TYPES or not digest:
+            raise RepoError(
+                f"no usable hash for {match.group('filename')}:"
+                f" {match.group('hash')!r}",
+            )
+        uris.append(
+            DebUri(
+                match.group("uri"),
+                match.group("filename"),
+                int(match.group("size")),
+                HASH_TYPES[hash_type],
+                digest.lower(),
+            ),
+        )
+    return uris
+
+
+def print_uris(packages: list[str], chroot: str = "") -> list[DebUri]:
+    """Return the download URIs of packages' candidate versions."""
+    cmd = [
+        "/usr/bin/apt-get",
+        "download",
+        "--print-uris",
+        *sorted(packages),
+    ]
+    return parse_print_uris(_run(cmd, chroot))
+
+
+def _file_matches(path: str, deb: DebUri) -> bool:
+    """Return True if path exists with the size and hash deb lists."""
+    try:
+        if os.stat(path).st_size != deb.size:
+            return False
+    except FileNotFoundError:
+        return False
+    digest = hashlib.new(deb.hash_type)
+    with open(path, "rb") as fob:
+        while data := fob.read(FETCH_CHUNK):
+            digest.update(data)
+    return digest.hexdigest() == deb.digest
+
+
+@functools.cache
+def _umask() -> int:
+    """Return the umask; os.umask() can only read it by changing it."""
+    with contextlib.suppress(OSError), open("/proc/self/status") as fob:
+        for line in fob:
+            if line.startswith("Umask:"):
+                return int(line.split()[1], 8)
+    return 0o022
+
+
+def _download(deb: DebUri, tmp: str) -> tuple[int, str]:
+    """Download deb to tmp, retrying; return (size, hex digest)."""
+    for attempt in range(FETCH_RETRIES + 1):
+        digest = hashlib.new(deb.hash_type)
+        size = 0
+        try:
+            with (
+                urllib.request.urlopen(  # noqa: S310 - scheme checked by caller
+                    deb.uri, timeout=FETCH_TIMEOUT,
+                ) as response,
+                open(tmp, "wb") as fob,
+            ):
+                while data := response.read(FETCH_CHUNK):
+                    fob.write(data)
+                    digest.update(data)
+                    size += len(data)
+        # OSError includes urllib.error.URLError; HTTPException covers a
+        # connection dropped mid-body (IncompleteRead and the like)
+        except (OSError, http.client.HTTPException) as e:
+            # 4xx answers will not change on retry; network errors might
+            client_error = (
+                isinstance(e, urllib.error.HTTPError)
+                and e.code < 500  # noqa: PLR2004
+            )
+            if attempt < FETCH_RETRIES and not client_error:
+                logger.warning("Retrying %s: %s", deb.uri, e)
+                continue
+            raise RepoError(f"downloading {deb.uri} failed: {e}") from e
+        break
+    return size, digest.hexdigest()
+
+
+def fetch_deb(deb: DebUri, pool_component: str) -> bool:
+    """Download deb into pool_component, verifying its size and hash.
+
+    A file already in the pool that matches is left alone; one that does
+    not is replaced. The download goes to a temporary file that only
+    replaces the pool file once verified, and is removed on any failure.
+    Returns True if the file was downloaded, False if it was already
+    present.
+    """
+    dst = join(pool_component, deb.filename)
+    if _file_matches(dst, deb):
+        logger.debug("Already in pool: %s", deb.filename)
+        return False
+    scheme = deb.uri.split(":", 1)[0]
+    if scheme not in URI_SCHEMES:
+        raise RepoError(
+            f"unsupported URI scheme '{scheme}' for {deb.filename}",
+        )
+    # a unique name: other runs may be fetching into the same pool
+    fd, tmp = tempfile.mkstemp(
+        prefix=f".{deb.filename}.", suffix=".tmp", dir=dirname(dst),
+    )
+    os.close(fd)
+    try:
+        os.chmod(tmp, 0o666 & ~_umask())
+        size, digest = _download(deb, tmp)
+    except BaseException:
+        rm_files([tmp])
+        raise
+    if size != deb.size or digest != deb.digest:
+        rm_files([tmp])
+        raise RepoError(
+            f"{deb.filename}: {deb.hash_type} or size mismatch (expected"
+            f" {deb.size} bytes, got {size})",
+        )
+    os.replace(tmp, dst)
+    logger.debug("Downloaded: %s", deb.filename)
+    return True
+
+
+def fetch_debs(
+    debs: list[DebUri], pool_component: str, jobs: int = DOWNLOAD_JOBS,
+) -> int:
+    """Fetch debs into pool_component, up to jobs at a time.
+
+    Returns the count of files downloaded (files already present and
+    valid are skipped). The first failure raises RepoError once the
+    downloads in flight have finished.
+    """
+    return sum(
+        parallel_map(
+            lambda deb: fetch_deb(deb, pool_component), debs, max(jobs, 1),
+        ),
+    )
+
+
+def _reflink(src: str, dst: str) -> None:
+    """Clone src to dst sharing its extents (FICLONE), else raise OSError."""
+    with open(src, "rb") as src_fob, open(dst, "wb") as dst_fob:
+        try:
+            fcntl.ioctl(dst_fob.fileno(), FICLONE, src_fob.fileno())
+        except OSError:
+            dst_fob.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _copy_file_range(src: str, dst: str) -> None:
+    """Copy src to dst in the kernel; filesystems may share extents.
+
+    The copy is made under a temporary name and only moved to dst once
+    complete; on any failure nothing is left behind.
+    """
+    tmp = f"{dst}.tmp"
+    try:
+        with open(src, "rb") as src_fob, open(tmp, "wb") as dst_fob:
+            size = os.fstat(src_fob.fileno()).st_size
+            remaining = size
+            while remaining > 0:
+                copied = os.copy_file_range(
+                    src_fob.fileno(), dst_fob.fileno(), remaining,
+                )
+                if not copied:
+                    break
+                remaining -= copied
+            written = os.fstat(dst_fob.fileno()).st_size
+        if written == size:
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+            return
+    except BaseException:
+        rm_files([tmp])
+        raise
+    rm_files([tmp])
+    raise RepoError(
+        f"copying {src} to {dst}: short copy ({written} of {size} bytes)",
+    )
+
+
+def _copy(src: str, dst: str) -> None:
+    """Copy src to dst, with its metadata, via a temporary name.
+
+    A reader never sees a partial dst, and on any failure nothing is
+    left behind.
+    """
+    tmp = f"{dst}.tmp"
+    try:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        rm_files([tmp])
+        raise
+
+
+class PoolLinker:
+    """Place files into the pool by reflink, hard link or copy.
+
+    With mode 'auto' the cheapest method that works is found once per
+    (source, destination) filesystem pair: a reflink (copy-on-write
+    clone, e.g. on btrfs or XFS) gives an independent file that shares
+    its data blocks; a hard link needs no extra space but shares the
+    inode with the apt cache; a copy always works. 'reflink' also
+    accepts an in-kernel copy_file_range() where cloning is refused.
+    """
+
+    def __init__(self, mode: str = "auto") -> None:
+        if mode not in LINK_MODES:
+            raise RepoError(
+                f"unknown link mode '{mode}' (valid options:"
+                f" {', '.join(LINK_MODES)})",
+            )
+        self.mode = mode
+        # (src st_dev, dst st_dev) -> method found to work for 'auto'
+        self.methods: dict[tuple[int, int], str] = {}
+
+    def _try(self, method: str, src: str, dst: str) -> bool:
+        try:
+            if method == "reflink":
+                _reflink(src, dst)
+            elif method == "hardlink":
+                os.link(src, dst)
+            elif method == "copy_file_range":
+                _copy_file_range(src, dst)
+            else:
+                _copy(src, dst)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            logger.debug("%s not possible for %s: %s", method, dst, e)
+            return False
+        return True
+
+    def place(self, src: str, dst: str) -> str:
+        """Place src at dst; return the method used."""
+        if self.mode == "copy":
+            _copy(src, dst)
+            return "copy"
+        if self.mode == "hardlink":
+            try:
+                os.link(src, dst)
+            except OSError as e:
+                raise RepoError(f"hard linking {src} failed: {e}") from e
+            return "hardlink"
+        if self.mode == "reflink":
+            for method in ("reflink", "copy_file_range"):
+                if self._try(method, src, dst):
+                    return method
+            raise RepoError(f"reflink not supported for {dst}")
+
+        key = (
+            os.stat(os.path.dirname(src)).st_dev,
+            os.stat(os.path.dirname(dst)).st_dev,
+        )
+        known = self.methods.get(key)
+        if known and self._try(known, src, dst):
+            return known
+        for method in AUTO_ORDER:
+            if method == known:
+                continue
+            if self._try(method, src, dst):
+                if key not in self.methods:
+                    logger.info("Populating pool by %s", method)
+                self.methods[key] = method
+                return method
+        raise RepoError(f"could not copy {src} to {dst}")
+
+
+def copy_debs_to_pool(
+    pool_component: str,
+    chroot: str = "",
+    link: str = "auto",
+    debs: Iterable[tuple[str, str, str]] | None = None,
+) -> int:
     """Copy .deb files from the apt cache into pool_component.
 
-    Files already present in the pool are skipped. Returns the count of
-    files copied.
+    With debs, an iterable of (name, version, arch), only those packages
+    are copied and each is looked up by its file name (see deb_filename)
+    rather than by listing the cache, so the cost follows the request and
+    not the size of the cache; packages missing from the cache are
+    reported. Without it every .deb in the cache is copied. Files already
+    present in the pool are skipped. link selects how files are placed
+    (see PoolLinker). Returns the count of files copied.
     """
     if chroot:
         cache_dir = join(chroot, "var", "cache", "apt", "archives")
     else:
         cache_dir = APT_CACHE
+    if debs is None:
+        filenames = [
+            filename
+            for filename in os.listdir(cache_dir)
+            if filename.endswith(".deb")
+        ]
+    else:
+        filenames = sorted({deb_filename(*deb) for deb in debs})
+    linker = PoolLinker(link)
     count = 0
-    for filename in os.listdir(cache_dir):
-        if not filename.endswith(".deb"):
-            continue
+    for filename in filenames:
         src = join(cache_dir, filename)
         dst = join(pool_component, filename)
         if exists(dst):
             logger.debug("Already in pool: %s", filename)
             continue
-        shutil.copy2(src, dst)
-        logger.debug("Copied: %s", filename)
+        if debs is not None and not exists(src):
+            logger.warning("Not in apt cache: %s", filename)
+            continue
+        method = linker.place(src, dst)
+        logger.debug("Copied (%s): %s", method, filename)
         count += 1
     return count
 
 
+def resolve_packages(
+    packages: list[str],
+    chroot: str,
+    resolver: str,
+    arch: str,
+    use_cache: bool,
+) -> tuple[set[str], set[str]]:
+    """Return (installed, closure) for packages.
+
+    With use_cache, both sets come from the ResolveCache when the lists
+    and dpkg status under chroot (or /) are unchanged since they were
+    stored.
+    """
+
+    def closure(installed: set[str]) -> set[str]:
+        if resolver == "native":
+            return resolve_deps_native(packages, chroot, arch, installed)
+        return resolve_deps(packages, chroot)
+
+    if not use_cache:
+        installed = installed_packages(chroot)
+        return installed, closure(installed)
+
+    from repo_lib.resolve_cache import (  # noqa: PLC0415
+        ResolveCache,
+        lists_signature,
+        status_signature,
+    )
+
+    cache = ResolveCache()
+    root = os.path.abspath(chroot or "/")
+    status = status_signature(root)
+    installed = cache.get_or_compute(
+        ["installed", root, status],
+        lambda: installed_packages(chroot),
+    )
+    resolved = cache.get_or_compute(
+        [
+            "closure",
+            root,
+            resolver,
+            arch,
+            lists_signature(root),
+            status,
+            *sorted(packages),
+        ],
+        lambda: closure(installed),
+    )
+    return installed, resolved
+
+
 def populate_pool(
     path: str,
     pool: str,
     component: str,
     packages: list[str],
     chroot: str = "",
+    *,
+    engine: str = "apt",
+    jobs: int = DOWNLOAD_JOBS,
+    link: str = "auto",
+    resolver: str = "apt",
+    arch: str = "",
+    use_cache: bool = True,
 ) -> None:
     """Resolve, download, and copy .deb files into pool/component.
 
     Reports totals at each stage. When chroot is given, apt-cache,
     dpkg-query, and apt-get run inside the chroot via turnkey-chroot,
-    and .deb files are copied from the chroot's apt cache.
+    and .deb files are copied from the chroot's apt cache. With the
+    'direct' engine the .debs are instead fetched straight into the pool
+    from the URIs apt-get prints, jobs at a time. link selects how the
+    'apt' engine places cached .debs into the pool (see PoolLinker).
+    With the 'native' resolver the closure is computed in-process from
+    apt's Packages lists for arch (default: the environment's dpkg
+    architecture) rather than by apt-cache. With use_cache set, closures
+    and the installed-package set are kept in a ResolveCache keyed on the
+    state of the environment's apt lists and dpkg status, so repeated
+    runs against an unchanged environment skip resolution entirely.
     """
+    if engine not in ENGINES:
+        raise RepoError(
+            f"unknown download engine '{engine}' (valid options:"
+            f" {', '.join(ENGINES)})",
+        )
+    if resolver not in RESOLVERS:
+        raise RepoError(
+            f"unknown resolver '{resolver}' (valid options:"
+            f" {', '.join(RESOLVERS)})",
+        )
     pool_component = join(path, pool, component)
     os.makedirs(pool_component, exist_ok=True)
 
     print(f"Resolving dependencies for: {', '.join(packages)}")
-    resolved = resolve_deps(packages, chroot)
+    with instrument.measure("resolve", resolver):
+        installed, resolved = resolve_packages(
+            packages, chroot, resolver, arch, use_cache,
+        )
     print(f"Total packages in dependency closure: {len(resolved)}")
 
-    installed = installed_packages(chroot)
     to_download = sorted(resolved - installed)
     already_installed = len(resolved) - len(to_download)
     print(
@@ -141,7 +701,132 @@ def populate_pool(
         return
 
     logger.info("Downloading: %s", ", ".join(to_download))
-    download_packages(to_download, chroot)
+    if engine == "direct":
+        with instrument.measure("print-uris"):
+            uris = print_uris(to_download, chroot)
+        with instrument.measure("fetch", f"{len(uris)} file(s)"):
+            count = fetch_debs(uris, pool_component, jobs)
+        print(f"Downloaded {count} .deb file(s) to pool.")
+        return
+    with instrument.measure("simulate"):
+        debs = simulate_install(to_download, chroot)
+    with instrument.measure("apt-get download"):
+        download_packages(to_download, chroot)
 
-    count = copy_debs_to_pool(pool_component, chroot)
+    with instrument.measure("copy", link):
+        count = copy_debs_to_pool(pool_component, chroot, link, debs)
     print(f"Copied {count} .deb file(s) to pool.")
+
+
+class Coverage(NamedTuple):
+    """What one target environment of a batch download needed."""
+
+    closure: int  # packages in its dependency closure
+    installed: int  # of those, already installed in it
+    debs: int  # .debs it needs from the pool
+    shared: int  # of those, also needed by another target
+    in_pool: int  # of those, present in the pool afterwards
+
+
+def load_manifest(manifest: str) -> dict[str, list[str]]:
+    """Read a batch manifest: a JSON object of chroot -> package names."""
+    try:
+        with open(manifest) as fob:
+            data = json.load(fob)
+    except (OSError, ValueError) as e:
+        raise RepoError(f"can not read manifest {manifest}: {e}") from e
+    if not isinstance(data, dict) or not all(
+        isinstance(packages, list)
+        and all(isinstance(name, str) for name in packages)
+        for packages in data.values()
+    ):
+        raise RepoError(
+            f"manifest {manifest} must map chroot paths to lists of package"
+            " names",
+        )
+    return data
+
+
+def populate_pool_batch(
+    path: str,
+    pool: str,
+    component: str,
+    targets: dict[str, list[str]],
+    *,
+    jobs: int = DOWNLOAD_JOBS,
+    resolver: str = "apt",
+    arch: str = "",
+    use_cache: bool = True,
+) -> dict[str, Coverage]:
+    """Populate pool/component for many target environments at once.
+
+    targets maps chroot paths ('' for the host) to the packages wanted
+    in each. Every target's closure is resolved on its own, as in
+    populate_pool, and its downloads are listed with apt-get
+    --print-uris; the lists are then merged, so a .deb (one package
+    version for one architecture) that several targets need is fetched
+    once, straight into the pool, jobs at a time. Returns each target's
+    Coverage, which is also printed.
+    """
+    if resolver not in RESOLVERS:
+        raise RepoError(
+            f"unknown resolver '{resolver}' (valid options:"
+            f" {', '.join(RESOLVERS)})",
+        )
+    pool_component = join(path, pool, component)
+    os.makedirs(pool_component, exist_ok=True)
+
+    wanted: dict[str, DebUri] = {}
+    users: Counter[str] = Counter()
+    needs: dict[str, tuple[int, int, list[str]]] = {}
+    for chroot, packages in targets.items():
+        print(
+            f"Resolving dependencies for {chroot or '/'}:"
+            f" {', '.join(packages)}",
+        )
+        with instrument.measure("resolve", chroot or "/"):
+            installed, resolved = resolve_packages(
+                packages, chroot, resolver, arch, use_cache,
+            )
+        to_download = sorted(resolved - installed)
+        with instrument.measure("print-uris", chroot or "/"):
+            debs = print_uris(to_download, chroot) if to_download else []
+        for deb in debs:
+            known = wanted.setdefault(deb.filename, deb)
+            if known.digest != deb.digest:
+                logger.warning(
+                    "%s: differs between targets, using the first one",
+                    deb.filename,
+                )
+        users.update({deb.filename for deb in debs})
+        needs[chroot] = (
+            len(resolved),
+            len(resolved) - len(to_download),
+            [deb.filename for deb in debs],
+        )
+
+    total = sum(len(filenames) for _, _, filenames in needs.values())
+    print(
+        f"Unique .debs: {len(wanted)} (of {total} needed across"
+        f" {len(targets)} target(s))",
+    )
+    with instrument.measure("fetch", f"{len(wanted)} file(s)"):
+        count = fetch_debs(list(wanted.values()), pool_component, jobs)
+    print(f"Downloaded {count} .deb file(s) to pool.")
+
+    coverage = {}
+    for chroot, (closure, installed_count, filenames) in needs.items():
+        coverage[chroot] = Coverage(
+            closure,
+            installed_count,
+            len(filenames),
+            sum(users[filename] > 1 for filename in filenames),
+            sum(exists(join(pool_component, name)) for name in filenames),
+        )
+        item = coverage[chroot]
+        print(
+            f"{chroot or '/'}: {item.in_pool}/{item.debs} .debs in pool"
+            f" ({item.shared} shared, {item.installed} of {item.closure}"
+            " already installed)",
+        )
+    return coverage
@@ -1,48 +1,127 @@
 """GPG key generation and export for repository release signing."""
 from __future__ import annotations
 
+import contextlib
+import fcntl
 import logging
 import os
 import shutil
-import subprocess
 import tempfile
-from os.path import basename, join
+import time
+from os.path import basename, isdir, join
 from typing import TYPE_CHECKING
 
-from repo_lib import RepoError
+from repo_lib import KEY_ALGO, RepoError, generate_releases, run_cmd
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from repo_lib import Repository
 
 logger = logging.getLogger(__name__)
 
+CACHED_KEY_UID = "Repo Signing Key <repo@cache>"
+
 
 def _gpg(args: list[str], gnupghome: str) -> str:
     """Run a gpg command in gnupghome; raise RepoError on failure."""
-    cmd = ["/usr/bin/gpg", "--homedir", gnupghome, *args]
-    logger.debug("Running: %s", " ".join(cmd))
-    result = subprocess.run(
-        cmd, capture_output=True, text=True, check=False,
+    return run_cmd(["/usr/bin/gpg", "--homedir", gnupghome, *args])
+
+
+def _dash_escape(text: str) -> str:
+    """Dash-escape text for a cleartext signed message (RFC 4880 7.1)."""
+    return "".join(
+        f"- {line}" if line.startswith("-") else line
+        for line in text.splitlines(keepends=True)
     )
-    if result.returncode != 0:
-        raise RepoError(result.stderr)
-    return result.stdout
+
+
+class SigningSession:
+    """Sign Release files with one key, one gpg run per Release.
+
+    The detached signature is made in text mode with a fixed digest, so
+    the same signature is also valid for the cleartext signed (dash-
+    escaped) Release: InRelease is built from it rather than by a second,
+    --clearsign run. A session may sign any number of Releases; the
+    gpg-agent started by the first signature serves them all, so the key
+    is only loaded (and any passphrase asked for) once.
+    """
+
+    DIGEST = "SHA512"
+
+    def __init__(self, gpgkey: str, gnupghome: str = "") -> None:
+        self.gpgkey = gpgkey
+        self.env = (
+            {**os.environ, "GNUPGHOME": gnupghome} if gnupghome else None
+        )
+        self._cmd = [
+            "/usr/bin/gpg",
+            "--armor",
+            "--digest-algo",
+            self.DIGEST,
+            "--local-user",
+            gpgkey,
+        ]
+
+    def sign(self, release: str, text: str) -> None:
+        """Write Release.gpg and InRelease next to release (text)."""
+        dist_dir = os.path.dirname(release)
+        signature = run_cmd(
+            [
+                *self._cmd,
+                "--textmode",
+                "--detach-sign",
+                "--output",
+                "-",
+                release,
+            ],
+            env=self.env,
+        )
+        with open(join(dist_dir, "Release.gpg"), "w") as fob:
+            fob.write(signature)
+        inrelease = join(dist_dir, "InRelease")
+        if any(line != line.rstrip(" \t") for line in text.splitlines()):
+            # a cleartext signature ignores trailing whitespace, a text
+            # mode one does not: only a real --clearsign will do
+            run_cmd(
+                [*self._cmd, "--clearsign", "--output", inrelease, release],
+                env=self.env,
+            )
+            return
+        # the line break before the armor is not part of the signed text:
+        # after Release's final newline that leaves an empty line
+        with open(inrelease, "w") as fob:
+            fob.writelines(
+                [
+                    "-----BEGIN PGP SIGNED MESSAGE-----\n",
+                    f"Hash: {self.DIGEST}\n",
+                    "\n",
+                    _dash_escape(text),
+                    "\n",
+                    signature,
+                ],
+            )
 
 
 def gen_repo_key(
     repo_path: str,
     expiry: str = "10y",
+    algo: str = KEY_ALGO,
+    *,
+    uid: str = "",
+    parent: str = "",
 ) -> tuple[str, str]:
-    """Generate a 4096-bit RSA signing key in a fresh temporary GPG homedir.
+    """Generate an algo (see KEY_ALGOS) signing key in a fresh GPG homedir.
 
+    The homedir is made in parent (default: the system temp directory).
     Returns (gnupghome, uid). The caller must pass gnupghome to cleanup_key
     after signing is complete so the private key is not retained on disk.
     """
-    gnupghome = tempfile.mkdtemp()
+    gnupghome = tempfile.mkdtemp(dir=parent or None)
     os.chmod(gnupghome, 0o700)
-    uid = f"Repo Signing Key <repo@{basename(repo_path.rstrip('/'))}>"
+    uid = uid or f"Repo Signing Key <repo@{basename(repo_path.rstrip('/'))}>"
     logger.debug(
-        "Generating rsa4096 key (expiry=%s) in: %s", expiry, gnupghome,
+        "Generating %s key (expiry=%s) in: %s", algo, expiry, gnupghome,
     )
     _gpg(
         [
@@ -53,7 +132,7 @@ def gen_repo_key(
             "",
             "--quick-generate-key",
             uid,
-            "rsa4096",
+            algo,
             "sign",
             expiry,
         ],
@@ -63,10 +142,10 @@ def gen_repo_key(
 
 
 def export_public_key(gnupghome: str, uid: str, dest: str) -> None:
-    """Export the public key as an ASCII-armored file at dest."""
+    """Export the public key as an ASCII-armored file at dest (replaced)."""
     logger.debug("Exporting public key to: %s", dest)
     _gpg(
-        ["--armor", "--export", "--output", dest, uid],
+        ["--yes", "--armor", "--export", "--output", dest, uid],
         gnupghome,
     )
 
@@ -77,16 +156,127 @@ def cleanup_key(gnupghome: str) -> None:
     logger.debug("Deleted temporary GPG homedir: %s", gnupghome)
 
 
-def gen_and_sign(repo: Repository, expiry: str = "10y") -> None:
+def default_key_cache_dir() -> str:
+    """Return the directory cached_key() keeps keys in.
+
+    $XDG_RUNTIME_DIR/repo/keys, a per-user tmpfs gone at logout, so that
+    private keys never persist on disk; '' if XDG_RUNTIME_DIR is not set.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    return join(runtime_dir, "repo", "keys") if runtime_dir else ""
+
+
+def _private_dir(path: str) -> None:
+    """Create path if need be; make sure only this user can access it."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid():
+        raise RepoError(f"key cache '{path}' is not owned by this user")
+    if stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def _key_expired(gnupghome: str) -> bool:
+    try:
+        with open(join(gnupghome, "expires")) as fob:
+            return float(fob.read()) <= time.time()
+    except (FileNotFoundError, ValueError):
+        return True  # left half made
+
+
+@contextlib.contextmanager
+def cached_key(
+    ttl: float,
+    expiry: str = "10y",
+    algo: str = KEY_ALGO,
+    cache_dir: str = "",
+) -> Iterator[tuple[str, str]]:
+    """Yield (gnupghome, uid) of an ephemeral key reused for ttl seconds.
+
+    One key is cached per algo and expiry, in a 0700 directory (see
+    default_key_cache_dir). Each key expires ttl seconds after it was
+    generated, as set by the call that generated it; expired keys, of
+    any algo, are deleted (as cleanup_key() would) and a new one is
+    generated in place of the one wanted. The cache is locked while the
+    key is in use, so no other process deletes it meanwhile.
+    """
+    cache_dir = cache_dir or default_key_cache_dir()
+    if not cache_dir:
+        raise RepoError("no key cache directory: XDG_RUNTIME_DIR is not set")
+    _private_dir(cache_dir)
+    with open(join(cache_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for name in os.listdir(cache_dir):
+            gnupghome = join(cache_dir, name)
+            if isdir(gnupghome) and _key_expired(gnupghome):
+                cleanup_key(gnupghome)
+        gnupghome = join(cache_dir, f"{algo}-{expiry}")
+        if isdir(gnupghome):
+            with open(join(gnupghome, "uid")) as fob:
+                uid = fob.read()
+            logger.debug("Reusing cached %s key: %s", algo, gnupghome)
+        else:
+            new_home, uid = gen_repo_key(
+                "", expiry, algo, uid=CACHED_KEY_UID, parent=cache_dir,
+            )
+            try:
+                # the agent knows the key by its homedir, which is renamed
+                run_cmd(
+                    [
+                        "/usr/bin/gpgconf",
+                        "--homedir",
+                        new_home,
+                        "--kill",
+                        "gpg-agent",
+                    ],
+                )
+                with open(join(new_home, "uid"), "w") as fob:
+                    fob.write(uid)
+                # written last: proof that the key is complete
+                with open(join(new_home, "expires"), "w") as fob:
+                    fob.write(str(time.time() + ttl))
+                os.rename(new_home, gnupghome)
+            except BaseException:
+                cleanup_key(new_home)
+                raise
+        yield gnupghome, uid
+
+
+def _sign_and_export(
+    repos: list[Repository], gnupghome: str, uid: str,
+) -> None:
+    generate_releases(repos, uid, gnupghome)
+    for path in dict.fromkeys(repo.path for repo in repos):
+        export_public_key(gnupghome, uid, join(path, "repo.asc"))
+
+
+def gen_and_sign(
+    repo: Repository | list[Repository],
+    expiry: str = "10y",
+    algo: str = KEY_ALGO,
+    *,
+    key_ttl: float = 0,
+) -> None:
     """Generate a temporary key, sign the release, export repo.asc, clean up.
 
+    Given a list of repositories (suites), they are all signed with the
+    one key, concurrently; see generate_releases().
+
     The private key is always deleted before this function returns, even if
-    signing or export fails.
+    signing or export fails. With key_ttl, a cached key is used instead,
+    deleted key_ttl seconds after it was generated (see cached_key); if
+    there is no key cache directory, the key is not cached.
     """
-    gnupghome, uid = gen_repo_key(repo.path, expiry)
+    repos = repo if isinstance(repo, list) else [repo]
+    if key_ttl > 0 and default_key_cache_dir():
+        with cached_key(key_ttl, expiry, algo) as (gnupghome, uid):
+            _sign_and_export(repos, gnupghome, uid)
+        return
+    if key_ttl > 0:
+        logger.warning("XDG_RUNTIME_DIR is not set, not caching the key")
+    gnupghome, uid = gen_repo_key(repos[0].path, expiry, algo)
     try:
-        repo.generate_release(uid, gnupghome)
-        export_public_key(gnupghome, uid, join(repo.path, "repo.asc"))
+        _sign_and_export(repos, gnupghome, uid)
     finally:
         # Always remove the private key even if signing or export fails.
         cleanup_key(gnupghome)
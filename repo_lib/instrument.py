@@ -0,0 +1,182 @@
+"""Opt-in timing and resource accounting of repo's hot paths.
+
+Stages are measured with measure(); nothing is recorded (and next to
+nothing is done) until enable() is called. Each finished stage records
+its wall time, CPU time (this process plus the children it waited
+for), bytes read from and written to storage, and the peak RSS of the
+child processes reaped by wait_child() during the stage. report()
+returns the records as JSON.
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import subprocess
+    from collections.abc import Iterator
+
+_state = {"enabled": False}
+_lock = threading.Lock()
+_records: list[dict[str, object]] = []
+# the stages open in each thread, innermost last
+_local = threading.local()
+
+
+def enable() -> None:
+    """Start recording stages."""
+    _state["enabled"] = True
+
+
+def enabled() -> bool:
+    return _state["enabled"]
+
+
+def reset() -> None:
+    """Stop recording stages and forget those recorded."""
+    _state["enabled"] = False
+    with _lock:
+        _records.clear()
+
+
+def _proc_io() -> tuple[int, int]:
+    """Return the bytes this process read from and wrote to storage.
+
+    Storage, not rchar/wchar: those also count pipes, so a command's
+    output read by us would be counted on top of the child's own reads
+    (its ru_inblock, see Stage.add_child()).
+    """
+    try:
+        with open("/proc/self/io") as fob:
+            fields = dict(line.split(":", 1) for line in fob)
+    except OSError:
+        return 0, 0
+    return int(fields.get("read_bytes", 0)), int(fields.get("write_bytes", 0))
+
+
+class Stage:
+    """One measured stage; read_bytes/write_bytes may be added to."""
+
+    def __init__(self, name: str, detail: str, *, thread: bool) -> None:
+        self.name = name
+        self.detail = detail
+        # thread: CPU of the calling thread only, and no process-wide I/O
+        # counters, for stages that run alongside others (e.g. codecs)
+        self.thread = thread
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.children = 0
+        self.child_max_rss_kb = 0
+        self.child_cpu = 0.0
+
+    def add_child(self, rusage: resource.struct_rusage) -> None:
+        self.children += 1
+        self.child_max_rss_kb = max(self.child_max_rss_kb, rusage.ru_maxrss)
+        self.child_cpu += rusage.ru_utime + rusage.ru_stime
+        self.read_bytes += rusage.ru_inblock * 512
+        self.write_bytes += rusage.ru_oublock * 512
+
+
+_NULL_STAGE = Stage("", "", thread=True)
+
+
+@contextlib.contextmanager
+def measure(
+    name: str, detail: str = "", *, thread: bool = False,
+) -> Iterator[Stage]:
+    """Record the resources used by the body as stage name (detail)."""
+    if not _state["enabled"]:
+        yield _NULL_STAGE
+        return
+    stage = Stage(name, detail, thread=thread)
+    stack = _local.__dict__.setdefault("stages", [])
+    depth = len(stack)
+    stack.append(stage)
+    cpu_clock = time.thread_time if thread else time.process_time
+    io_start = (0, 0) if thread else _proc_io()
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_start = cpu_clock()
+    wall_start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = cpu_clock() - cpu_start
+        io_end = (0, 0) if thread else _proc_io()
+        if not thread:
+            # every child reaped meanwhile, also those run without
+            # wait_child() (e.g. by subprocess.run)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            reaped_cpu = (
+                children.ru_utime
+                + children.ru_stime
+                - children_start.ru_utime
+                - children_start.ru_stime
+            )
+            # add what wait_child() has not already credited
+            stage.child_cpu += max(reaped_cpu - stage.child_cpu, 0.0)
+            # a new high-water mark can only come from such a child
+            if children.ru_maxrss > children_start.ru_maxrss:
+                stage.child_max_rss_kb = max(
+                    stage.child_max_rss_kb, children.ru_maxrss,
+                )
+        # not pop(): a generator body (e.g. a command's streamed output)
+        # may be finished after stages opened later in the same thread
+        stack.remove(stage)
+        record: dict[str, object] = {
+            "stage": name,
+            "detail": detail,
+            "depth": depth,
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu + stage.child_cpu, 6),
+            "read_bytes": stage.read_bytes + io_end[0] - io_start[0],
+            "write_bytes": stage.write_bytes + io_end[1] - io_start[1],
+            "children": stage.children,
+            "child_max_rss_kb": stage.child_max_rss_kb,
+        }
+        with _lock:
+            _records.append(record)
+
+
+def wait_child(proc: subprocess.Popen[str]) -> int:
+    """Wait for proc like proc.wait(), crediting its usage to the stages.
+
+    The child's rusage (from wait4) is added to every stage open in the
+    calling thread. Returns the exit code, which is also set on proc.
+    A child already reaped elsewhere is waited for with proc.wait(),
+    and its usage is not credited.
+    """
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    for stage in getattr(_local, "stages", []):
+        stage.add_child(rusage)
+    return proc.returncode
+
+
+def records() -> list[dict[str, object]]:
+    """Return the finished stages, in the order they finished."""
+    with _lock:
+        return list(_records)
+
+
+def report() -> str:
+    """Return the recorded stages, with per-stage totals, as JSON."""
+    stages = records()
+    totals: dict[str, dict[str, float]] = {}
+    for record in stages:
+        total = totals.setdefault(
+            str(record["stage"]),
+            {"count": 0, "wall_s": 0.0, "cpu_s": 0.0},
+        )
+        total["count"] += 1
+        for key in ("wall_s", "cpu_s"):
+            total[key] = round(total[key] + float(record[key]), 6)  # type: ignore[arg-type]
+    return json.dumps({"stages": stages, "totals": totals}, indent=2)
@@ -0,0 +1,178 @@
+"""Sidecar record of index file digests, used to build Release files."""
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+from os.path import dirname, join, relpath
+from typing import Any
+
+from repo_lib.compress import DIGESTS, HashedWriter
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# Release file section for each digest, in the order they are written
+RELEASE_FIELDS = {
+    "md5": "MD5Sum",
+    "sha1": "SHA1",
+    "sha256": "SHA256",
+    "sha512": "SHA512",
+}
+
+# files apt-ftparchive lists in a Release file by default
+RELEASE_PATTERNS = (
+    "Packages",
+    "Packages.*",
+    "Sources",
+    "Sources.*",
+    "Release",
+    "Contents-*",
+    "Translation-*",
+    "Index",
+    "Index.*",
+    "icons-*.tar",
+    "icons-*.tar.*",
+    "Components-*.yml",
+    "Components-*.yml.*",
+    "md5sum.txt",
+)
+
+# files generated by 'repo release' itself, never listed in it
+TOP_LEVEL_EXCLUDES = ("Release", "Release.gpg", "InRelease")
+
+
+def release_files(dist_dir: str) -> list[str]:
+    """Return the files under dist_dir to list in its Release, sorted.
+
+    Paths are relative to dist_dir. by-hash trees and the suite's own
+    Release, Release.gpg and InRelease are skipped.
+    """
+    found = []
+    for root, dirs, files in os.walk(dist_dir):
+        dirs[:] = [name for name in dirs if name != "by-hash"]
+        for name in files:
+            path = relpath(join(root, name), dist_dir)
+            # skip our own in-progress (.tmp) and PDiff (.old) files too
+            if path in TOP_LEVEL_EXCLUDES or name.endswith((".tmp", ".old")):
+                continue
+            if any(fnmatch.fnmatchcase(name, pat) for pat in RELEASE_PATTERNS):
+                found.append(path)
+    return sorted(found)
+
+
+def _hash_file(path: str) -> dict[str, str]:
+    hashes = {algo: hashlib.new(algo) for algo in DIGESTS}
+    with open(path, "rb") as fob:
+        while data := fob.read(1024 * 1024):
+            for digest in hashes.values():
+                digest.update(data)
+    return {algo: digest.hexdigest() for algo, digest in hashes.items()}
+
+
+class Manifest:
+    """Size, mtime and digests of the index files of one dists/<release>.
+
+    Repository.index() records every file it writes; generate_release()
+    reads the digests back instead of hashing the files again. An entry
+    is only trusted while the file's size and mtime still match, so files
+    changed behind our back are simply hashed afresh. settings holds the
+    options the indexes were last written with (see
+    Repository.index_settings()), so they can be rebuilt alike.
+    """
+
+    def __init__(self, manifest_file: str, dist_dir: str) -> None:
+        self.manifest_file = manifest_file
+        self.dist_dir = dist_dir
+        self.entries: dict[str, list[int | str]] = {}
+        self.settings: dict[str, Any] = {}
+        self.dirty = False
+        try:
+            with open(manifest_file) as fob:
+                data = json.load(fob)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Ignoring unreadable manifest %s: %s", manifest_file, e,
+            )
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.entries = data.get("entries", {})
+            self.settings = data.get("settings", {})
+
+    def _set(self, path: str, digests: dict[str, str]) -> int:
+        stat = os.stat(join(self.dist_dir, path))
+        self.entries[path] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            *(digests[algo] for algo in DIGESTS),
+        ]
+        self.dirty = True
+        return stat.st_size
+
+    def set_settings(self, settings: dict[str, Any]) -> None:
+        if settings != self.settings:
+            self.settings = settings
+            self.dirty = True
+
+    def record(self, output: HashedWriter) -> None:
+        """Record a file that was just written (and committed)."""
+        self._set(relpath(output.path, self.dist_dir), output.hexdigests())
+
+    def digests(self, path: str) -> tuple[int, dict[str, str]]:
+        """Return (size, digests) for path (relative to dist_dir).
+
+        Recorded digests are used when the file's size and mtime match the
+        record; otherwise the file is hashed and the record updated.
+        """
+        stat = os.stat(join(self.dist_dir, path))
+        entry = self.entries.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return stat.st_size, {
+                algo: str(digest)
+                for algo, digest in zip(DIGESTS, entry[2:], strict=True)
+            }
+        logger.debug("Hashing (not in manifest or changed): %s", path)
+        digests = _hash_file(join(self.dist_dir, path))
+        return self._set(path, digests), digests
+
+    def release_hashes(self) -> str:
+        """Return the MD5Sum/SHA1/SHA256/SHA512 sections of a Release file.
+
+        Entries for files that no longer exist are dropped.
+        """
+        files = release_files(self.dist_dir)
+        for path in set(self.entries) - set(files):
+            del self.entries[path]
+            self.dirty = True
+        info = {path: self.digests(path) for path in files}
+        lines = []
+        for algo, field in RELEASE_FIELDS.items():
+            lines.append(f"{field}:")
+            lines.extend(
+                f" {digests[algo]} {size:>16} {path}"
+                for path, (size, digests) in info.items()
+            )
+        return "\n".join(lines)
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        os.makedirs(dirname(self.manifest_file), exist_ok=True)
+        tmp_file = f"{self.manifest_file}.tmp"
+        logger.debug("Writing: %s", self.manifest_file)
+        with open(tmp_file, "w") as fob:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "entries": self.entries,
+                    "settings": self.settings,
+                },
+                fob,
+            )
+        os.replace(tmp_file, self.manifest_file)
+        self.dirty = False
@@ -0,0 +1,192 @@
+"""Packages index helpers: pool walking and the per-.deb stanza cache."""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import dirname, join
+from typing import TYPE_CHECKING, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+_FILENAME_RE = re.compile(r"^Filename: (.*)$", re.MULTILINE)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def parallel_map(  # noqa: UP047
+    func: Callable[[T], R], items: Iterable[T], jobs: int,
+) -> Iterator[R]:
+    """Like map(), but run func over up to jobs items at a time.
+
+    Results are yielded in input order. Only a small window of results
+    is ever pending, so memory use does not grow with the number of
+    items. hashlib, zlib, lzma and file reads all release the GIL, so
+    threads give real parallelism for .deb reading and hashing.
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending: deque[Future[R]] = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def walk_debs(
+    repo_path: str, component_dir: str,
+) -> Iterator[tuple[str, os.stat_result]]:
+    """Yield (filename, stat) for each .deb under component_dir.
+
+    filename is relative to repo_path, exactly as apt-ftparchive prints it
+    in the Filename field. Entries come in readdir order (subdirectories
+    are descended into as soon as they are met), which is filesystem
+    dependent: callers that write a Packages file sort them by filename,
+    as apt-ftparchive does.
+    """
+    top = join(repo_path, component_dir)
+    stack = [os.scandir(top)]
+    prefixes = [component_dir]
+    try:
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop().close()
+                prefixes.pop()
+                continue
+            filename = join(prefixes[-1], entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(os.scandir(entry.path))
+                prefixes.append(filename)
+            elif entry.name.endswith(".deb") and entry.is_file():
+                yield filename, entry.stat()
+    finally:
+        for iterator in stack:
+            iterator.close()
+
+
+def arch_matches(filename: str, arch: str) -> bool:
+    """Return True if filename would be accepted by apt-ftparchive --arch."""
+    if not arch:
+        return True
+    return filename.endswith((f"_{arch}.deb", "_all.deb"))
+
+
+def deb_archs(filenames: Iterable[str]) -> list[str]:
+    """Return the architectures to index for the .debs in filenames.
+
+    Architecture: all packages are listed in every binary-<arch> index,
+    so 'all' is only returned on its own, when no .deb names a real
+    architecture.
+    """
+    archs = {
+        filename.removesuffix(".deb").rsplit("_", 1)[-1]
+        for filename in filenames
+    }
+    return sorted(archs - {"all"}) or sorted(archs)
+
+
+def iter_stanzas(chunks: Iterable[str]) -> Iterator[str]:
+    """Split apt-ftparchive packages output into per-file stanzas.
+
+    The output arrives as a stream of chunks of any size; only the stanza
+    currently being assembled is held in memory. Each stanza keeps its
+    trailing blank line, so joining the results gives back the original
+    text.
+    """
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        *complete, pending = pending.split("\n\n")
+        for stanza in complete:
+            if stanza.strip():
+                yield f"{stanza}\n\n"
+    if pending.strip():
+        yield f"{pending}\n\n"
+
+
+def stanza_filename(stanza: str) -> str:
+    """Return the Filename field of a Packages stanza."""
+    match = _FILENAME_RE.search(stanza)
+    return match.group(1) if match else ""
+
+
+class PackagesCache:
+    """Packages stanzas for pool .deb files, persisted as JSON.
+
+    Entries are keyed on the pool-relative filename and are only valid
+    while the file's size, mtime and inode are unchanged; any other
+    change means the .deb has to be read again.
+    """
+
+    def __init__(self, cache_file: str) -> None:
+        self.cache_file = cache_file
+        self.entries: dict[str, list[int | str]] = {}
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def _stat_key(stat: os.stat_result) -> list[int]:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file) as fob:
+                data = json.load(fob)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Ignoring unreadable cache %s: %s", self.cache_file, e,
+            )
+            return
+        if data.get("version") != CACHE_VERSION:
+            logger.debug("Ignoring cache with old format: %s", self.cache_file)
+            return
+        self.entries = data.get("entries", {})
+
+    def get(self, filename: str, stat: os.stat_result) -> str | None:
+        """Return the cached stanza for filename, or None if stale/missing."""
+        entry = self.entries.get(filename)
+        if entry is None or entry[:3] != self._stat_key(stat):
+            return None
+        return str(entry[3])
+
+    def put(self, filename: str, stat: os.stat_result, stanza: str) -> None:
+        entry: list[int | str] = [*self._stat_key(stat), stanza]
+        if self.entries.get(filename) != entry:
+            self.entries[filename] = entry
+            self.dirty = True
+
+    def prune(self, keep: Iterable[str]) -> None:
+        """Drop entries for files that are no longer in the pool."""
+        keep = set(keep)
+        for filename in set(self.entries) - keep:
+            del self.entries[filename]
+            self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        os.makedirs(dirname(self.cache_file), exist_ok=True)
+        tmp_file = f"{self.cache_file}.tmp"
+        logger.debug("Writing: %s", self.cache_file)
+        with open(tmp_file, "w") as fob:
+            json.dump(
+                {"version": CACHE_VERSION, "entries": self.entries}, fob,
+            )
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
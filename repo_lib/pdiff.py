@@ -0,0 +1,164 @@
+"""Packages.diff/Index and ed-style patch generation (PDiffs)."""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+from datetime import UTC, datetime
+from os.path import basename, exists, join
+
+from repo_lib import RepoError, rm_files
+from repo_lib.compress import HashedWriter
+
+logger = logging.getLogger(__name__)
+
+# Index sections, each listing one (sha256, size) entry per patch: the
+# Packages file the patch applies to, the patch and the gzipped patch
+HISTORY = "SHA256-History"
+PATCHES = "SHA256-Patches"
+DOWNLOAD = "SHA256-Download"
+
+Entry = tuple[str, int]  # (sha256, size)
+
+
+def _sha256_file(path: str) -> Entry:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as fob:
+        while data := fob.read(1024 * 1024):
+            digest.update(data)
+            size += len(data)
+    return digest.hexdigest(), size
+
+
+def read_index(path: str) -> tuple[Entry | None, dict[str, dict[str, Entry]]]:
+    """Parse a Packages.diff/Index file.
+
+    Returns (current, sections) where current is the (sha256, size) of the
+    Packages file the Index describes and sections maps each of the
+    History, Patches and Download fields to {patch name: (sha256, size)},
+    oldest patch first. A missing Index gives (None, empty sections).
+    """
+    current: Entry | None = None
+    sections: dict[str, dict[str, Entry]] = {
+        HISTORY: {},
+        PATCHES: {},
+        DOWNLOAD: {},
+    }
+    if not exists(path):
+        return current, sections
+    section: dict[str, Entry] | None = None
+    with open(path) as fob:
+        for line in fob:
+            if line[:1].isspace() and section is not None:
+                digest, size, name = line.split()
+                section[name.removesuffix(".gz")] = (digest, int(size))
+                continue
+            field, _, value = line.partition(":")
+            section = sections.get(field)
+            if field == "SHA256-Current":
+                digest, size = value.split()
+                current = (digest, int(size))
+    return current, sections
+
+
+def write_index(
+    path: str, current: Entry, sections: dict[str, dict[str, Entry]],
+) -> HashedWriter:
+    """Write a Packages.diff/Index file; return its committed writer."""
+    lines = [f"SHA256-Current: {current[0]} {current[1]:>7}\n"]
+    for field, entries in sections.items():
+        lines.append(f"{field}:\n")
+        suffix = ".gz" if field == DOWNLOAD else ""
+        lines.extend(
+            f" {digest} {size:>7} {name}{suffix}\n"
+            for name, (digest, size) in entries.items()
+        )
+    with HashedWriter(path) as output:
+        output.write("".join(lines).encode())
+    return output
+
+
+def ed_diff(old: str, new: str) -> bytes:
+    """Return an ed script (diff --ed) turning file old into file new."""
+    cmd = ["/usr/bin/diff", "--ed", old, new]
+    logger.debug("Running command: %s", " ".join(cmd))
+    result = subprocess.run(cmd, capture_output=True, check=False)
+    # diff exits 1 when the files differ, 2 on trouble
+    if result.returncode not in (0, 1):
+        raise RepoError(result.stderr.decode(errors="replace"))
+    return result.stdout
+
+
+def update_pdiffs(
+    packages: HashedWriter, old_file: str, keep: int,
+) -> HashedWriter | None:
+    """Add a patch from old_file to packages.path in Packages.diff/.
+
+    packages is the committed writer of the new Packages file and old_file
+    the previous generation of it (which need not exist). The newest keep
+    patches are listed in Packages.diff/Index and older ones are removed.
+    If the Index does not describe old_file (the Packages file was
+    regenerated without PDiffs in between) the history can no longer be
+    chained and is started again. With keep set to 0 the Packages.diff
+    directory is removed. Returns the writer of the new Index, or None
+    when PDiffs are disabled.
+    """
+    packages_file = packages.path
+    diff_dir = f"{packages_file}.diff"
+    if keep <= 0:
+        if exists(diff_dir):
+            logger.debug("Removing: %s", diff_dir)
+            shutil.rmtree(diff_dir)
+        return None
+    os.makedirs(diff_dir, exist_ok=True)
+    index_file = join(diff_dir, "Index")
+    current, sections = read_index(index_file)
+    new = (packages.sha256.hexdigest(), packages.size)
+
+    old = _sha256_file(old_file) if exists(old_file) else None
+    if old is not None and current is not None and old != current:
+        logger.info(
+            "%s does not match %s; restarting PDiff history",
+            index_file,
+            basename(old_file),
+        )
+        for entries in sections.values():
+            entries.clear()
+
+    if old is not None and old != new:
+        name = datetime.now(UTC).strftime("%Y-%m-%d-%H%M.%S")
+        while name in sections[HISTORY]:
+            # more than one index run within a second
+            name = f"{name}.1"
+        patch = ed_diff(old_file, packages_file)
+        patch_gz = gzip.compress(patch, 9, mtime=0)
+        patch_file = join(diff_dir, f"{name}.gz")
+        with HashedWriter(patch_file) as output:
+            output.write(patch_gz)
+        sections[HISTORY][name] = old
+        sections[PATCHES][name] = (
+            hashlib.sha256(patch).hexdigest(),
+            len(patch),
+        )
+        sections[DOWNLOAD][name] = (output.sha256.hexdigest(), output.size)
+
+    expired = list(sections[HISTORY])[:-keep]
+    for name in expired:
+        for entries in sections.values():
+            entries.pop(name, None)
+    on_disk = {
+        name.removesuffix(".gz")
+        for name in os.listdir(diff_dir)
+        if name.endswith(".gz")
+    }
+    rm_files(
+        [
+            join(diff_dir, f"{name}.gz")
+            for name in on_disk - set(sections[HISTORY])
+        ],
+    )
+    return write_index(index_file, new, sections)
@@ -0,0 +1,497 @@
+"""Pool garbage collection: old versions, unindexed files, duplicates."""
+from __future__ import annotations
+
+import contextlib
+import functools
+import hashlib
+import logging
+import os
+import re
+from os.path import exists, isdir, isfile, join, relpath
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from repo_lib import BY_HASH_KEEP, CACHE_DIR, GC_KEEP, RepoError, Repository
+from repo_lib.gpg import SigningSession
+from repo_lib.packages import PackagesCache, parallel_map, walk_debs
+from repo_lib.resolver import version_compare
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK = 1024 * 1024
+
+_SHA256_RE = re.compile(r"^SHA256: (\S+)$", re.MULTILINE)
+
+InodeKey = tuple[int, int]  # (st_dev, st_ino)
+
+
+def deb_fields(filename: str) -> tuple[str, str, str] | None:
+    """Return (name, version, arch) of a pool .deb, from its file name."""
+    parts = os.path.basename(filename).removesuffix(".deb").split("_")
+    if len(parts) != 3:  # noqa: PLR2004
+        return None
+    name, version, arch = parts
+    return name, version.replace("%3a", ":"), arch
+
+
+def _component_of(filename: str, components: Iterable[str]) -> str:
+    return next(
+        (c for c in components if filename.startswith(f"{c}/")), "",
+    )
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fob:
+        while data := fob.read(HASH_CHUNK):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class IndexedFiles(NamedTuple):
+    """What the Packages indexes under dists/ list; see indexed_files()."""
+
+    # listed by any index, live or a previous generation
+    referenced: set[str]
+    # listed by a staged generation (dists/.<release>.*), which is kept
+    # as it is, even if its release is reindexed
+    kept: set[str]
+    # (component directory, arch) -> mtime of its newest index
+    indexed_at: dict[tuple[str, str], float]
+    # release -> (component, arch) -> listed by its live index
+    live: dict[str, dict[tuple[str, str], set[str]]]
+
+
+def indexed_files(path: str, pool: str = "pool") -> IndexedFiles:
+    """Return the files the Packages indexes under path/dists list.
+
+    Every Packages file is read, including those of the previous
+    generations a staged publish keeps. indexed_at gives, for each
+    component directory and architecture (e.g. ('pool/main', 'amd64'))
+    with a binary-<arch> index, the mtime of its newest index: files that
+    arrived after it may simply not have been indexed yet.
+    """
+    indexed = IndexedFiles(set(), set(), {}, {})
+    listed: dict[str, dict[tuple[str, str], set[str]]] = {}
+    dists_dir = join(path, "dists")
+    if not isdir(dists_dir):
+        return indexed
+    for root, _, files in os.walk(dists_dir):
+        parts = relpath(root, dists_dir).split(os.sep)
+        if "Packages" not in files or len(parts) != 3:  # noqa: PLR2004
+            continue
+        top, component, binary = parts
+        if not binary.startswith("binary-"):
+            continue
+        arch = binary.removeprefix("binary-")
+        packages_file = join(root, "Packages")
+        key = (join(pool, component), arch)
+        indexed.indexed_at[key] = max(
+            os.stat(packages_file).st_mtime, indexed.indexed_at.get(key, 0),
+        )
+        filenames = listed.setdefault(top, {}).setdefault(
+            (component, arch), set(),
+        )
+        with open(packages_file, encoding="utf-8", errors="replace") as fob:
+            for line in fob:
+                if line.startswith("Filename: "):
+                    filenames.add(line[10:].strip())
+        indexed.referenced.update(filenames)
+        if top.startswith("."):
+            indexed.kept.update(filenames)
+    # a staged release is a symlink to its live generation
+    for name in os.listdir(dists_dir):
+        if not name.startswith(".") and isdir(join(dists_dir, name)):
+            indexed.live[name] = listed.get(
+                os.path.basename(os.path.realpath(join(dists_dir, name))), {},
+            )
+    return indexed
+
+
+class GcPlan:
+    """The changes a pool garbage collection makes, and the space saved.
+
+    remove lists (filename, reason) and link lists (filename, identical
+    file it becomes a hard link to); filenames are relative to the
+    repository. reclaimed counts only the data actually freed: a file
+    that still has a hard link elsewhere (another pool component, or an
+    apt cache) frees nothing. unlist holds the old versions that are
+    only taken out of the live indexes, as a kept staged generation still
+    lists them. reindex maps each release whose live indexes list a file
+    removed or unlisted to the (component, arch) indexes that list one.
+    """
+
+    def __init__(self, files: dict[str, os.stat_result]) -> None:
+        self.files = files
+        self.remove: list[tuple[str, str]] = []
+        self.link: list[tuple[str, str]] = []
+        self.reclaimed = 0
+        self.unlist: set[str] = set()
+        self.reindex: dict[str, set[tuple[str, str]]] = {}
+        self._links_left: dict[InodeKey, int] = {}
+        for stat in files.values():
+            self._links_left[(stat.st_dev, stat.st_ino)] = stat.st_nlink
+
+    def _unlink(self, stat: os.stat_result) -> None:
+        key = (stat.st_dev, stat.st_ino)
+        self._links_left[key] -= 1
+        if not self._links_left[key]:
+            self.reclaimed += stat.st_size
+
+    def inode(self, filename: str) -> InodeKey:
+        stat = self.files[filename]
+        return stat.st_dev, stat.st_ino
+
+    def drop(self, filename: str, reason: str) -> None:
+        self.remove.append((filename, reason))
+        self._unlink(self.files.pop(filename))
+
+    def excluded(self) -> set[str]:
+        """Return the files to leave out of rebuilt indexes."""
+        return self.unlist | {filename for filename, _ in self.remove}
+
+    def relink(self, filename: str, target: str) -> None:
+        self.link.append((filename, target))
+        self._unlink(self.files[filename])
+
+
+def _old_versions(
+    plan: GcPlan, components: list[str], keep: int, kept: set[str],
+) -> None:
+    groups: dict[tuple[str, str, str], list[tuple[str, str]]] = {}
+    for filename in plan.files:
+        fields = deb_fields(filename)
+        component = _component_of(filename, components)
+        if fields:
+            name, version, arch = fields
+            groups.setdefault((component, name, arch), []).append(
+                (version, filename),
+            )
+    by_version = functools.cmp_to_key(version_compare)
+    for versions in groups.values():
+        versions.sort(key=lambda item: by_version(item[0]), reverse=True)
+        for _, filename in versions[keep:]:
+            if filename in kept:
+                # clients that fetched that generation may still want it
+                logger.debug("Old version, in a kept generation: %s", filename)
+                plan.unlist.add(filename)
+            else:
+                plan.drop(filename, f"older than the newest {keep}")
+
+
+def _unindexed(
+    plan: GcPlan,
+    components: list[str],
+    referenced: set[str],
+    indexed_at: dict[tuple[str, str], float],
+) -> None:
+    unindexed: set[tuple[str, str]] = set()
+    for filename in sorted(plan.files):
+        fields = deb_fields(filename)
+        if not fields or filename in referenced:
+            continue
+        component = _component_of(filename, components)
+        arch = fields[2]
+        if arch == "all":
+            # listed by every binary-<arch> index of its component
+            index_times = [
+                mtime
+                for (indexed, _), mtime in indexed_at.items()
+                if indexed == component
+            ]
+        else:
+            index_times = (
+                [indexed_at[(component, arch)]]
+                if (component, arch) in indexed_at
+                else []
+            )
+        if not index_times:
+            unindexed.add((component, arch))
+            continue
+        # ctime, not mtime: copies out of the apt cache keep the mtime of
+        # the download, but linking or copying into the pool sets ctime
+        if plan.files[filename].st_ctime > max(index_times):
+            logger.debug("Newer than the last index, kept: %s", filename)
+            continue
+        plan.drop(filename, "not in any Packages index")
+    for component, arch in sorted(unindexed):
+        logger.warning(
+            "%s: %s not in any Packages index, leaving its files alone",
+            component,
+            arch,
+        )
+
+
+def _duplicates(
+    plan: GcPlan, path: str, cache_dir: str, components: list[str], jobs: int,
+) -> None:
+    by_size: dict[int, list[str]] = {}
+    for filename, stat in sorted(plan.files.items()):
+        by_size.setdefault(stat.st_size, []).append(filename)
+    # only files that share their size with a different inode can have
+    # identical content, and only those need a digest
+    candidates = [
+        filename
+        for filenames in by_size.values()
+        if len({plan.inode(filename) for filename in filenames}) > 1
+        for filename in filenames
+    ]
+    caches = {
+        component: PackagesCache(
+            join(cache_dir, f"packages-{os.path.basename(component)}.json"),
+        )
+        for component in components
+    }
+
+    def digest(filename: str) -> str:
+        cache = caches[_component_of(filename, components)]
+        stanza = cache.get(filename, plan.files[filename])
+        match = _SHA256_RE.search(stanza or "")
+        return match.group(1) if match else _sha256(join(path, filename))
+
+    first: dict[tuple[int, str], str] = {}
+    for filename, sha256 in zip(
+        candidates, parallel_map(digest, candidates, jobs), strict=True,
+    ):
+        stat = plan.files[filename]
+        target = first.setdefault((stat.st_size, sha256), filename)
+        if plan.inode(target) == plan.inode(filename):
+            continue
+        if plan.files[target].st_dev != stat.st_dev:
+            logger.debug("Identical, but on another device: %s", filename)
+            continue
+        plan.relink(filename, target)
+
+
+def plan_gc(
+    path: str,
+    pool: str = "pool",
+    *,
+    keep: int = GC_KEEP,
+    jobs: int = 1,
+    cache_dir: str = "",
+) -> GcPlan:
+    """Work out what collect_garbage() would do, without doing it.
+
+    In order: of each package (per component and architecture) all but
+    the newest keep versions are removed (keep 0: all are kept), or only
+    unlisted while a kept staged generation lists them; .debs no Packages
+    index lists are removed, unless their component has never been
+    indexed for their architecture or they arrived after its last index;
+    and of the files left, identical ones are hard-linked to the first of
+    them. Content digests come from the index stanza cache where it is
+    current. The live indexes that list a removed or unlisted file are
+    noted for reindexing.
+    """
+    pool_dir = join(path, pool)
+    if not isdir(pool_dir):
+        raise RepoError(f"pool '{pool_dir}' does not exist")
+    components = sorted(
+        join(pool, name)
+        for name in os.listdir(pool_dir)
+        if isdir(join(pool_dir, name))
+    )
+    files = {
+        filename: stat
+        for component in components
+        for filename, stat in walk_debs(path, component)
+    }
+    plan = GcPlan(files)
+    indexed = indexed_files(path, pool)
+    if keep > 0:
+        _old_versions(plan, components, keep, indexed.kept)
+    _unindexed(plan, components, indexed.referenced, indexed.indexed_at)
+    excluded = plan.excluded()
+    for release, indexes in sorted(indexed.live.items()):
+        stale = {
+            key
+            for key, listed in indexes.items()
+            if not listed.isdisjoint(excluded)
+        }
+        if stale:
+            plan.reindex[release] = stale
+    _duplicates(
+        plan,
+        path,
+        cache_dir or join(path, CACHE_DIR),
+        components,
+        jobs if jobs > 0 else os.cpu_count() or 1,
+    )
+    return plan
+
+
+def apply_gc(path: str, plan: GcPlan) -> None:
+    """Make the pool changes in plan; reindex() them first."""
+    for filename, _ in plan.remove:
+        logger.debug("Removing: %s", filename)
+        os.remove(join(path, filename))
+    for filename, target in plan.link:
+        logger.debug("Linking: %s -> %s", filename, target)
+        tmp_file = join(path, f"{filename}.gc.tmp")
+        os.link(join(path, target), tmp_file)
+        os.replace(tmp_file, join(path, filename))
+
+
+def _release_fields(dist_dir: str) -> dict[str, str]:
+    """Return the fields of dist_dir's Release, if there is one."""
+    fields: dict[str, str] = {}
+    release_file = join(dist_dir, "Release")
+    if not isfile(release_file):
+        return fields
+    with open(release_file, encoding="utf-8", errors="replace") as fob:
+        for line in fob:
+            key, sep, value = line.partition(": ")
+            if sep and not line[0].isspace():
+                fields[key] = value.strip()
+    return fields
+
+
+def _settings(path: str, pool: str, release: str) -> dict[str, Any]:
+    settings = Repository(path, release, pool, "", "").recorded_settings()
+    if not settings:
+        raise RepoError(
+            f"{release}: needs reindexing after gc, but its index settings"
+            " were never recorded; publish it again first",
+        )
+    return settings
+
+
+def _rebuilder(
+    path: str, pool: str, release: str, plan: GcPlan, jobs: int,
+) -> Repository:
+    """Return a Repository that rebuilds release as it was last indexed.
+
+    The settings come from the release's manifest (see
+    Repository.index_settings()); Origin and Version from its Release
+    where there is one. Raises RepoError if none were recorded.
+    """
+    settings = _settings(path, pool, release)
+    fields = _release_fields(join(path, "dists", release))
+    codecs = settings.get("codecs")
+    return Repository(
+        path,
+        release,
+        pool,
+        fields.get("Version", settings.get("version", "")),
+        fields.get("Origin", settings.get("origin", "")),
+        quiet=True,
+        incremental=settings.get("incremental", False),
+        backend=settings.get("backend", "apt-ftparchive"),
+        jobs=jobs,
+        codecs=None if codecs is None else tuple(codecs),
+        by_hash_keep=settings.get("by_hash_keep", BY_HASH_KEEP),
+        pdiff_keep=settings.get("pdiff_keep", 0),
+        exclude=plan.excluded(),
+    )
+
+
+def check_reindex(
+    path: str, pool: str, plan: GcPlan, gpgkey: str,
+) -> None:
+    """Raise RepoError if reindex() could not rebuild plan.reindex alike.
+
+    That is: a release has no recorded index settings, or is signed and
+    no gpgkey is given.
+    """
+    for release in sorted(plan.reindex):
+        _settings(path, pool, release)
+    if gpgkey:
+        return
+    signed = [
+        release
+        for release in sorted(plan.reindex)
+        if any(
+            exists(join(path, "dists", release, name))
+            for name in ("Release.gpg", "InRelease")
+        )
+    ]
+    if signed:
+        raise RepoError(
+            f"{', '.join(signed)}: signed, and needs reindexing after gc;"
+            " a gpg key to sign it with is required",
+        )
+
+
+def reindex(
+    path: str,
+    pool: str,
+    plan: GcPlan,
+    *,
+    gpgkey: str = "",
+    gnupghome: str = "",
+    jobs: int = 1,
+) -> None:
+    """Rebuild the indexes plan.reindex names without plan's files.
+
+    Each release is rebuilt with the settings it was last indexed with,
+    then its Release is generated; a staged release (see
+    Repository.staged()) is rebuilt aside and swapped in. Raises
+    RepoError, before anything is written, if check_reindex() fails.
+    """
+    check_reindex(path, pool, plan, gpgkey)
+    signer = SigningSession(gpgkey, gnupghome) if gpgkey else None
+    for release, indexes in sorted(plan.reindex.items()):
+        repo = _rebuilder(path, pool, release, plan, jobs)
+        with (
+            repo.staged()
+            if os.path.islink(join(path, "dists", release))
+            else contextlib.nullcontext()
+        ):
+            for component, arch in sorted(indexes):
+                repo.index(component, arch)
+            repo.generate_release(signer=signer)
+
+
+def collect_garbage(
+    path: str,
+    pool: str = "pool",
+    *,
+    keep: int = GC_KEEP,
+    jobs: int = 1,
+    dry_run: bool = False,
+    gpgkey: str = "",
+    gnupghome: str = "",
+) -> GcPlan:
+    """Remove old and unindexed .debs from the pool, link duplicates.
+
+    See plan_gc(). The indexes that list a file to be removed or unlisted
+    are rebuilt without it first, and their Release regenerated and
+    signed with gpgkey (see reindex()); the pool is only changed once
+    that is published. Each change and the space reclaimed is printed;
+    with dry_run nothing is changed.
+    """
+    plan = plan_gc(path, pool, keep=keep, jobs=jobs)
+    remove, unlist, link, rebuild, reclaim = (
+        (
+            "Would remove",
+            "Would unlist",
+            "Would link",
+            "Would reindex",
+            "Would reclaim",
+        )
+        if dry_run
+        else ("Removed", "Unlisted", "Linked", "Reindexed", "Reclaimed")
+    )
+    if not dry_run:
+        reindex(
+            path, pool, plan, gpgkey=gpgkey, gnupghome=gnupghome, jobs=jobs,
+        )
+        apply_gc(path, plan)
+    for filename, reason in plan.remove:
+        print(f"{remove}: {filename} ({reason})")
+    for filename in sorted(plan.unlist):
+        print(f"{unlist}: {filename} (kept for a previous generation)")
+    for filename, target in plan.link:
+        print(f"{link}: {filename} -> {target}")
+    for release, indexes in sorted(plan.reindex.items()):
+        print(
+            f"{rebuild}: {release} "
+            + ", ".join(f"{c}/binary-{a}" for c, a in sorted(indexes)),
+        )
+    print(
+        f"{reclaim} {plan.reclaimed} bytes ({plan.reclaimed / 2**20:.1f} MiB)"
+        f" from {len(plan.remove)} removal(s) and {len(plan.link)} link(s).",
+    )
+    return plan
@@ -0,0 +1,148 @@
+"""On-disk cache of dependency closures and installed-package sets."""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+from os.path import expanduser, isdir, join
+from typing import TYPE_CHECKING
+
+from repo_lib.download import DPKG_STATUS
+from repo_lib.resolver import LISTS_DIR
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+# total size of cached entries kept before the least recently used go
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> str:
+    """Return $XDG_CACHE_HOME/repo/resolve (XDG default: ~/.cache)."""
+    base = os.environ.get("XDG_CACHE_HOME") or expanduser("~/.cache")
+    return join(base, "repo", "resolve")
+
+
+def files_signature(paths: Iterable[str]) -> str:
+    """Return a digest of the paths' names, sizes, mtimes and inodes.
+
+    Missing files are part of the signature too, so creating one changes
+    it. Content is not read: apt and dpkg replace these files by rename,
+    which always changes the inode.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            digest.update(f"{path}\0-\n".encode())
+            continue
+        digest.update(
+            f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{stat.st_ino}\n"
+            .encode(),
+        )
+    return digest.hexdigest()
+
+
+def lists_signature(root: str) -> str:
+    """Return the signature of apt's lists under root (a rootfs path)."""
+    lists_dir = join(root, LISTS_DIR)
+    names = sorted(os.listdir(lists_dir)) if isdir(lists_dir) else []
+    return files_signature(
+        join(lists_dir, name)
+        for name in names
+        if name not in ("lock", "partial", "auxfiles")
+    )
+
+
+def status_signature(root: str) -> str:
+    """Return the signature of the dpkg status file under root."""
+    return files_signature([join(root, DPKG_STATUS)])
+
+
+class ResolveCache:
+    """Sets of package names on disk, one JSON file per key.
+
+    Keys are digests of everything a result depends on (see
+    lists_signature and status_signature), so entries never need to be
+    invalidated, only evicted: reading an entry marks it as recently
+    used and once the entries take up more than max_bytes the least
+    recently used are removed.
+    """
+
+    def __init__(
+        self, cache_dir: str = "", max_bytes: int = MAX_BYTES,
+    ) -> None:
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> set[str] | None:
+        path = self._path(key)
+        try:
+            with open(path) as fob:
+                data = json.load(fob)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache entry %s: %s", path, e)
+            return None
+        if data.get("version") != CACHE_VERSION:
+            return None
+        # LRU touch; a read-only or foreign cache still serves hits
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return set(data.get("names", []))
+
+    def put(self, key: str, names: Iterable[str]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as fob:
+            json.dump({"version": CACHE_VERSION, "names": sorted(names)}, fob)
+        os.replace(tmp_file, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries beyond max_bytes."""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append(
+                        (stat.st_mtime_ns, stat.st_size, entry.path),
+                    )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug("Evicting: %s", path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+    def get_or_compute(
+        self, parts: Iterable[str], compute: Callable[[], set[str]],
+    ) -> set[str]:
+        """Return the cached set for parts, computing and storing on a miss."""
+        key = self.key(*parts)
+        names = self.get(key)
+        if names is None:
+            names = compute()
+            self.put(key, names)
+        else:
+            logger.debug("Resolve cache hit: %s", key)
+        return names
@@ -0,0 +1,341 @@
+"""In-process Depends/Pre-Depends resolution over apt's Packages lists."""
+from __future__ import annotations
+
+import glob
+import logging
+import re
+from os.path import join
+from typing import TYPE_CHECKING, NamedTuple
+
+from repo_lib import RepoError
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+LISTS_DIR = join("var", "lib", "apt", "lists")
+
+# Packages fields kept in memory; everything else is skipped while parsing
+_FIELDS = (
+    "Package",
+    "Version",
+    "Architecture",
+    "Depends",
+    "Pre-Depends",
+    "Provides",
+)
+
+# 'name[:archqual] [(op version)]', ignoring [arch] and <profile> lists
+_RELATION_RE = re.compile(
+    r"^\s*(?P<name>[^\s:(\[<]+)(?::\S+)?\s*"
+    r"(?:\(\s*(?P<op><<|<=|=|>=|>>|<|>)\s*(?P<version>[^\s)]+)\s*\))?",
+)
+
+Relation = tuple[str, str, str]  # (name, op, version); op '' if unversioned
+
+
+def _order(char: str) -> int:
+    # dpkg's order(): '~' sorts before everything, even the end of the
+    # string; letters before non-letters
+    if char == "~":
+        return -1
+    if not char or char.isdigit():
+        return 0
+    if char.isascii() and char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _verrevcmp(a: str, b: str) -> int:
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (
+            j < len(b) and not b[j].isdigit()
+        ):
+            ac = _order(a[i] if i < len(a) else "")
+            bc = _order(b[j] if j < len(b) else "")
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        first_diff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(version: str) -> tuple[int, str, str]:
+    # [epoch:]upstream[-revision]; the epoch ends at the first ':' and the
+    # revision starts after the last '-'
+    epoch = 0
+    if ":" in version:
+        head, version = version.split(":", 1)
+        epoch = int(head or 0)
+    upstream, revision = version, ""
+    if "-" in version:
+        upstream, revision = version.rsplit("-", 1)
+    return epoch, upstream, revision
+
+
+def version_compare(a: str, b: str) -> int:
+    """Compare Debian versions a and b like dpkg --compare-versions.
+
+    Returns a negative number, zero or a positive number as a is lower
+    than, equal to or higher than b.
+    """
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _verrevcmp(a_upstream, b_upstream) or _verrevcmp(
+        a_revision, b_revision,
+    )
+
+
+def version_satisfies(version: str, op: str, wanted: str) -> bool:
+    """Return True if version satisfies the relation 'op wanted'."""
+    result = version_compare(version, wanted)
+    if op == "<<":
+        return result < 0
+    if op in ("<=", "<"):
+        return result <= 0
+    if op == "=":
+        return result == 0
+    if op in (">=", ">"):
+        return result >= 0
+    if op == ">>":
+        return result > 0
+    raise RepoError(f"unknown version relation '{op}'")
+
+
+def parse_relations(value: str) -> list[list[Relation]]:
+    """Parse a Depends-style field into groups of alternatives."""
+    groups = []
+    for group in value.split(","):
+        alternatives = []
+        for alternative in group.split("|"):
+            match = _RELATION_RE.match(alternative)
+            if match:
+                alternatives.append(
+                    (
+                        match.group("name"),
+                        match.group("op") or "",
+                        match.group("version") or "",
+                    ),
+                )
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+class Candidate(NamedTuple):
+    """The version of a package apt would pick, with its raw relations."""
+
+    version: str
+    depends: str
+    provides: str
+
+
+class PackageLists:
+    """Candidate versions from a set of Packages files, indexed by name.
+
+    For each package only the highest version for arch (or 'all') is
+    kept, with its Depends/Pre-Depends and Provides left unparsed until
+    needed. Pinning is not taken into account.
+    """
+
+    def __init__(self, paths: Iterable[str], arch: str) -> None:
+        self.arch = arch
+        self.packages: dict[str, Candidate] = {}
+        for path in paths:
+            self._load(path)
+        # virtual name -> [(provider, provided version or '')]
+        self.provides: dict[str, list[tuple[str, str]]] = {}
+        for name in sorted(self.packages):
+            provides = self.packages[name].provides
+            for group in parse_relations(provides) if provides else []:
+                virtual, _, version = group[0]
+                self.provides.setdefault(virtual, []).append((name, version))
+
+    def _add(self, fields: dict[str, str]) -> None:
+        name = fields.get("Package")
+        version = fields.get("Version")
+        if not name or not version:
+            return
+        if fields.get("Architecture") not in (self.arch, "all"):
+            return
+        current = self.packages.get(name)
+        if current and version_compare(current.version, version) >= 0:
+            return
+        depends = ", ".join(
+            fields[field]
+            for field in ("Pre-Depends", "Depends")
+            if fields.get(field)
+        )
+        self.packages[name] = Candidate(
+            version, depends, fields.get("Provides", ""),
+        )
+
+    def _load(self, path: str) -> None:
+        logger.debug("Loading: %s", path)
+        fields: dict[str, str] = {}
+        field = ""
+        with open(path, encoding="utf-8", errors="replace") as fob:
+            for line in fob:
+                if line == "\n":
+                    self._add(fields)
+                    fields = {}
+                elif line[0] in " \t":
+                    if field in fields:
+                        fields[field] += f" {line.strip()}"
+                else:
+                    field, _, value = line.partition(":")
+                    if field in _FIELDS:
+                        fields[field] = value.strip()
+        self._add(fields)
+
+
+def load_lists(root: str, arch: str) -> PackageLists:
+    """Load the *_Packages lists apt keeps under root (a rootfs path)."""
+    paths = sorted(glob.glob(join(root, LISTS_DIR, "*_Packages")))
+    if not paths:
+        raise RepoError(
+            f"no Packages lists in {join(root, LISTS_DIR)} (run apt update)",
+        )
+    return PackageLists(paths, arch)
+
+
+class Resolver:
+    """Depends/Pre-Depends closures over PackageLists, memoized.
+
+    Of each group of alternatives the first one that can be satisfied is
+    followed, unless a later one is already satisfied by an installed
+    package. A virtual package is satisfied by its (alphabetically) first
+    provider. The closure of every package reached is kept, so closures
+    that share dependencies are only walked once.
+    """
+
+    def __init__(
+        self, lists: PackageLists, installed: Iterable[str] = (),
+    ) -> None:
+        self.lists = lists
+        self.installed = set(installed)
+        self.depends: dict[str, list[str]] = {}
+        self.closures: dict[str, frozenset[str]] = {}
+
+    def _satisfiers(self, name: str, op: str, version: str) -> list[str]:
+        found = []
+        candidate = self.lists.packages.get(name)
+        if candidate and (
+            not op or version_satisfies(candidate.version, op, version)
+        ):
+            found.append(name)
+        for provider, provided in self.lists.provides.get(name, []):
+            if not op or (
+                provided and version_satisfies(provided, op, version)
+            ):
+                found.append(provider)
+        return found
+
+    def _direct(self, name: str) -> list[str]:
+        """Return the packages name depends on, one per relation group."""
+        if name in self.depends:
+            return self.depends[name]
+        chosen = []
+        candidate = self.lists.packages[name]
+        for group in parse_relations(candidate.depends):
+            options = [
+                satisfier
+                for relation in group
+                for satisfier in self._satisfiers(*relation)
+            ]
+            if not options:
+                logger.warning(
+                    "%s: unsatisfiable dependency: %s",
+                    name,
+                    " | ".join(
+                        f"{n} ({op} {v})" if op else n for n, op, v in group
+                    ),
+                )
+                continue
+            installed = [
+                option for option in options if option in self.installed
+            ]
+            chosen.append(installed[0] if installed else options[0])
+        self.depends[name] = chosen
+        return chosen
+
+    def _closure(self, root: str) -> frozenset[str]:
+        # iterative Tarjan: dependency cycles are common (e.g. libc6 and
+        # libgcc-s1), and every package in a cycle shares one closure
+        index: dict[str, int] = {root: 0}
+        low: dict[str, int] = {root: 0}
+        stack = [root]
+        on_stack = {root}
+        work = [(root, iter(self._direct(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child in self.closures:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(self._direct(child))))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+                members = set()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    members.add(member)
+                    if member == node:
+                        break
+                closure = set(members)
+                for member in members:
+                    for child in self._direct(member):
+                        if child not in members:
+                            closure |= self.closures[child]
+                frozen = frozenset(closure)
+                for member in members:
+                    self.closures[member] = frozen
+        return self.closures[root]
+
+    def resolve(self, packages: Iterable[str]) -> set[str]:
+        """Return the Depends/Pre-Depends closure of packages, inclusive.
+
+        A requested virtual package is replaced by its provider. Unknown
+        packages raise RepoError.
+        """
+        result: set[str] = set()
+        for name in packages:
+            options = self._satisfiers(name, "", "")
+            if not options:
+                raise RepoError(f"package '{name}' not found in apt lists")
+            result |= self.closures.get(options[0]) or self._closure(
+                options[0],
+            )
+        return result
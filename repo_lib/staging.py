@@ -0,0 +1,86 @@
+"""Staged generations of a dists/<release> tree, swapped in atomically."""
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+from datetime import UTC, datetime
+from os.path import basename, isdir, islink, join, realpath
+
+logger = logging.getLogger(__name__)
+
+
+def generation_prefix(release: str) -> str:
+    """Return the name prefix of the generation directories of release."""
+    return f".{release}."
+
+
+def new_generation(dists_dir: str, release: str) -> str:
+    """Return the path of a new (not yet created) generation directory.
+
+    Generations are hidden siblings of dists/<release> named after the
+    time they were started, so sorting the names sorts them by age.
+    """
+    stamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%S.%f")
+    return join(dists_dir, f"{generation_prefix(release)}{stamp}")
+
+
+def link_tree(src: str, dst: str) -> None:
+    """Recreate the tree src at dst with files hard-linked, not copied.
+
+    Everything under dists/ is written to a temporary file and renamed
+    into place, never modified in place, so the two trees can share inodes
+    and later writes to either one leave the other untouched. Files are
+    copied where hard links are not possible.
+    """
+    for root, dirs, files in os.walk(src):
+        target_root = join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files + [d for d in dirs if islink(join(root, d))]:
+            source = join(root, name)
+            target = join(target_root, name)
+            if islink(source):
+                os.symlink(os.readlink(source), target)
+                continue
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+
+
+def activate(dists_dir: str, release: str, generation: str) -> None:
+    """Point dists/<release> at generation with an atomic symlink swap.
+
+    Clients see either the complete old tree or the complete new one. A
+    dists/<release> that is still a plain directory (published in place)
+    is first moved aside as a generation of its own; only that one-off
+    conversion leaves a brief window where the path does not exist.
+    """
+    live = join(dists_dir, release)
+    if isdir(live) and not islink(live):
+        previous = new_generation(dists_dir, release)
+        logger.info("Converting %s to a staged generation", live)
+        os.rename(live, previous)
+    tmp_link = join(dists_dir, f"{generation_prefix(release)}link.tmp")
+    if islink(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(basename(generation), tmp_link)
+    logger.debug("Activating: %s -> %s", live, basename(generation))
+    os.replace(tmp_link, live)
+
+
+def prune_generations(dists_dir: str, release: str, keep: int) -> None:
+    """Remove all but the live and the newest keep previous generations."""
+    live = realpath(join(dists_dir, release))
+    prefix = generation_prefix(release)
+    previous = sorted(
+        name
+        for name in os.listdir(dists_dir)
+        if name.startswith(prefix)
+        and isdir(join(dists_dir, name))
+        and not islink(join(dists_dir, name))
+        and realpath(join(dists_dir, name)) != live
+    )
+    for name in previous[: max(len(previous) - keep, 0)]:
+        logger.debug("Removing: %s", join(dists_dir, name))
+        shutil.rmtree(join(dists_dir, name))
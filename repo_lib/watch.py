@@ -0,0 +1,317 @@
+"""Keep a release published while .debs come and go: repo watch."""
+from __future__ import annotations
+
+import contextlib
+import ctypes
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from os.path import isdir, join, relpath
+from typing import TYPE_CHECKING
+
+from repo_lib import STAGED_KEEP, WATCH_DEBOUNCE, WATCH_MAX_DELAY, RepoError
+from repo_lib.gpg import SigningSession
+from repo_lib.packages import deb_archs, walk_debs
+
+if TYPE_CHECKING:
+    from repo_lib import Repository
+
+logger = logging.getLogger(__name__)
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# a .deb is complete once closed after writing, moved into place or hard
+# linked in (IN_CREATE alone); a file still being written is not picked up
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; then the name
+READ_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Minimal inotify(7) binding over libc, via ctypes."""
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise RepoError(
+                f"inotify_init1: {os.strerror(ctypes.get_errno())}",
+            )
+        self.paths: dict[int, str] = {}
+
+    def add(self, path: str, mask: int = WATCH_MASK) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOENT:
+                return  # removed again before it could be watched
+            raise RepoError(f"inotify_add_watch {path}: {os.strerror(error)}")
+        if wd in self.paths:
+            return  # already watched
+        self.paths[wd] = path
+
+    def read(self, timeout: float | None) -> list[tuple[str, str, int]]:
+        """Return (directory, name, mask) events, waiting up to timeout.
+
+        A queue overflow is returned as ('', '', IN_Q_OVERFLOW).
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                events.append(("", "", mask))
+            elif wd in self.paths:
+                events.append((self.paths[wd], name, mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PoolWatcher:
+    """Reindex and re-release a repository as its pool changes.
+
+    Changes are collected into batches: a batch ends once no event has
+    arrived for debounce seconds, or max_delay seconds after it started.
+    Only the binary-<arch> indexes the batch touched are rebuilt (every
+    arch for Architecture: all packages), then the Release is generated
+    and signed once. A new component or architecture, a removed
+    component, or an inotify queue overflow makes the batch a full
+    index_all() instead. Use an incremental or native Repository, so a
+    rebuilt index only reads the .debs that changed.
+    """
+
+    def __init__(
+        self,
+        repo: Repository,
+        *,
+        gpgkey: str = "",
+        gnupghome: str = "",
+        staged: bool = False,
+        keep: int = STAGED_KEEP,
+        debounce: float = WATCH_DEBOUNCE,
+        max_delay: float = WATCH_MAX_DELAY,
+    ) -> None:
+        self.repo = repo
+        # one signing session for every release published
+        self.signer = SigningSession(gpgkey, gnupghome) if gpgkey else None
+        self.staged = staged
+        self.keep = keep
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pool_dir = join(repo.path, repo.pool)
+        self.components: list[str] = []
+        self.archs: list[str] = []
+        self.inotify = Inotify()
+        # changes whose publish failed, retried with the next batch
+        # (None: everything)
+        self.failed: set[str] | None = set()
+        # .debs seen by IN_CREATE only so far; see _linked()
+        self._created: set[str] = set()
+        self._watch_tree(self.pool_dir)
+
+    def _watch_tree(self, top: str) -> list[str]:
+        """Watch top and its subdirectories; return the .debs found."""
+        found: list[str] = []
+        for root, _, files in os.walk(top):
+            self.inotify.add(root)
+            found.extend(
+                relpath(join(root, name), self.repo.path)
+                for name in files
+                if name.endswith(".deb")
+            )
+        return found
+
+    def scan(self) -> None:
+        """Read the pool's components and architectures."""
+        self.components = self.repo.components()
+        self.archs = deb_archs(
+            filename
+            for component in self.components
+            for filename, _ in walk_debs(
+                self.repo.path, join(self.repo.pool, component),
+            )
+        )
+
+    def wait_batch(self) -> set[str] | None:
+        """Block until a batch of changes is complete; return it.
+
+        Returns the changed .debs (relative to the repository), or None
+        if events were lost or a directory went, and everything has to be
+        reindexed.
+        """
+        changed: set[str] = set()
+        started = 0.0
+        while True:
+            timeout = None
+            if changed or self._created:
+                timeout = self.debounce
+            if changed:
+                timeout = min(
+                    self.debounce, started + self.max_delay - time.monotonic(),
+                )
+                if timeout <= 0:
+                    return self._end_batch(changed)
+            events = self.inotify.read(timeout)
+            if not events:
+                changed.update(self._linked())
+                if changed:
+                    return self._end_batch(changed)
+            for directory, name, mask in events:
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflow, reindexing all")
+                    return None
+                path = join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_MOVED_FROM | IN_DELETE):
+                        # the .debs under it went without events of their own
+                        logger.debug("Directory gone: %s", path)
+                        return None
+                    if mask & (IN_CREATE | IN_MOVED_TO) and isdir(path):
+                        # .debs may have landed before the watch was added
+                        changed.update(self._watch_tree(path))
+                    continue
+                if not name.endswith(".deb"):
+                    continue
+                filename = relpath(path, self.repo.path)
+                if mask & IN_CREATE:
+                    self._created.add(filename)
+                else:
+                    logger.debug("Changed: %s", path)
+                    self._created.discard(filename)
+                    changed.add(filename)
+            if changed and not started:
+                started = time.monotonic()
+
+    def _linked(self) -> set[str]:
+        """Return the created .debs that were hard links, not writes.
+
+        A hard link only raises IN_CREATE; a file still being written
+        has a single link and stays pending until its IN_CLOSE_WRITE.
+        """
+        linked = set()
+        for filename in list(self._created):
+            try:
+                nlink = os.stat(join(self.repo.path, filename)).st_nlink
+            except FileNotFoundError:
+                nlink = 0
+            if nlink != 1:
+                self._created.discard(filename)
+                linked.add(filename)
+        return linked
+
+    def _end_batch(self, changed: set[str]) -> set[str]:
+        return changed | self._linked()
+
+    def affected(self, filenames: set[str]) -> set[tuple[str, str]] | None:
+        """Return the (component, arch) indexes filenames touch.
+
+        None means a full reindex is needed: a component or architecture
+        came or went.
+        """
+        indexes: set[tuple[str, str]] = set()
+        for filename in filenames:
+            component = relpath(filename, self.repo.pool).split(os.sep)[0]
+            arch = filename.removesuffix(".deb").rsplit("_", 1)[-1]
+            if component not in self.components or not isdir(
+                join(self.pool_dir, component),
+            ):
+                return None
+            if arch == "all":
+                indexes.update((component, a) for a in self.archs)
+            elif arch in self.archs:
+                indexes.add((component, arch))
+            else:
+                return None
+        return indexes
+
+    def publish(self, filenames: set[str] | None) -> None:
+        """Reindex what filenames touch (None: everything), then release."""
+        start = time.monotonic()
+        indexes = None if filenames is None else self.affected(filenames)
+        with (
+            self.repo.staged(self.keep)
+            if self.staged
+            else contextlib.nullcontext()
+        ):
+            if indexes is None:
+                # directories created while events were lost are unwatched
+                self._watch_tree(self.pool_dir)
+                self.scan()
+                self.repo.index_all(self.archs)
+            else:
+                for component, arch in sorted(indexes):
+                    self.repo.index(component, arch)
+            self.repo.generate_release(signer=self.signer)
+        if not self.repo.quiet:
+            what = (
+                "all indexes"
+                if indexes is None
+                else ", ".join(f"{c}/binary-{a}" for c, a in sorted(indexes))
+            )
+            print(
+                f"Published {what} ({len(filenames or ())} change(s)) in"
+                f" {time.monotonic() - start:.1f}s",
+            )
+
+    def run(self, batches: int = 0) -> None:
+        """Publish everything, then each batch of changes as it completes.
+
+        A batch that fails to publish (a RepoError, e.g. from a corrupt
+        .deb or gpg, or an OSError, e.g. from a .deb removed while being
+        read or a full disk) is logged and its changes are added to the next
+        batch. Runs until interrupted, or for batches batches if given.
+        """
+        self._attempt(None)
+        done = 0
+        while not batches or done < batches:
+            filenames = self.wait_batch()
+            if filenames is None or filenames:
+                self._attempt(filenames)
+                done += 1
+
+    def _attempt(self, filenames: set[str] | None) -> None:
+        """publish() filenames and the failed ones; log errors, go on."""
+        if self.failed is None:
+            filenames = None
+        elif filenames is not None:
+            filenames = filenames | self.failed
+        try:
+            self.publish(filenames)
+        except (RepoError, OSError):
+            logger.exception("Publishing failed, retried with next batch")
+            self.failed = filenames
+        else:
+            self.failed = set()
+
+    def close(self) -> None:
+        self.inotify.close()
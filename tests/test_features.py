@@ -1,26 +1,58 @@
 """Tests for repo download, repo release --gen-key, and repo client-config."""
 from __future__ import annotations
 
+import errno
+import functools
+import hashlib
+import http.client
+import http.server
 import os
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import urllib.request
 from os.path import exists, join
+from typing import TYPE_CHECKING
 
 import pytest
 
-from repo_lib import RepoError, Repository
+if TYPE_CHECKING:
+    from collections.abc import Generator
+
+from repo_lib import RepoError, Repository, download, gpg
 from repo_lib.client import write_client_config
 from repo_lib.download import (
+    DebUri,
+    PoolLinker,
     copy_debs_to_pool,
+    deb_filename,
+    fetch_debs,
     installed_packages,
+    load_manifest,
+    parse_print_uris,
+    populate_pool,
+    populate_pool_batch,
     resolve_deps,
+    simulate_install,
 )
 from repo_lib.gpg import (
+    cached_key,
     cleanup_key,
+    default_key_cache_dir,
     export_public_key,
     gen_and_sign,
     gen_repo_key,
 )
+from repo_lib.resolve_cache import ResolveCache, lists_signature
+from repo_lib.resolver import (
+    LISTS_DIR,
+    Resolver,
+    load_lists,
+    parse_relations,
+    version_compare,
+)
 
 # conftest.py provides: tempdir, repo_root, indexed_root fixtures
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -94,6 +126,58 @@ class TestDownloadLib:
         # dpkg is always installed on Debian.
         assert "dpkg" in installed_packages()
 
+    def test_installed_packages_matches_dpkg_query(self) -> None:
+        # direct parse of the host's status file vs dpkg-query's view of
+        # installed packages
+        output = subprocess.run(
+            [
+                "/usr/bin/dpkg-query",
+                "--showformat=${Package} ${Status}\\n",
+                "--show",
+            ],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        expected = {
+            line.split()[0]
+            for line in output.splitlines()
+            if line.endswith(" installed")
+            and line.split()[1] in ("install", "hold")
+        }
+        assert installed_packages() == expected
+
+    def test_installed_packages_reads_root_status(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        os.makedirs(join(tempdir, "var", "lib", "dpkg"))
+        with open(join(tempdir, "var", "lib", "dpkg", "status"), "w") as fob:
+            fob.write(
+                "Package: kept\n"
+                "Status: install ok installed\n"
+                "Description: multi-line\n"
+                " Package: not-a-field\n"
+                "\n"
+                "Package: held\n"
+                "Status: hold ok installed\n"
+                "\n"
+                "Package: removing\n"
+                "Status: deinstall ok installed\n"
+                "\n"
+                "Package: removed\n"
+                "Status: deinstall ok config-files\n"
+                "\n"
+                "Package: half\n"
+                "Status: install ok half-configured\n"
+                "\n"
+                "Package: last\n"
+                "Status: install ok installed\n",
+            )
+
+        def no_spawn(*_args: object) -> str:
+            raise AssertionError("dpkg-query was run")
+
+        monkeypatch.setattr(download, "_run", no_spawn)
+        assert installed_packages(tempdir) == {"kept", "held", "last"}
+
     def test_copy_debs_to_pool_copies_files(self, tempdir: str) -> None:
         # Simulate a chroot apt cache by creating the expected directory tree.
         cache_dir = join(tempdir, "var", "cache", "apt", "archives")
@@ -145,6 +229,601 @@ class TestDownloadLib:
         assert not exists(join(pool_dir, "partial"))
 
 
+    @staticmethod
+    def _cache_with_deb(tempdir: str) -> tuple[str, str]:
+        cache_dir = join(tempdir, "var", "cache", "apt", "archives")
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(cache_dir)
+        os.makedirs(pool_dir)
+        with open(join(cache_dir, "pkg_1.0_amd64.deb"), "wb") as fob:
+            fob.write(b"deb content")
+        return cache_dir, pool_dir
+
+    def test_hardlink_mode_shares_inode(self, tempdir: str) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        assert copy_debs_to_pool(pool_dir, tempdir, link="hardlink") == 1
+        name = "pkg_1.0_amd64.deb"
+        assert os.path.samefile(join(cache_dir, name), join(pool_dir, name))
+
+    def test_copy_mode_makes_independent_file(self, tempdir: str) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        copy_debs_to_pool(pool_dir, tempdir, link="copy")
+        name = "pkg_1.0_amd64.deb"
+        assert not os.path.samefile(
+            join(cache_dir, name), join(pool_dir, name),
+        )
+        with open(join(pool_dir, name), "rb") as fob:
+            assert fob.read() == b"deb content"
+
+    def test_auto_mode_falls_back(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        _, pool_dir = self._cache_with_deb(tempdir)
+
+        def no_link(*_args: object) -> None:
+            raise OSError(errno.EXDEV, "cross-device link")
+
+        monkeypatch.setattr(download, "_reflink", no_link)
+        monkeypatch.setattr(os, "link", no_link)
+        linker = PoolLinker()
+        src = join(tempdir, "var", "cache", "apt", "archives")
+        method = linker.place(
+            join(src, "pkg_1.0_amd64.deb"), join(pool_dir, "pkg.deb"),
+        )
+        assert method == "copy"
+        assert list(linker.methods.values()) == ["copy"]
+
+    def test_reflink_mode_clones_or_raises(self, tempdir: str) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        name = "pkg_1.0_amd64.deb"
+        try:
+            method = PoolLinker("reflink").place(
+                join(cache_dir, name), join(pool_dir, name),
+            )
+        except RepoError:
+            assert not exists(join(pool_dir, name))
+        else:
+            assert method in ("reflink", "copy_file_range")
+            with open(join(pool_dir, name), "rb") as fob:
+                assert fob.read() == b"deb content"
+
+    @pytest.mark.parametrize("failure", ["exdev", "short"])
+    def test_reflink_failure_leaves_nothing(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch, failure: str,
+    ) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        name = "pkg_1.0_amd64.deb"
+
+        def no_reflink(*_args: object) -> None:
+            raise OSError(errno.EXDEV, "cross-device link")
+
+        def copy_file_range(*_args: object) -> int:
+            if failure == "exdev":
+                raise OSError(errno.EXDEV, "cross-device link")
+            return 0
+
+        monkeypatch.setattr(download, "_reflink", no_reflink)
+        monkeypatch.setattr(os, "copy_file_range", copy_file_range)
+        with pytest.raises(RepoError):
+            PoolLinker("reflink").place(
+                join(cache_dir, name), join(pool_dir, name),
+            )
+        assert os.listdir(pool_dir) == []
+
+    @pytest.mark.parametrize("mode", ["copy", "auto"])
+    def test_failed_copy_leaves_nothing(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch, mode: str,
+    ) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        name = "pkg_1.0_amd64.deb"
+
+        def no_link(*_args: object) -> None:
+            raise OSError(errno.EXDEV, "cross-device link")
+
+        def copy_fails(_src: str, dst: str) -> None:
+            with open(dst, "wb") as fob:
+                fob.write(b"deb")
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        monkeypatch.setattr(download, "_reflink", no_link)
+        monkeypatch.setattr(os, "link", no_link)
+        monkeypatch.setattr(shutil, "copy2", copy_fails)
+        with pytest.raises(OSError, match="No space left"):
+            PoolLinker(mode).place(join(cache_dir, name), join(pool_dir, name))
+        assert os.listdir(pool_dir) == []
+
+    def test_copies_only_requested_debs_without_listing(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        cache_dir, pool_dir = self._cache_with_deb(tempdir)
+        for name in ("stray_2.0_amd64.deb", "libfoo_1%3a2.0-1_all.deb"):
+            open(join(cache_dir, name), "w").close()
+
+        def no_listdir(path: str) -> list[str]:
+            raise AssertionError(f"cache directory listed: {path}")
+
+        monkeypatch.setattr(os, "listdir", no_listdir)
+        debs = {
+            ("pkg", "1.0", "amd64"),
+            ("libfoo", "1:2.0-1", "all"),
+            ("absent", "1.0", "amd64"),
+        }
+        assert copy_debs_to_pool(pool_dir, tempdir, debs=debs) == 2  # noqa: PLR2004
+        assert exists(join(pool_dir, "libfoo_1%3a2.0-1_all.deb"))
+        assert not exists(join(pool_dir, "stray_2.0_amd64.deb"))
+
+    def test_simulate_install_parses_inst_lines(
+        self, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        output = (
+            "NOTE: This is only a simulation!\n"
+            "Inst libfoo1 (1:2.0-1 Debian:13.0/stable [amd64])\n"
+            "Inst foo-data [1.0-1] (1.1-1 Debian:13.0/stable [all])"
+            " []\n"
+            "Inst libbar:i386 (3.0 Debian:13.0/stable [i386])\n"
+            "Conf libfoo1 (1:2.0-1 Debian:13.0/stable [amd64])\n"
+        )
+        monkeypatch.setattr(download, "_run", lambda *_args: output)
+        assert simulate_install(["libfoo1"]) == {
+            ("libfoo1", "1:2.0-1", "amd64"),
+            ("foo-data", "1.1-1", "all"),
+            ("libbar", "3.0", "i386"),
+        }
+        assert deb_filename("libfoo1", "1:2.0-1", "amd64") == (
+            "libfoo1_1%3a2.0-1_amd64.deb"
+        )
+
+    def test_unknown_link_mode_raises(self) -> None:
+        with pytest.raises(RepoError, match="unknown link mode"):
+            PoolLinker("symlink")
+
+
+LISTS = """\
+Package: app
+Version: 1.0
+Architecture: amd64
+Depends: libfoo (>= 2.0), mail-transport-agent | exim4, helper | other
+Pre-Depends: base
+
+Package: libfoo
+Version: 1.5
+Architecture: amd64
+
+Package: libfoo
+Version: 2.1
+Architecture: amd64
+Depends: base
+
+Package: libfoo
+Version: 9.0
+Architecture: arm64
+
+Package: postfix
+Version: 3.0
+Architecture: amd64
+Provides: mail-transport-agent
+
+Package: exim4
+Version: 4.0
+Architecture: all
+
+Package: helper
+Version: 1:0.1
+Architecture: all
+Depends: other (<< 1.0)
+
+Package: other
+Version: 2.0
+Architecture: amd64
+
+Package: base
+Version: 1.0
+Architecture: amd64
+Depends: base-loop
+
+Package: base-loop
+Version: 1.0
+Architecture: all
+Depends: base
+"""
+
+
+@pytest.fixture
+def lists_root(tempdir: str) -> str:
+    lists_dir = join(tempdir, LISTS_DIR)
+    os.makedirs(lists_dir)
+    lists_file = join(lists_dir, "deb.example_dists_trixie_main_Packages")
+    with open(lists_file, "w") as fob:
+        fob.write(LISTS)
+    return tempdir
+
+
+class TestNativeResolver:
+    @pytest.mark.parametrize(
+        ("a", "b"),
+        [
+            ("1.0", "1.0-1"),
+            ("1.0~rc1", "1.0"),
+            ("1.0", "1:0.1"),
+            ("1.0-9", "1.0-10"),
+            ("1.0a", "1.0+b1"),
+            ("1.0", "1.0.1"),
+            ("1~~", "1~~a"),
+        ],
+    )
+    def test_version_compare_like_dpkg(self, a: str, b: str) -> None:
+        assert version_compare(a, b) < 0
+        assert version_compare(b, a) > 0
+        assert version_compare(a, a) == 0
+        result = subprocess.run(
+            ["/usr/bin/dpkg", "--compare-versions", a, "lt", b],
+            check=False,
+        )
+        assert result.returncode == 0
+
+    def test_closure_with_versions_and_alternatives(
+        self, lists_root: str,
+    ) -> None:
+        resolver = Resolver(load_lists(lists_root, "amd64"))
+        assert resolver.lists.packages["libfoo"].version == "2.1"
+        # virtual mail-transport-agent -> postfix, not the exim4
+        # alternative; helper's 'other (<< 1.0)' is unsatisfiable
+        assert resolver.resolve(["app"]) == {
+            "app", "libfoo", "base", "base-loop", "postfix", "helper",
+        }
+
+    def test_installed_alternative_preferred(self, lists_root: str) -> None:
+        resolver = Resolver(load_lists(lists_root, "amd64"), {"exim4"})
+        closure = resolver.resolve(["app"])
+        assert "exim4" in closure
+        assert "postfix" not in closure
+
+    def test_closures_are_memoized(self, lists_root: str) -> None:
+        resolver = Resolver(load_lists(lists_root, "amd64"))
+        resolver.resolve(["app"])
+        assert resolver.closures["base"] == resolver.closures["base-loop"]
+        assert resolver.closures["base"] == {"base", "base-loop"}
+
+    def test_unknown_package_raises(self, lists_root: str) -> None:
+        resolver = Resolver(load_lists(lists_root, "amd64"))
+        with pytest.raises(RepoError, match="not found"):
+            resolver.resolve(["no-such-package"])
+
+    def test_missing_lists_raise(self, tempdir: str) -> None:
+        with pytest.raises(RepoError, match="no Packages lists"):
+            load_lists(tempdir, "amd64")
+
+    def test_parse_relations(self) -> None:
+        assert parse_relations("a (>= 1:2), b:any | c [amd64] <!nocheck>") == [
+            [("a", ">=", "1:2")],
+            [("b", "", ""), ("c", "", "")],
+        ]
+
+
+class TestResolveCache:
+    def test_get_or_compute_stores_result(self, tempdir: str) -> None:
+        cache = ResolveCache(join(tempdir, "cache"))
+        calls = []
+
+        def compute() -> set[str]:
+            calls.append(1)
+            return {"a", "b"}
+
+        assert cache.get_or_compute(["x"], compute) == {"a", "b"}
+        assert cache.get_or_compute(["x"], compute) == {"a", "b"}
+        assert len(calls) == 1
+        assert ResolveCache(join(tempdir, "cache")).get(cache.key("x")) == {
+            "a", "b",
+        }
+
+    def test_lists_signature_follows_lists(self, lists_root: str) -> None:
+        before = lists_signature(lists_root)
+        assert lists_signature(lists_root) == before
+        lists_dir = join(lists_root, LISTS_DIR)
+        with open(join(lists_dir, "other_Packages"), "w") as fob:
+            fob.write("")
+        assert lists_signature(lists_root) != before
+
+    def test_least_recently_used_evicted(self, tempdir: str) -> None:
+        cache = ResolveCache(join(tempdir, "cache"), max_bytes=10**6)
+        for i, key in enumerate(("old", "used", "new")):
+            cache.put(key, [f"pkg{n}" for n in range(100)])
+            path = join(cache.cache_dir, f"{key}.json")
+            os.utime(path, (i, i))
+        cache.get("old")  # now the most recently used
+        size = os.path.getsize(join(cache.cache_dir, "old.json"))
+        cache.max_bytes = size * 2
+        cache.evict()
+        assert cache.get("used") is None
+        assert cache.get("old") is not None
+        assert cache.get("new") is not None
+
+    def test_hit_in_read_only_cache(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        cache = ResolveCache(join(tempdir, "cache"))
+        cache.put("key", ["a"])
+
+        def denied(*_args: object) -> None:
+            raise PermissionError(13, "Permission denied")
+
+        monkeypatch.setattr(os, "utime", denied)
+        assert cache.get("key") == {"a"}
+
+    def test_download_resolution_cached(
+        self,
+        lists_root: str,
+        tempdir: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        monkeypatch.setenv("XDG_CACHE_HOME", join(tempdir, "xdg"))
+        monkeypatch.setattr(download, "installed_packages", lambda _: set())
+        calls = []
+        real = download.resolve_deps_native
+
+        def counting(*args: object) -> set[str]:
+            calls.append(1)
+            return real(*args)  # type: ignore[arg-type]
+
+        monkeypatch.setattr(download, "resolve_deps_native", counting)
+        args = (["app"], lists_root, "native", "amd64", True)
+        first = download.resolve_packages(*args)
+        assert download.resolve_packages(*args) == first
+        assert len(calls) == 1
+        # new lists invalidate the cached closure
+        lists_file = join(
+            lists_root, LISTS_DIR, "deb.example_dists_trixie_main_Packages",
+        )
+        os.replace(lists_file, f"{lists_file}.new")
+        os.replace(f"{lists_file}.new", lists_file)
+        os.utime(lists_file, (1, 1))
+        download.resolve_packages(*args)
+        assert len(calls) == 2  # noqa: PLR2004
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *_args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def http_dir(tempdir: str) -> Generator[tuple[str, str]]:
+    """Serve a directory over HTTP; yield (directory, base URL)."""
+    served = join(tempdir, "mirror")
+    os.makedirs(served)
+    handler = functools.partial(_QuietHandler, directory=served)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield served, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _mirror_deb(
+    served: str, url: str, name: str, content: bytes,
+) -> DebUri:
+    with open(join(served, name), "wb") as fob:
+        fob.write(content)
+    return DebUri(
+        f"{url}/{name}",
+        name,
+        len(content),
+        "sha256",
+        hashlib.sha256(content).hexdigest(),
+    )
+
+
+class TestDirectDownload:
+    def test_parse_print_uris(self) -> None:
+        output = (
+            "'http://deb.debian.org/debian/pool/main/c/curl/"
+            "curl_8.14.1-2_amd64.deb' curl_8.14.1-2_amd64.deb 269340"
+            " SHA256:ABCDEF0123\n"
+            "'http://deb.debian.org/debian/pool/main/libz/zlib1g_1%3a1.3_amd64"
+            ".deb' zlib1g_1%3a1.3_amd64.deb 88 SHA512:0f\n"
+        )
+        debs = parse_print_uris(output)
+        assert debs[0] == DebUri(
+            "http://deb.debian.org/debian/pool/main/c/curl/"
+            "curl_8.14.1-2_amd64.deb",
+            "curl_8.14.1-2_amd64.deb",
+            269340,
+            "sha256",
+            "abcdef0123",
+        )
+        assert debs[1].filename == "zlib1g_1%3a1.3_amd64.deb"
+        assert debs[1].hash_type == "sha512"
+
+    def test_parse_print_uris_without_hash_raises(self) -> None:
+        with pytest.raises(RepoError, match="no usable hash"):
+            parse_print_uris("'http://h/a_1_all.deb' a_1_all.deb 10\n")
+
+    def test_fetches_and_verifies(
+        self, http_dir: tuple[str, str], tempdir: str,
+    ) -> None:
+        served, url = http_dir
+        debs = [
+            _mirror_deb(served, url, f"pkg{i}_1.0_amd64.deb", b"x" * i)
+            for i in range(1, 11)
+        ]
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(pool_dir)
+        assert fetch_debs(debs, pool_dir, jobs=4) == len(debs)
+        for deb in debs:
+            with open(join(pool_dir, deb.filename), "rb") as fob:
+                assert fob.read() == b"x" * deb.size
+        assert not [n for n in os.listdir(pool_dir) if n.endswith(".tmp")]
+
+    def test_valid_files_are_skipped_invalid_replaced(
+        self, http_dir: tuple[str, str], tempdir: str,
+    ) -> None:
+        served, url = http_dir
+        good = _mirror_deb(served, url, "good_1_all.deb", b"good")
+        bad = _mirror_deb(served, url, "bad_1_all.deb", b"fresh")
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(pool_dir)
+        with open(join(pool_dir, good.filename), "wb") as fob:
+            fob.write(b"good")
+        with open(join(pool_dir, bad.filename), "wb") as fob:
+            fob.write(b"stale")
+        assert fetch_debs([good, bad], pool_dir) == 1
+        with open(join(pool_dir, bad.filename), "rb") as fob:
+            assert fob.read() == b"fresh"
+
+    def test_concurrent_run_partial_file_untouched(
+        self, http_dir: tuple[str, str], tempdir: str,
+    ) -> None:
+        served, url = http_dir
+        deb = _mirror_deb(served, url, "pkg_1_all.deb", b"content")
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(pool_dir)
+        # another run's download in progress
+        other = join(pool_dir, f"{deb.filename}.tmp")
+        with open(other, "wb") as fob:
+            fob.write(b"cont")
+        assert fetch_debs([deb], pool_dir) == 1
+        with open(other, "rb") as fob:
+            assert fob.read() == b"cont"
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = os.stat(join(pool_dir, deb.filename)).st_mode & 0o777
+        assert mode == 0o666 & ~umask
+        assert sorted(os.listdir(pool_dir)) == [
+            deb.filename, f"{deb.filename}.tmp",
+        ]
+
+    def test_hash_mismatch_raises(
+        self, http_dir: tuple[str, str], tempdir: str,
+    ) -> None:
+        served, url = http_dir
+        deb = _mirror_deb(served, url, "pkg_1_all.deb", b"content")
+        with open(join(served, deb.filename), "wb") as fob:
+            fob.write(b"CONTENT")
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(pool_dir)
+        with pytest.raises(RepoError, match="mismatch"):
+            fetch_debs([deb], pool_dir)
+        assert os.listdir(pool_dir) == []
+
+    def test_missing_file_raises(
+        self, http_dir: tuple[str, str], tempdir: str,
+    ) -> None:
+        _, url = http_dir
+        deb = DebUri(
+            f"{url}/gone_1_all.deb", "gone_1_all.deb", 1, "sha256", "0",
+        )
+        with pytest.raises(RepoError, match="failed"):
+            fetch_debs([deb], tempdir)
+        assert not [n for n in os.listdir(tempdir) if n.endswith(".tmp")]
+
+    def test_dropped_connection_retried(
+        self,
+        http_dir: tuple[str, str],
+        tempdir: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        served, url = http_dir
+        deb = _mirror_deb(served, url, "pkg_1_all.deb", b"content")
+        real_urlopen = urllib.request.urlopen
+        calls = []
+
+        def urlopen(uri: str, timeout: float) -> object:
+            calls.append(uri)
+            if len(calls) == 1:
+                raise http.client.IncompleteRead(b"cont", 3)
+            return real_urlopen(uri, timeout=timeout)
+
+        monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+        pool_dir = join(tempdir, "pool")
+        os.makedirs(pool_dir)
+        assert fetch_debs([deb], pool_dir) == 1
+        assert len(calls) == 2  # noqa: PLR2004
+        assert os.listdir(pool_dir) == [deb.filename]
+
+    def test_interrupted_download_leaves_nothing(
+        self, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        deb = DebUri(
+            "http://h/pkg_1_all.deb", "pkg_1_all.deb", 1, "sha256", "0",
+        )
+
+        def urlopen(*_args: object, **_kwargs: object) -> None:
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+        with pytest.raises(KeyboardInterrupt):
+            download.fetch_deb(deb, tempdir)
+        assert os.listdir(tempdir) == []
+
+    def test_batch_fetches_shared_debs_once(
+        self,
+        http_dir: tuple[str, str],
+        repo_root: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        served, url = http_dir
+        mirror = {
+            name: _mirror_deb(
+                served, url, f"{name}_1_amd64.deb", name.encode(),
+            )
+            for name in ("libc", "web", "db", "tool")
+        }
+        closures = {
+            "/img/web": ({"tool"}, {"libc", "web", "tool"}),
+            "/img/db": (set(), {"libc", "db"}),
+        }
+        monkeypatch.setattr(
+            download,
+            "resolve_packages",
+            lambda _packages, chroot, *_args: closures[chroot],
+        )
+        listed = []
+
+        def print_uris(packages: list[str], chroot: str) -> list[DebUri]:
+            listed.append(chroot)
+            return [mirror[name] for name in packages]
+
+        fetched = []
+        real_fetch = download.fetch_deb
+
+        def fetch_deb(deb: DebUri, pool_component: str) -> bool:
+            fetched.append(deb.filename)
+            return real_fetch(deb, pool_component)
+
+        monkeypatch.setattr(download, "print_uris", print_uris)
+        monkeypatch.setattr(download, "fetch_deb", fetch_deb)
+        coverage = populate_pool_batch(
+            repo_root,
+            "pool",
+            "main",
+            {"/img/web": ["web"], "/img/db": ["db"]},
+            jobs=2,
+        )
+        assert listed == ["/img/web", "/img/db"]
+        assert sorted(fetched) == [
+            "db_1_amd64.deb", "libc_1_amd64.deb", "web_1_amd64.deb",
+        ]
+        assert coverage["/img/web"] == (3, 1, 2, 1, 2)
+        assert coverage["/img/db"] == (2, 0, 2, 1, 2)
+
+    def test_load_manifest(self, tempdir: str) -> None:
+        manifest = join(tempdir, "manifest.json")
+        with open(manifest, "w") as fob:
+            fob.write('{"/img/a": ["curl"], "/img/b": []}')
+        assert load_manifest(manifest) == {"/img/a": ["curl"], "/img/b": []}
+        with open(manifest, "w") as fob:
+            fob.write('{"/img/a": "curl"}')
+        with pytest.raises(RepoError, match="must map"):
+            load_manifest(manifest)
+
+    def test_unknown_engine_raises(self, repo_root: str) -> None:
+        with pytest.raises(RepoError, match="unknown download engine"):
+            populate_pool(repo_root, "pool", "main", ["bash"], engine="bogus")
+
+
 class TestDownloadCli:
     def test_cli_download_missing_args_exits_nonzero(self) -> None:
         result = run_repo("download")
@@ -156,6 +835,28 @@ class TestDownloadCli:
         result = run_repo("download", repo_root, "trixie", "main", "amd64")
         assert result.returncode != 0
 
+    @pytest.mark.parametrize(
+        ("options", "error"),
+        [
+            (("--chroot", "a", "--chroot", "b", "--engine", "apt"),
+             "--engine apt does not apply"),
+            (("--chroot", "a", "--chroot", "b", "--link", "copy"),
+             "--link only applies"),
+            (("--engine", "direct", "--link", "copy"),
+             "--link only applies"),
+        ],
+    )
+    def test_cli_download_rejects_unused_options(
+        self, repo_root: str, options: tuple[str, ...], error: str,
+    ) -> None:
+        result = run_repo(
+            "download", repo_root, "trixie", "main", "amd64", "pkg",
+            *options,
+        )
+        assert result.returncode != 0
+        assert error in result.stderr
+        assert not os.listdir(join(repo_root, "pool", "main"))
+
 
 class TestGpgLib:
     def test_gen_repo_key_creates_homedir(self, repo_root: str) -> None:
@@ -231,6 +932,216 @@ class TestGpgLib:
             assert not exists(d), f"private key homedir not cleaned up: {d}"
 
 
+def _fingerprint(gnupghome: str) -> tuple[str, str]:
+    """Return (algorithm id, fingerprint) of the key in gnupghome."""
+    listing = subprocess.run(
+        [
+            "/usr/bin/gpg", "--homedir", gnupghome, "--with-colons",
+            "--list-secret-keys",
+        ],
+        capture_output=True, text=True, check=True,
+    ).stdout.splitlines()
+    sec = next(line.split(":") for line in listing if line.startswith("sec"))
+    fpr = next(line.split(":") for line in listing if line.startswith("fpr"))
+    return sec[3], fpr[9]
+
+
+class TestKeyCache:
+    def test_ed25519_key(self, repo_root: str) -> None:
+        gnupghome, _ = gen_repo_key(repo_root, "1d", "ed25519")
+        try:
+            assert _fingerprint(gnupghome)[0] == "22"  # EdDSA
+        finally:
+            cleanup_key(gnupghome)
+
+    def test_key_reused_within_ttl(self, tempdir: str) -> None:
+        cache_dir = join(tempdir, "keys")
+        with cached_key(60, "1d", "ed25519", cache_dir) as (gnupghome, uid):
+            first = _fingerprint(gnupghome)
+        assert os.stat(cache_dir).st_mode & 0o777 == 0o700  # noqa: PLR2004
+        with cached_key(60, "1d", "ed25519", cache_dir) as (again, _):
+            assert again == gnupghome
+            assert _fingerprint(again) == first
+        # expired: deleted and replaced by a new key
+        with open(join(gnupghome, "expires"), "w") as fob:
+            fob.write(str(time.time() - 1))
+        with cached_key(60, "1d", "ed25519", cache_dir) as (renewed, _):
+            assert _fingerprint(renewed) != first
+        assert os.listdir(cache_dir) == [".lock", "ed25519-1d"]
+        assert "Repo Signing Key" in uid
+
+    def test_short_ttl_keeps_longer_lived_keys(self, tempdir: str) -> None:
+        cache_dir = join(tempdir, "keys")
+        with cached_key(600, "1d", "ed25519", cache_dir) as (gnupghome, _):
+            first = _fingerprint(gnupghome)
+        with cached_key(0.001, "2d", "ed25519", cache_dir):
+            pass
+        time.sleep(0.01)
+        # the 2d key has expired, the 1d one has not, whatever this ttl
+        with cached_key(0.001, "1d", "ed25519", cache_dir) as (again, _):
+            assert _fingerprint(again) == first
+        assert sorted(os.listdir(cache_dir)) == [".lock", "ed25519-1d"]
+
+    def test_no_runtime_dir_no_cache(
+        self, repo_root: str, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        home = join(tempdir, "home")
+        os.makedirs(home)
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setenv("XDG_CACHE_HOME", join(home, ".cache"))
+        monkeypatch.setenv("HOME", home)
+        assert not default_key_cache_dir()
+        with pytest.raises(RepoError, match="XDG_RUNTIME_DIR"), cached_key(60):
+            pass
+        repo = Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        )
+        repo.index("main", "amd64")
+        gen_and_sign(repo, "1d", "ed25519", key_ttl=60)
+        assert exists(join(repo_root, "repo.asc"))
+        assert os.listdir(home) == []
+
+    def test_cli_release_reuses_cached_key(
+        self, repo_root: str, tempdir: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        ).index("main", "amd64")
+        monkeypatch.setenv("XDG_RUNTIME_DIR", tempdir)
+        asc = []
+        for _ in range(2):
+            result = run_repo(
+                "release", repo_root, "trixie", "--gen-key",
+                "--key-algo", "ed25519", "--key-cache-ttl", "600",
+            )
+            assert result.returncode == 0, result.stderr
+            with open(join(repo_root, "repo.asc")) as fob:
+                asc.append(fob.read())
+        assert asc[0] == asc[1]
+        assert exists(
+            join(tempdir, "repo", "keys", "ed25519-10y", "pubring.kbx"),
+        )
+
+
+class TestSigningSession:
+    @pytest.fixture
+    def signing_key(self, repo_root: str) -> Generator[tuple[str, str]]:
+        gnupghome, uid = gen_repo_key(repo_root)
+        yield gnupghome, uid
+        cleanup_key(gnupghome)
+
+    @staticmethod
+    def _verify(gnupghome: str, *files: str) -> None:
+        result = subprocess.run(
+            ["/usr/bin/gpg", "--homedir", gnupghome, "--verify", *files],
+            capture_output=True, text=True, check=False,
+        )
+        assert result.returncode == 0, result.stderr
+
+    def test_one_gpg_run_signs_both(
+        self,
+        repo_root: str,
+        signing_key: tuple[str, str],
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        gnupghome, uid = signing_key
+        Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        ).index("main", "amd64")
+        commands: list[list[str]] = []
+        real_run_cmd = gpg.run_cmd
+
+        def counting_run_cmd(cmd: list[str], **kwargs: object) -> str:
+            commands.append(cmd)
+            return real_run_cmd(cmd, **kwargs)  # type: ignore[arg-type]
+
+        monkeypatch.setattr(gpg, "run_cmd", counting_run_cmd)
+        Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+        ).generate_release(uid, gnupghome)
+        assert len(commands) == 1
+        dist_dir = join(repo_root, "dists", "trixie")
+        self._verify(gnupghome, join(dist_dir, "InRelease"))
+        self._verify(
+            gnupghome,
+            join(dist_dir, "Release.gpg"),
+            join(dist_dir, "Release"),
+        )
+        with open(join(dist_dir, "InRelease")) as fob:
+            assert fob.read().startswith(
+                "-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n"
+                "Origin: origin\n",
+            )
+        assert not exists(join(dist_dir, "InRelease.tmp"))
+
+    def test_suites_share_one_key(
+        self, repo_root: str, tempdir: str,
+    ) -> None:
+        suites = ("bookworm", "trixie")
+        repos = [
+            Repository(
+                repo_root, suite, "pool", "1.0", "origin", quiet=True,
+                backend="native",
+            )
+            for suite in suites
+        ]
+        for repo in repos:
+            repo.index("main", "amd64")
+        gen_and_sign(repos, "1d", "ed25519")
+        # verify against the exported public key only
+        verify_home = join(tempdir, "verify")
+        os.makedirs(verify_home, mode=0o700)
+        subprocess.run(
+            [
+                "/usr/bin/gpg", "--homedir", verify_home, "--import",
+                join(repo_root, "repo.asc"),
+            ],
+            capture_output=True, check=True,
+        )
+        for suite in suites:
+            dist_dir = join(repo_root, "dists", suite)
+            self._verify(verify_home, join(dist_dir, "InRelease"))
+            self._verify(
+                verify_home,
+                join(dist_dir, "Release.gpg"),
+                join(dist_dir, "Release"),
+            )
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "Origin: x\n-----BEGIN dashes\n abc 1 main/Packages\n",
+            "Origin: x\nArchitectures: \nComponents: main\n",
+        ],
+        ids=["dash-escaped", "trailing-whitespace"],
+    )
+    def test_signatures_verify(
+        self, tempdir: str, signing_key: tuple[str, str], text: str,
+    ) -> None:
+        gnupghome, uid = signing_key
+        release = join(tempdir, "Release")
+        with open(release, "w") as fob:
+            fob.write(text)
+        gpg.SigningSession(uid, gnupghome).sign(release, text)
+        self._verify(gnupghome, join(tempdir, "InRelease"))
+        self._verify(gnupghome, join(tempdir, "Release.gpg"), release)
+        content = subprocess.run(
+            [
+                "/usr/bin/gpg", "--homedir", gnupghome, "--decrypt",
+                join(tempdir, "InRelease"),
+            ],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        # gpg --clearsign drops trailing whitespace, as verifying does
+        lines = content.rstrip("\n").splitlines()
+        assert [line.rstrip() for line in lines] == [
+            line.rstrip() for line in text.splitlines()
+        ]
+
+
 class TestGpgCli:
     def test_cli_release_gen_key_creates_repo_asc(
         self, indexed_root: str,
@@ -1,19 +1,50 @@
 """Regression tests for repo index and repo release."""
 from __future__ import annotations
 
+import bz2
+import gzip
+import hashlib
+import importlib.util
+import json
+import lzma
 import os
+import runpy
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 from os.path import exists, join
 from typing import TYPE_CHECKING
 
 import pytest
 
 if TYPE_CHECKING:
-    from collections.abc import Generator
+    from collections.abc import Callable, Generator
 
-from repo_lib import RepoError, Repository
+from repo_lib import (
+    BY_HASH_KEEP,
+    RepoError,
+    Repository,
+    deb,
+    generate_releases,
+    instrument,
+    manifest,
+    run_cmd,
+)
+from repo_lib.deb import deb_stanza, read_deb
+from repo_lib.packages import (
+    PackagesCache,
+    arch_matches,
+    deb_archs,
+    iter_stanzas,
+    parallel_map,
+    stanza_filename,
+    walk_debs,
+)
+from repo_lib.pool_gc import collect_garbage, plan_gc
+from repo_lib.watch import PoolWatcher
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -49,7 +80,13 @@ def run_repo(*args: str) -> subprocess.CompletedProcess[str]:
     )
 
 
-def build_deb(dest_dir: str, name: str, version: str, arch: str) -> str:
+def build_deb(
+    dest_dir: str,
+    name: str,
+    version: str,
+    arch: str,
+    compression: str = "",
+) -> str:
     # Build a minimal but valid .deb with dpkg-deb so apt-ftparchive has
     # real package metadata to index.
     build_dir = join(dest_dir, f"{name}-build")
@@ -66,8 +103,9 @@ def build_deb(dest_dir: str, name: str, version: str, arch: str) -> str:
             ],
         )
     deb_path = join(dest_dir, f"{name}_{version}_{arch}.deb")
+    compress_args = [f"-Z{compression}"] if compression else []
     subprocess.run(
-        ["/usr/bin/dpkg-deb", "--build", build_dir, deb_path],
+        ["/usr/bin/dpkg-deb", *compress_args, "--build", build_dir, deb_path],
         capture_output=True,
         text=True,
         check=True,
@@ -75,6 +113,11 @@ def build_deb(dest_dir: str, name: str, version: str, arch: str) -> str:
     return deb_path
 
 
+def _read(directory: str, name: str) -> bytes:
+    with open(join(directory, name), "rb") as fob:
+        return fob.read()
+
+
 def gen_signing_key(gnupghome: str, uid: str) -> None:
     # Generate a throwaway, passphraseless signing key in an isolated
     # GNUPGHOME so the release signing path can be exercised without
@@ -206,6 +249,23 @@ class TestIndex:
         result = run_repo("index", repo_root, "trixie", "main", "amd64")
         assert result.returncode == 0
 
+    @pytest.mark.parametrize(
+        ("options", "warned"),
+        [
+            ((), True),
+            (("--incremental",), False),
+            (("--backend", "native"), False),
+        ],
+    )
+    def test_cli_jobs_ignored_warns(
+        self, repo_root: str, options: tuple[str, ...], warned: bool,
+    ) -> None:
+        result = run_repo(
+            "index", repo_root, "trixie", "main", "amd64", "-j", "4",
+            *options,
+        )
+        assert ("--jobs has no effect" in result.stderr) == warned
+
     def test_cli_no_subcommand_exits_nonzero(self) -> None:
         result = run_repo()
         assert result.returncode != 0
@@ -233,6 +293,1362 @@ class TestIndex:
         assert result.returncode != 0
 
 
+class TestIncrementalIndex:
+    @staticmethod
+    def _packages(root: str) -> bytes:
+        path = join(root, "dists", "trixie", "main", "binary-amd64")
+        with open(join(path, "Packages"), "rb") as fob:
+            return fob.read()
+
+    @staticmethod
+    def _filenames(packages: bytes) -> list[str]:
+        return [
+            line.split(": ", 1)[1]
+            for line in packages.decode().splitlines()
+            if line.startswith("Filename: ")
+        ]
+
+    def test_output_matches_full_index(self, populated_root: str) -> None:
+        pool_main = join(populated_root, "pool", "main")
+        # created out of order, some in subdirectories, so readdir order
+        # differs from Filename order on most filesystems
+        for name, version, arch in (
+            ("zed", "1.0", "amd64"),
+            ("otherpkg", "2.0", "all"),
+            ("abc", "1.0", "amd64"),
+            ("armpkg", "1.0", "arm64"),
+        ):
+            build_dir = join(populated_root, f"build-{name}")
+            os.makedirs(build_dir)
+            directory = join(pool_main, name[0], name)
+            os.makedirs(directory)
+            shutil.move(build_deb(build_dir, name, version, arch), directory)
+        Repository(populated_root, "trixie", "pool", "1.0", "origin").index(
+            "main", "amd64",
+        )
+        full = self._packages(populated_root)
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            incremental=True,
+        ).index("main", "amd64")
+        incremental = self._packages(populated_root)
+        assert incremental == full
+        filenames = self._filenames(incremental)
+        assert filenames == sorted(filenames)
+
+    def test_stanzas_sorted_whatever_the_walk_order(
+        self,
+        populated_root: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        pool_main = join(populated_root, "pool", "main")
+        for name in ("zed", "abc", "mmm"):
+            with open(join(pool_main, f"{name}_1_amd64.deb"), "w") as fob:
+                fob.write(name)
+        real_walk_debs = walk_debs
+
+        def reversed_walk(
+            repo_path: str, component_dir: str,
+        ) -> list[tuple[str, os.stat_result]]:
+            return sorted(real_walk_debs(repo_path, component_dir))[::-1]
+
+        repo = Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            incremental=True,
+        )
+        monkeypatch.setattr("repo_lib.walk_debs", reversed_walk)
+        monkeypatch.setattr(
+            repo,
+            "_archive_cmd",
+            lambda _command, filename, _arch="": (
+                f"Package: {os.path.basename(filename).split('_')[0]}\n"
+                f"Filename: {filename}\n\n"
+            ),
+        )
+        repo.index("main", "amd64")
+        assert self._filenames(self._packages(populated_root)) == [
+            "pool/main/abc_1_amd64.deb",
+            "pool/main/mmm_1_amd64.deb",
+            "pool/main/testpkg_1.2.3_amd64.deb",
+            "pool/main/zed_1_amd64.deb",
+        ]
+
+    def test_only_changed_debs_are_read(
+        self,
+        populated_root: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        repo = Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            incremental=True,
+        )
+        repo.index("main", "amd64")
+        build_deb(join(populated_root, "pool", "main"), "newpkg", "1", "amd64")
+
+        scanned: list[str] = []
+        real_archive_cmd = repo._archive_cmd  # noqa: SLF001
+
+        def spy(command: str, input_str: str, arch: str = "") -> str:
+            scanned.append(input_str)
+            return real_archive_cmd(command, input_str, arch)
+
+        monkeypatch.setattr(repo, "_archive_cmd", spy)
+        repo.index("main", "amd64")
+        assert scanned == ["pool/main/newpkg_1_amd64.deb"]
+        content = self._packages(populated_root).decode()
+        assert "Package: testpkg\n" in content
+        assert "Package: newpkg\n" in content
+
+    def test_cache_entry_invalidated_by_change(self, tempdir: str) -> None:
+        deb = join(tempdir, "pkg_1_amd64.deb")
+        with open(deb, "w") as fob:
+            fob.write("one")
+        cache = PackagesCache(join(tempdir, "cache.json"))
+        cache.put("pkg_1_amd64.deb", os.stat(deb), "Package: pkg\n\n")
+        cache.save()
+
+        cache = PackagesCache(join(tempdir, "cache.json"))
+        assert cache.get("pkg_1_amd64.deb", os.stat(deb)) == (
+            "Package: pkg\n\n"
+        )
+        with open(deb, "w") as fob:
+            fob.write("changed")
+        assert cache.get("pkg_1_amd64.deb", os.stat(deb)) is None
+
+    def test_walk_debs_finds_nested_debs(self, repo_root: str) -> None:
+        nested = join(repo_root, "pool", "main", "p", "pkg")
+        os.makedirs(nested)
+        for name in ("pkg_1_amd64.deb", "README"):
+            open(join(nested, name), "w").close()
+        found = [name for name, _ in walk_debs(repo_root, "pool/main")]
+        assert found == ["pool/main/p/pkg/pkg_1_amd64.deb"]
+
+    def test_arch_matches_like_apt_ftparchive(self) -> None:
+        assert arch_matches("pool/main/a_1_amd64.deb", "amd64")
+        assert arch_matches("pool/main/a_1_all.deb", "amd64")
+        assert not arch_matches("pool/main/a_1_arm64.deb", "amd64")
+
+    @pytest.mark.parametrize("size", [1, 2, 7, 1000])
+    def test_iter_stanzas_independent_of_chunking(self, size: int) -> None:
+        text = "Package: a\nFilename: a\n\nPackage: b\n\n\nPackage: c\n\n"
+        chunks = [text[i : i + size] for i in range(0, len(text), size)]
+        stanzas = list(iter_stanzas(chunks))
+        assert stanzas == list(iter_stanzas([text]))
+        assert "".join(stanzas) == text
+        assert [stanza_filename(stanza) for stanza in stanzas] == ["a", "", ""]
+
+
+class TestNativeBackend:
+    @pytest.mark.parametrize("compression", ["gzip", "xz", "none"])
+    def test_read_deb_control_and_hashes(
+        self, tempdir: str, compression: str,
+    ) -> None:
+        deb = build_deb(tempdir, "testpkg", "1.2.3", "amd64", compression)
+        control, size, digests = read_deb(deb)
+        assert "Package: testpkg\n" in control
+        with open(deb, "rb") as fob:
+            data = fob.read()
+        assert size == len(data)
+        assert digests["MD5sum"] == hashlib.md5(data).hexdigest()  # noqa: S324
+        assert digests["SHA256"] == hashlib.sha256(data).hexdigest()
+        assert digests["SHA512"] == hashlib.sha512(data).hexdigest()
+
+    def test_stanza_field_order(self, tempdir: str) -> None:
+        deb = build_deb(tempdir, "testpkg", "1.2.3", "amd64")
+        stanza = deb_stanza(deb, "pool/main/testpkg_1.2.3_amd64.deb")
+        names = [
+            line.split(":", 1)[0]
+            for line in stanza.splitlines()
+            if line and not line[0].isspace()
+        ]
+        assert names == [
+            "Package", "Architecture", "Version", "Maintainer",
+            "Filename", "Size", "MD5sum", "SHA1", "SHA256", "SHA512",
+            "Description",
+        ]
+        assert stanza.endswith("\n\n")
+
+    def test_not_a_deb_raises(self, tempdir: str) -> None:
+        bogus = join(tempdir, "bogus_1_amd64.deb")
+        with open(bogus, "w") as fob:
+            fob.write("not an ar archive")
+        with pytest.raises(RepoError, match="not a Debian package"):
+            read_deb(bogus)
+
+    @pytest.mark.parametrize("keep", [150, -10])
+    def test_truncated_deb_raises(self, tempdir: str, keep: int) -> None:
+        deb = build_deb(tempdir, "testpkg", "1.2.3", "amd64")
+        with open(deb, "rb") as fob:
+            data = fob.read()
+        with open(deb, "wb") as fob:
+            fob.write(data[:keep])
+        with pytest.raises(RepoError, match="truncated"):
+            read_deb(deb)
+
+    @pytest.mark.parametrize("compression", ["gzip", "xz", "none"])
+    def test_garbled_control_tar_raises(
+        self, tempdir: str, compression: str,
+    ) -> None:
+        deb = build_deb(tempdir, "testpkg", "1.2.3", "amd64", compression)
+        with open(deb, "r+b") as fob:
+            # past the ar magic, debian-binary and the control.tar header
+            fob.seek(140)
+            fob.write(b"\xff" * 64)
+        with pytest.raises(RepoError, match=r"corrupt control\.tar"):
+            read_deb(deb)
+
+    def test_index_with_native_backend(self, populated_root: str) -> None:
+        pool_main = join(populated_root, "pool", "main")
+        build_deb(pool_main, "otherpkg", "2.0", "all")
+        build_deb(pool_main, "armpkg", "1.0", "arm64")
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native",
+        ).index("main", "amd64")
+        binary_dir = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+        )
+        with open(join(binary_dir, "Packages")) as fob:
+            content = fob.read()
+        assert "Package: testpkg\n" in content
+        assert "Package: otherpkg\n" in content
+        assert "Package: armpkg\n" not in content
+        assert "Filename: pool/main/testpkg_1.2.3_amd64.deb\n" in content
+        assert content.endswith("\n\n\n")
+
+    def test_native_incremental_matches_full(
+        self, populated_root: str,
+    ) -> None:
+        packages = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+            "Packages",
+        )
+        contents = []
+        for incremental in (False, True, True):
+            Repository(
+                populated_root, "trixie", "pool", "1.0", "origin",
+                backend="native", incremental=incremental,
+            ).index("main", "amd64")
+            with open(packages, "rb") as fob:
+                contents.append(fob.read())
+        assert contents[0] == contents[1] == contents[2]
+
+    def test_parallel_index_matches_serial(
+        self, populated_root: str,
+    ) -> None:
+        pool_main = join(populated_root, "pool", "main")
+        for i in range(8):
+            build_deb(pool_main, f"pkg{i}", "1.0", "amd64")
+        packages = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+            "Packages",
+        )
+        contents = []
+        for jobs in (1, 4):
+            Repository(
+                populated_root, "trixie", "pool", "1.0", "origin",
+                backend="native", jobs=jobs,
+            ).index("main", "amd64")
+            with open(packages, "rb") as fob:
+                contents.append(fob.read())
+        assert contents[0] == contents[1]
+
+    def test_parallel_map_keeps_input_order(self) -> None:
+        items = list(range(50))
+        assert list(parallel_map(lambda x: x * x, items, 8)) == [
+            x * x for x in items
+        ]
+
+    def test_unknown_backend_raises(self, repo_root: str) -> None:
+        with pytest.raises(RepoError, match="unknown index backend"):
+            Repository(
+                repo_root, "trixie", "pool", "1.0", "origin",
+                backend="bogus",
+            )
+
+
+class TestCompression:
+    def test_variants_decompress_to_packages(
+        self, populated_root: str,
+    ) -> None:
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native",
+        ).index("main", "amd64")
+        binary_dir = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+        )
+        with open(join(binary_dir, "Packages"), "rb") as fob:
+            packages = fob.read()
+        assert gzip.decompress(_read(binary_dir, "Packages.gz")) == packages
+        assert bz2.decompress(_read(binary_dir, "Packages.bz2")) == packages
+        assert lzma.decompress(_read(binary_dir, "Packages.xz")) == packages
+
+    def test_codec_set_is_configurable(self, populated_root: str) -> None:
+        binary_dir = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+        )
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native",
+        ).index("main", "amd64")
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native", codecs=("gz", "xz"),
+        ).index("main", "amd64")
+        assert exists(join(binary_dir, "Packages.gz"))
+        assert exists(join(binary_dir, "Packages.xz"))
+        # dropped codecs must not leave a stale variant behind
+        assert not exists(join(binary_dir, "Packages.bz2"))
+
+    def test_unknown_codec_raises(self, populated_root: str) -> None:
+        repo = Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native", codecs=("gz", "rar"),
+        )
+        with pytest.raises(RepoError, match="unsupported compression"):
+            repo.index("main", "amd64")
+
+
+class TestAcquireByHash:
+    @staticmethod
+    def _index(root: str, by_hash_keep: int = BY_HASH_KEEP) -> str:
+        Repository(
+            root, "trixie", "pool", "1.0", "origin", backend="native",
+            by_hash_keep=by_hash_keep,
+        ).index("main", "amd64")
+        return join(root, "dists", "trixie", "main", "binary-amd64")
+
+    def test_variants_linked_by_sha256(self, populated_root: str) -> None:
+        binary_dir = self._index(populated_root)
+        for name in (
+            "Packages", "Packages.gz", "Packages.bz2", "Packages.xz",
+        ):
+            data = _read(binary_dir, name)
+            digest = hashlib.sha256(data).hexdigest()
+            assert _read(join(binary_dir, "by-hash", "SHA256"), digest) == data
+
+    def test_release_files_advertise_by_hash(
+        self, populated_root: str,
+    ) -> None:
+        binary_dir = self._index(populated_root)
+        assert b"Acquire-By-Hash: yes\n" in _read(binary_dir, "Release")
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+        ).generate_release()
+        dist_dir = join(populated_root, "dists", "trixie")
+        assert b"Acquire-By-Hash: yes\n" in _read(dist_dir, "Release")
+
+    def test_old_generations_pruned(self, populated_root: str) -> None:
+        keep = 2
+        pool_main = join(populated_root, "pool", "main")
+        for i in range(4):
+            build_deb(pool_main, f"gen{i}", "1.0", "amd64")
+            binary_dir = self._index(populated_root, by_hash_keep=keep)
+        by_hash_dir = join(binary_dir, "by-hash", "SHA256")
+        # Packages plus .gz, .bz2 and .xz for each kept generation
+        assert len(os.listdir(by_hash_dir)) == keep * 4
+        current = hashlib.sha256(_read(binary_dir, "Packages")).hexdigest()
+        assert exists(join(by_hash_dir, current))
+
+    def test_keep_zero_disables_by_hash(self, populated_root: str) -> None:
+        self._index(populated_root)
+        binary_dir = self._index(populated_root, by_hash_keep=0)
+        assert not exists(join(binary_dir, "by-hash"))
+        assert b"Acquire-By-Hash" not in _read(binary_dir, "Release")
+
+
+def _apply_ed(old: list[str], script: str) -> list[str]:
+    # Minimal ed interpreter for 'diff --ed' output ('a', 'c' and 'd'
+    # commands, emitted last line first), as apt's rred method applies it.
+    lines = list(old)
+    script_lines = script.splitlines(keepends=True)
+    i = 0
+    while i < len(script_lines):
+        command = script_lines[i].rstrip("\n")
+        i += 1
+        addresses, action = command[:-1], command[-1]
+        start, _, end = addresses.partition(",")
+        first, last = int(start), int(end or start)
+        text: list[str] = []
+        if action in "ac":
+            while script_lines[i] != ".\n":
+                text.append(script_lines[i])
+                i += 1
+            i += 1
+        if action == "a":
+            lines[first:first] = text
+        else:
+            lines[first - 1:last] = text
+    return lines
+
+
+class TestPDiff:
+    @staticmethod
+    def _index(root: str, keep: int = 3) -> str:
+        Repository(
+            root, "trixie", "pool", "1.0", "origin", backend="native",
+            pdiff_keep=keep,
+        ).index("main", "amd64")
+        return join(root, "dists", "trixie", "main", "binary-amd64")
+
+    def test_patch_turns_old_packages_into_new(
+        self, populated_root: str,
+    ) -> None:
+        binary_dir = self._index(populated_root)
+        old = _read(binary_dir, "Packages").decode()
+        build_deb(join(populated_root, "pool", "main"), "new", "1", "amd64")
+        self._index(populated_root)
+        new = _read(binary_dir, "Packages").decode()
+
+        diff_dir = join(binary_dir, "Packages.diff")
+        index = _read(diff_dir, "Index").decode()
+        new_digest = hashlib.sha256(new.encode()).hexdigest()
+        assert index.startswith(f"SHA256-Current: {new_digest}")
+        old_digest = hashlib.sha256(old.encode()).hexdigest()
+        assert f" {old_digest} " in index
+        (patch,) = [n for n in os.listdir(diff_dir) if n.endswith(".gz")]
+        assert f" {patch}\n" in index
+        script = gzip.decompress(_read(diff_dir, patch)).decode()
+        patched = _apply_ed(old.splitlines(keepends=True), script)
+        assert "".join(patched) == new
+
+    def test_unchanged_packages_adds_no_patch(
+        self, populated_root: str,
+    ) -> None:
+        self._index(populated_root)
+        binary_dir = self._index(populated_root)
+        diff_dir = join(binary_dir, "Packages.diff")
+        assert not [n for n in os.listdir(diff_dir) if n.endswith(".gz")]
+
+    def test_only_newest_patches_kept(self, populated_root: str) -> None:
+        keep = 2
+        pool_main = join(populated_root, "pool", "main")
+        binary_dir = self._index(populated_root, keep)
+        for i in range(4):
+            build_deb(pool_main, f"gen{i}", "1.0", "amd64")
+            self._index(populated_root, keep)
+        diff_dir = join(binary_dir, "Packages.diff")
+        patches = [n for n in os.listdir(diff_dir) if n.endswith(".gz")]
+        assert len(patches) == keep
+        index = _read(diff_dir, "Index").decode()
+        for name in patches:
+            assert name in index
+
+    def test_keep_zero_removes_pdiffs(self, populated_root: str) -> None:
+        self._index(populated_root)
+        binary_dir = self._index(populated_root, keep=0)
+        assert not exists(join(binary_dir, "Packages.diff"))
+
+
+class TestReleaseManifest:
+    @staticmethod
+    def _release(root: str) -> str:
+        Repository(
+            root, "trixie", "pool", "1.0", "origin", quiet=True,
+        ).generate_release()
+        return _read(join(root, "dists", "trixie"), "Release").decode()
+
+    @staticmethod
+    def _sha256_entries(release: str) -> dict[str, str]:
+        section = release.split("SHA256:\n", 1)[1].split("SHA512:", 1)[0]
+        entries = {}
+        for line in section.splitlines():
+            digest, _, path = line.split()
+            entries[path] = digest
+        return entries
+
+    def test_release_hashes_match_files(self, populated_root: str) -> None:
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native",
+        ).index("main", "amd64")
+        entries = self._sha256_entries(self._release(populated_root))
+        dist_dir = join(populated_root, "dists", "trixie")
+        assert sorted(entries) == [
+            "main/binary-amd64/Packages",
+            "main/binary-amd64/Packages.bz2",
+            "main/binary-amd64/Packages.gz",
+            "main/binary-amd64/Packages.xz",
+            "main/binary-amd64/Release",
+        ]
+        for path, digest in entries.items():
+            assert hashlib.sha256(_read(dist_dir, path)).hexdigest() == digest
+
+    def test_recorded_files_are_not_rehashed(
+        self,
+        populated_root: str,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin",
+            backend="native",
+        ).index("main", "amd64")
+        hashed: list[str] = []
+        real_hash_file = manifest._hash_file  # noqa: SLF001
+
+        def spy(path: str) -> dict[str, str]:
+            hashed.append(path)
+            return real_hash_file(path)
+
+        monkeypatch.setattr(manifest, "_hash_file", spy)
+        self._release(populated_root)
+        assert hashed == []
+
+        # a file changed behind the manifest's back is hashed again
+        binary_dir = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+        )
+        with open(join(binary_dir, "Packages"), "ab") as fob:
+            fob.write(b"\n")
+        entries = self._sha256_entries(self._release(populated_root))
+        assert hashed == [join(binary_dir, "Packages")]
+        assert entries["main/binary-amd64/Packages"] == hashlib.sha256(
+            _read(binary_dir, "Packages"),
+        ).hexdigest()
+
+
+class TestPublish:
+    @pytest.fixture
+    def multi_root(self, populated_root: str) -> str:
+        build_deb(join(populated_root, "pool", "main"), "allpkg", "1.0", "all")
+        contrib = join(populated_root, "pool", "contrib")
+        os.makedirs(contrib)
+        build_deb(contrib, "armpkg", "1.0", "arm64")
+        return populated_root
+
+    def test_indexes_every_component_and_arch(self, multi_root: str) -> None:
+        Repository(
+            multi_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        ).publish()
+        dist_dir = join(multi_root, "dists", "trixie")
+        for component in ("main", "contrib"):
+            for arch in ("amd64", "arm64"):
+                assert exists(
+                    join(dist_dir, component, f"binary-{arch}", "Packages"),
+                )
+        assert not exists(join(dist_dir, "main", "binary-all"))
+        for arch in ("amd64", "arm64"):
+            binary_dir = join(dist_dir, "main", f"binary-{arch}")
+            assert b"Package: allpkg\n" in _read(binary_dir, "Packages")
+        release = _read(dist_dir, "Release").decode()
+        assert "main/binary-arm64/Packages" in release
+
+    def test_matches_per_arch_index(self, multi_root: str) -> None:
+        repo = Repository(
+            multi_root, "trixie", "pool", "1.0", "origin", backend="native",
+        )
+        repo.index_all()
+        dist_dir = join(multi_root, "dists", "trixie")
+        published = {
+            arch: _read(join(dist_dir, "main", f"binary-{arch}"), "Packages")
+            for arch in ("amd64", "arm64")
+        }
+        for arch, content in published.items():
+            repo.index("main", arch)
+            binary_dir = join(dist_dir, "main", f"binary-{arch}")
+            assert _read(binary_dir, "Packages") == content
+
+    def test_each_deb_read_once(
+        self, multi_root: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        read: list[str] = []
+        real_deb_stanza = deb.deb_stanza
+
+        def spy(path: str, filename: str) -> str:
+            read.append(filename)
+            return real_deb_stanza(path, filename)
+
+        monkeypatch.setattr(deb, "deb_stanza", spy)
+        Repository(
+            multi_root, "trixie", "pool", "1.0", "origin", backend="native",
+        ).index_all()
+        assert sorted(read) == [
+            "pool/contrib/armpkg_1.0_arm64.deb",
+            "pool/main/allpkg_1.0_all.deb",
+            "pool/main/testpkg_1.2.3_amd64.deb",
+        ]
+
+    def test_failed_stanzas_commit_no_index(
+        self, multi_root: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        repo = Repository(
+            multi_root, "trixie", "pool", "1.0", "origin", backend="native",
+        )
+        repo.index_all()
+        dist_dir = join(multi_root, "dists", "trixie")
+        before = {
+            arch: _read(join(dist_dir, "main", f"binary-{arch}"), "Packages")
+            for arch in ("amd64", "arm64")
+        }
+        build_deb(join(multi_root, "pool", "main"), "newpkg", "1.0", "all")
+
+        def broken(path: str, filename: str) -> str:
+            if "newpkg" in filename:
+                raise RepoError("corrupt")
+            return deb_stanza(path, filename)
+
+        monkeypatch.setattr(deb, "deb_stanza", broken)
+        with pytest.raises(RepoError, match="corrupt"):
+            repo.index_all()
+        for arch, content in before.items():
+            binary_dir = join(dist_dir, "main", f"binary-{arch}")
+            assert _read(binary_dir, "Packages") == content
+            assert not exists(join(binary_dir, "Packages.tmp"))
+
+    def test_archs_can_be_given(self, multi_root: str) -> None:
+        Repository(
+            multi_root, "trixie", "pool", "1.0", "origin", backend="native",
+        ).index_all(["amd64"])
+        dist_dir = join(multi_root, "dists", "trixie")
+        assert exists(join(dist_dir, "contrib", "binary-amd64", "Packages"))
+        assert not exists(join(dist_dir, "main", "binary-arm64"))
+
+    def test_deb_archs(self) -> None:
+        debs = ["a_1_amd64.deb", "b_1_all.deb", "c_1_arm64.deb"]
+        assert deb_archs(debs) == ["amd64", "arm64"]
+        assert deb_archs(["b_1_all.deb"]) == ["all"]
+        assert deb_archs([]) == []
+
+    def test_empty_pool_raises(self, repo_root: str) -> None:
+        with pytest.raises(RepoError, match=r"no \.deb files found"):
+            Repository(
+                repo_root, "trixie", "pool", "1.0", "origin",
+            ).index_all()
+
+    def test_cli_publish_succeeds(self, multi_root: str) -> None:
+        result = run_repo(
+            "publish", multi_root, "trixie", "--backend", "native", "-q",
+        )
+        assert result.returncode == 0, result.stderr
+        assert exists(join(multi_root, "dists", "trixie", "Release"))
+
+    def test_cli_publish_unsupported_arch_exits_nonzero(
+        self, multi_root: str,
+    ) -> None:
+        result = run_repo("publish", multi_root, "trixie", "--arch", "mips")
+        assert result.returncode != 0
+
+
+class TestStagedPublish:
+    @staticmethod
+    def _publish(root: str, codecs: tuple[str, ...] | None = None) -> None:
+        Repository(
+            root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native", codecs=codecs,
+        ).publish(staged=True, keep=1)
+
+    @staticmethod
+    def _generations(root: str) -> list[str]:
+        dists = join(root, "dists")
+        return sorted(
+            name for name in os.listdir(dists)
+            if name.startswith(".trixie.") and not os.path.islink(
+                join(dists, name),
+            )
+        )
+
+    def test_release_is_a_symlink_to_generation(
+        self, populated_root: str,
+    ) -> None:
+        self._publish(populated_root)
+        live = join(populated_root, "dists", "trixie")
+        assert os.path.islink(live)
+        assert os.readlink(live) == self._generations(populated_root)[-1]
+        assert exists(join(live, "Release"))
+        assert exists(join(live, "main", "binary-amd64", "Packages"))
+
+    def test_previous_generation_kept_intact(
+        self, populated_root: str,
+    ) -> None:
+        self._publish(populated_root)
+        live = join(populated_root, "dists", "trixie")
+        old_generation = os.readlink(live)
+        old_packages = _read(join(live, "main", "binary-amd64"), "Packages")
+        build_deb(join(populated_root, "pool", "main"), "newpkg", "1.0", "all")
+        self._publish(populated_root)
+        assert os.readlink(live) != old_generation
+        old_dir = join(populated_root, "dists", old_generation)
+        assert _read(join(old_dir, "main", "binary-amd64"), "Packages") == (
+            old_packages
+        )
+        packages = _read(join(live, "main", "binary-amd64"), "Packages")
+        assert b"Package: newpkg\n" in packages
+
+    def test_old_generations_pruned(self, populated_root: str) -> None:
+        for _ in range(4):
+            self._publish(populated_root)
+        # the live generation and keep=1 previous one
+        assert len(self._generations(populated_root)) == 2  # noqa: PLR2004
+
+    def test_in_place_tree_is_converted(self, populated_root: str) -> None:
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        ).publish()
+        live = join(populated_root, "dists", "trixie")
+        assert not os.path.islink(live)
+        self._publish(populated_root)
+        assert os.path.islink(live)
+        assert len(self._generations(populated_root)) == 2  # noqa: PLR2004
+
+    def test_failed_publish_leaves_live_tree(
+        self, populated_root: str,
+    ) -> None:
+        self._publish(populated_root)
+        live = join(populated_root, "dists", "trixie")
+        generation = os.readlink(live)
+        with pytest.raises(RepoError, match="unsupported compression"):
+            self._publish(populated_root, codecs=("bogus",))
+        assert os.readlink(live) == generation
+        assert self._generations(populated_root) == [generation]
+
+    def test_cli_publish_staged(self, populated_root: str) -> None:
+        result = run_repo(
+            "publish", populated_root, "trixie", "--backend", "native",
+            "--staged", "-q",
+        )
+        assert result.returncode == 0, result.stderr
+        assert os.path.islink(join(populated_root, "dists", "trixie"))
+
+
+class TestGc:
+    @staticmethod
+    def _index(
+        root: str,
+        *,
+        codecs: tuple[str, ...] | None = None,
+        pdiff_keep: int = 0,
+    ) -> None:
+        Repository(
+            root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native", codecs=codecs, pdiff_keep=pdiff_keep,
+        ).index("main", "amd64")
+
+    @staticmethod
+    def _add_versions(root: str, *versions: str) -> str:
+        main = join(root, "pool", "main")
+        for version in versions:
+            build_dir = join(root, f"build-{version}")
+            os.makedirs(build_dir)
+            shutil.move(build_deb(build_dir, "pkg", version, "all"), main)
+        return main
+
+    def test_old_versions_removed(self, repo_root: str) -> None:
+        main = join(repo_root, "pool", "main")
+        for i, version in enumerate(("1.0", "1:0.9", "1.10", "1.9")):
+            build_dir = join(repo_root, f"build{i}")
+            os.makedirs(build_dir)
+            shutil.move(
+                build_deb(build_dir, "pkg", version, "all"),
+                join(main, f"pkg_{version.replace(':', '%3a')}_all.deb"),
+            )
+        plan = collect_garbage(repo_root, keep=2)
+        assert sorted(filename for filename, _ in plan.remove) == [
+            "pool/main/pkg_1.0_all.deb", "pool/main/pkg_1.9_all.deb",
+        ]
+        assert sorted(os.listdir(main)) == [
+            "pkg_1%3a0.9_all.deb", "pkg_1.10_all.deb",
+        ]
+
+    def test_indexed_old_versions_removed_and_reindexed(
+        self, repo_root: str,
+    ) -> None:
+        main = self._add_versions(repo_root, "1.0", "1.1", "0.9", "1.2")
+        self._index(repo_root)
+        dry_plan = collect_garbage(repo_root, keep=1, dry_run=True)
+        assert len(dry_plan.remove) == 3  # noqa: PLR2004
+        assert dry_plan.reindex == {"trixie": {("main", "amd64")}}
+        plan = collect_garbage(repo_root, keep=1)
+        assert sorted(filename for filename, _ in plan.remove) == [
+            "pool/main/pkg_0.9_all.deb",
+            "pool/main/pkg_1.0_all.deb",
+            "pool/main/pkg_1.1_all.deb",
+        ]
+        assert os.listdir(main) == ["pkg_1.2_all.deb"]
+        dist_dir = join(repo_root, "dists", "trixie")
+        packages = _read(join(dist_dir, "main", "binary-amd64"), "Packages")
+        assert b"Version: 1.2\n" in packages
+        assert b"Version: 1.1\n" not in packages
+        release = _read(dist_dir, "Release").decode()
+        assert "Origin: origin\n" in release
+        assert "Version: 1.0\n" in release
+
+    @pytest.mark.parametrize(
+        "codecs",
+        [
+            ("gz", "xz"),
+            pytest.param(
+                ("gz", "zst"),
+                marks=pytest.mark.skipif(
+                    not exists("/usr/bin/zstd")
+                    and importlib.util.find_spec("zstandard") is None
+                    and sys.version_info < (3, 14),
+                    reason="no zstd compressor",
+                ),
+            ),
+        ],
+    )
+    def test_reindexed_with_recorded_settings(
+        self, repo_root: str, codecs: tuple[str, ...],
+    ) -> None:
+        self._add_versions(repo_root, "1.0")
+        self._index(repo_root, codecs=codecs, pdiff_keep=2)
+        self._add_versions(repo_root, "1.1")
+        self._index(repo_root, codecs=codecs, pdiff_keep=2)
+        binary_dir = join(repo_root, "dists", "trixie", "main", "binary-amd64")
+        with open(join(binary_dir, "Packages.diff", "Index")) as fob:
+            patches = fob.read().count("SHA256-Patches")
+        plan = collect_garbage(repo_root, keep=1)
+        assert plan.reindex == {"trixie": {("main", "amd64")}}
+        packages = _read(binary_dir, "Packages")
+        assert b"Version: 1.0\n" not in packages
+        assert gzip.decompress(_read(binary_dir, "Packages.gz")) == packages
+        names = {"Packages.diff", *(f"Packages.{codec}" for codec in codecs)}
+        assert {
+            name
+            for name in os.listdir(binary_dir)
+            if name.startswith("Packages.")
+        } == names
+        # gc's reindex added a patch rather than dropping the PDiffs
+        with open(join(binary_dir, "Packages.diff", "Index")) as fob:
+            assert fob.read().count("SHA256-Patches") == patches
+
+    def test_unrecorded_settings_refused(self, repo_root: str) -> None:
+        main = self._add_versions(repo_root, "1.0", "1.1")
+        self._index(repo_root)
+        os.remove(join(repo_root, ".cache", "manifest-trixie.json"))
+        packages = _read(
+            join(repo_root, "dists", "trixie", "main", "binary-amd64"),
+            "Packages",
+        )
+        with pytest.raises(RepoError, match="settings were never recorded"):
+            collect_garbage(repo_root, keep=1)
+        # nothing was removed, nor reindexed
+        assert len(os.listdir(main)) == 2  # noqa: PLR2004
+        assert packages == _read(
+            join(repo_root, "dists", "trixie", "main", "binary-amd64"),
+            "Packages",
+        )
+
+    def test_kept_generation_files_only_unlisted(
+        self, repo_root: str,
+    ) -> None:
+        main = self._add_versions(repo_root, "1.0", "1.1")
+        repo = Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        )
+        repo.publish(archs=["amd64"], staged=True)
+        plan = collect_garbage(repo_root, keep=1)
+        assert plan.remove == []
+        assert plan.unlist == {"pool/main/pkg_1.0_all.deb"}
+        # the generation gc replaced still lists it, so it stays
+        assert sorted(os.listdir(main)) == [
+            "pkg_1.0_all.deb", "pkg_1.1_all.deb",
+        ]
+        packages = _read(
+            join(repo_root, "dists", "trixie", "main", "binary-amd64"),
+            "Packages",
+        )
+        assert b"Version: 1.0\n" not in packages
+        assert b"Version: 1.1\n" in packages
+
+    def test_signed_release_needs_gpgkey(self, repo_root: str) -> None:
+        main = self._add_versions(repo_root, "1.0", "1.1")
+        self._index(repo_root)
+        release_gpg = join(repo_root, "dists", "trixie", "Release.gpg")
+        with open(release_gpg, "w") as fob:
+            fob.write("signature")
+        with pytest.raises(RepoError, match="trixie: signed"):
+            collect_garbage(repo_root, keep=1)
+        # nothing was removed
+        assert len(os.listdir(main)) == 2  # noqa: PLR2004
+
+    def test_unindexed_arch_left_alone(self, populated_root: str) -> None:
+        main = join(populated_root, "pool", "main")
+        build_deb(main, "armpkg", "1.0", "arm64")
+        self._index(populated_root)
+        build_deb(main, "orphan", "1.0", "amd64")
+        packages_file = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+            "Packages",
+        )
+        later = os.stat(packages_file).st_mtime + 60
+        os.utime(packages_file, (later, later))
+        # only amd64 was indexed: the arm64 .deb is not an orphan
+        plan = plan_gc(populated_root)
+        assert plan.remove == [
+            ("pool/main/orphan_1.0_amd64.deb", "not in any Packages index"),
+        ]
+
+    def test_unindexed_files_removed_new_ones_kept(
+        self, populated_root: str,
+    ) -> None:
+        main = join(populated_root, "pool", "main")
+        self._index(populated_root)
+        build_deb(main, "orphan", "1.0", "amd64")
+        # just added, so possibly not indexed yet
+        assert not plan_gc(populated_root).remove
+        packages_file = join(
+            populated_root, "dists", "trixie", "main", "binary-amd64",
+            "Packages",
+        )
+        later = os.stat(packages_file).st_mtime + 60
+        os.utime(packages_file, (later, later))
+        plan = collect_garbage(populated_root)
+        assert plan.remove == [
+            ("pool/main/orphan_1.0_amd64.deb", "not in any Packages index"),
+        ]
+        assert not exists(join(main, "orphan_1.0_amd64.deb"))
+        assert exists(join(main, "testpkg_1.2.3_amd64.deb"))
+
+    def test_duplicates_hard_linked(self, populated_root: str) -> None:
+        deb_name = "testpkg_1.2.3_amd64.deb"
+        main = join(populated_root, "pool", "main")
+        contrib = join(populated_root, "pool", "contrib")
+        os.makedirs(contrib)
+        shutil.copy2(join(main, deb_name), join(contrib, deb_name))
+        size = os.stat(join(main, deb_name)).st_size
+        plan = collect_garbage(populated_root, dry_run=True)
+        assert plan.link == [
+            (f"pool/main/{deb_name}", f"pool/contrib/{deb_name}"),
+        ]
+        assert plan.reclaimed == size
+        assert os.stat(join(main, deb_name)).st_nlink == 1
+        collect_garbage(populated_root)
+        assert os.path.samefile(join(main, deb_name), join(contrib, deb_name))
+        assert plan_gc(populated_root).link == []
+
+    def test_cli_gc_dry_run(self, populated_root: str) -> None:
+        main = join(populated_root, "pool", "main")
+        build_dir = join(populated_root, "build")
+        os.makedirs(build_dir)
+        shutil.move(build_deb(build_dir, "testpkg", "1.0", "amd64"), main)
+        result = run_repo("gc", populated_root, "--keep", "1", "--dry-run")
+        assert result.returncode == 0, result.stderr
+        assert "Would remove: pool/main/testpkg_1.0_amd64.deb" in result.stdout
+        assert "Would reclaim" in result.stdout
+        assert exists(join(main, "testpkg_1.0_amd64.deb"))
+
+
+class TestWatch:
+    @staticmethod
+    def _watcher(root: str) -> PoolWatcher:
+        repo = Repository(
+            root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        )
+        return PoolWatcher(repo, debounce=0.2, max_delay=5)
+
+    @staticmethod
+    def _packages(root: str) -> str:
+        with open(
+            join(root, "dists", "trixie", "main", "binary-amd64", "Packages"),
+        ) as fob:
+            return fob.read()
+
+    def _run_one_batch(self, root: str, add: Callable[[], object]) -> None:
+        watcher = self._watcher(root)
+        try:
+            thread = threading.Thread(target=watcher.run, args=(1,))
+            thread.start()
+            add()
+            thread.join(30)
+            assert not thread.is_alive()
+        finally:
+            watcher.close()
+
+    def test_affected_indexes(self, populated_root: str) -> None:
+        build_deb(join(populated_root, "pool", "main"), "arm", "1", "arm64")
+        watcher = self._watcher(populated_root)
+        try:
+            watcher.scan()
+            assert watcher.affected({"pool/main/a_1_amd64.deb"}) == {
+                ("main", "amd64"),
+            }
+            assert watcher.affected({"pool/main/a_1_all.deb"}) == {
+                ("main", "amd64"), ("main", "arm64"),
+            }
+            # a new architecture or component needs everything reindexed
+            assert watcher.affected({"pool/main/a_1_i386.deb"}) is None
+            assert watcher.affected({"pool/contrib/a_1_amd64.deb"}) is None
+        finally:
+            watcher.close()
+
+    def test_moved_deb_published(self, populated_root: str) -> None:
+        build_dir = join(populated_root, "build")
+        os.makedirs(build_dir)
+        deb = build_deb(build_dir, "newpkg", "1.0", "amd64")
+        main = join(populated_root, "pool", "main")
+        self._run_one_batch(populated_root, lambda: shutil.move(deb, main))
+        packages = self._packages(populated_root)
+        assert "Package: newpkg\n" in packages
+        assert "Package: testpkg\n" in packages
+        assert exists(join(populated_root, "dists", "trixie", "Release"))
+
+    def test_failed_batch_retried_with_next(
+        self, populated_root: str,
+    ) -> None:
+        main = join(populated_root, "pool", "main")
+        build_dir = join(populated_root, "build")
+        os.makedirs(build_dir)
+        deb = build_deb(build_dir, "newpkg", "1.0", "amd64")
+        bogus = join(main, "bogus_1.0_amd64.deb")
+        release = join(populated_root, "dists", "trixie", "Release")
+        watcher = self._watcher(populated_root)
+        try:
+            thread = threading.Thread(target=watcher.run, args=(2,))
+            thread.start()
+            deadline = time.monotonic() + 30
+            while not exists(release) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            with open(bogus, "w") as fob:
+                fob.write("not a deb")
+            # the first batch fails on the bogus .deb; the daemon goes on
+            while not watcher.failed and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert watcher.failed == {"pool/main/bogus_1.0_amd64.deb"}
+            os.remove(bogus)
+            shutil.move(deb, main)
+            thread.join(30)
+            assert not thread.is_alive()
+        finally:
+            watcher.close()
+        assert watcher.failed == set()
+        assert "Package: newpkg\n" in self._packages(populated_root)
+
+    def test_truncated_deb_logged_and_retried(
+        self, populated_root: str,
+    ) -> None:
+        build_dir = join(populated_root, "build")
+        os.makedirs(build_dir)
+        deb = build_deb(build_dir, "newpkg", "1.0", "amd64")
+        with open(deb, "rb") as fob:
+            data = fob.read()
+        with open(deb, "wb") as fob:
+            fob.write(data[: len(data) // 2])
+        release = join(populated_root, "dists", "trixie", "Release")
+        watcher = self._watcher(populated_root)
+        try:
+            thread = threading.Thread(target=watcher.run, args=(1,))
+            thread.start()
+            deadline = time.monotonic() + 30
+            while not exists(release) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            shutil.move(deb, join(populated_root, "pool", "main"))
+            thread.join(30)
+            assert not thread.is_alive()
+        finally:
+            watcher.close()
+        # logged and kept for the next batch, not raised out of run()
+        assert watcher.failed == {"pool/main/newpkg_1.0_amd64.deb"}
+
+    def test_directory_missed_in_overflow_watched(
+        self, populated_root: str,
+    ) -> None:
+        contrib = join(populated_root, "pool", "contrib")
+        watcher = self._watcher(populated_root)
+        try:
+            os.makedirs(contrib)
+            # as if the queue overflowed: the IN_CREATE is never seen
+            watcher.inotify.read(0)
+            watcher.publish(None)
+            assert contrib in watcher.inotify.paths.values()
+        finally:
+            watcher.close()
+
+    def test_failed_full_reindex_retried(
+        self, populated_root: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        watcher = self._watcher(populated_root)
+        published: list[set[str] | None] = []
+
+        def publish(filenames: set[str] | None) -> None:
+            published.append(filenames)
+            if len(published) == 1:
+                raise OSError(28, "No space left on device")
+
+        monkeypatch.setattr(watcher, "publish", publish)
+        try:
+            watcher._attempt(None)  # noqa: SLF001
+            assert watcher.failed is None
+            watcher._attempt({"pool/main/a_1_amd64.deb"})  # noqa: SLF001
+        finally:
+            watcher.close()
+        # the next batch is a full reindex again, not just its own .debs
+        assert published == [None, None]
+        assert watcher.failed == set()
+
+    def test_moved_out_component_reindexes_all(
+        self, populated_root: str,
+    ) -> None:
+        contrib = join(populated_root, "pool", "contrib")
+        os.makedirs(contrib)
+        build_deb(contrib, "gone", "1.0", "amd64")
+        watcher = self._watcher(populated_root)
+        try:
+            shutil.move(contrib, join(populated_root, "contrib.old"))
+            assert watcher.wait_batch() is None
+        finally:
+            watcher.close()
+
+    def test_hard_linked_deb_published(self, populated_root: str) -> None:
+        build_dir = join(populated_root, "build")
+        os.makedirs(build_dir)
+        deb = build_deb(build_dir, "linked", "1.0", "amd64")
+        target = join(populated_root, "pool", "main", os.path.basename(deb))
+        self._run_one_batch(populated_root, lambda: os.link(deb, target))
+        assert "Package: linked\n" in self._packages(populated_root)
+
+
+class TestInstrument:
+    @pytest.fixture(autouse=True)
+    def _recording(self) -> Generator[None]:
+        instrument.enable()
+        yield
+        instrument.reset()
+
+    def test_child_usage_recorded(self) -> None:
+        run_cmd(["/bin/sh", "-c", "head -c 1000000 /dev/zero | wc -c"])
+        (record,) = instrument.records()
+        assert record["stage"] == "sh"
+        assert record["children"] == 1
+        assert record["child_max_rss_kb"] > 0  # type: ignore[operator]
+        assert record["wall_s"] > 0  # type: ignore[operator]
+
+    def test_failed_command_still_recorded(self) -> None:
+        with pytest.raises(RepoError, match="oops"):
+            run_cmd(["/bin/sh", "-c", "echo oops >&2; exit 3"])
+        assert instrument.records()[0]["children"] == 1
+
+    def test_publish_stages(self, populated_root: str) -> None:
+        Repository(
+            populated_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native", codecs=("gz", "xz"),
+        ).publish()
+        stages = [record["stage"] for record in instrument.records()]
+        assert stages.count("compress") == 2  # noqa: PLR2004
+        for stage in ("walk", "index", "release"):
+            assert stage in stages
+        compressed = [
+            record for record in instrument.records()
+            if record["stage"] == "compress"
+        ]
+        assert all(record["write_bytes"] for record in compressed)
+
+    def test_child_cpu_of_several_children_added(self) -> None:
+        burn = "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"
+        with instrument.measure("outer"):
+            run_cmd(["/bin/sh", "-c", burn])
+            run_cmd(["/bin/sh", "-c", burn])
+        *inner, outer = instrument.records()
+        assert outer["children"] == 2  # noqa: PLR2004
+        assert outer["cpu_s"] >= sum(  # type: ignore[operator]
+            record["cpu_s"] for record in inner  # type: ignore[misc]
+        ) * 0.99
+
+    def test_reaped_child_waited_for(self) -> None:
+        with subprocess.Popen(["/bin/sh", "-c", "exit 3"], text=True) as proc:
+            proc.wait()
+            assert instrument.wait_child(proc) == 3  # noqa: PLR2004
+
+    def test_disabled_records_nothing(self) -> None:
+        instrument.reset()
+        run_cmd(["/bin/true"])
+        assert instrument.records() == []
+
+    def test_cli_report_json(self, populated_root: str) -> None:
+        report_file = join(populated_root, "report.json")
+        result = run_repo(
+            "--report", "json", "--report-file", report_file,
+            "publish", populated_root, "trixie", "--backend", "native", "-q",
+        )
+        assert result.returncode == 0, result.stderr
+        with open(report_file) as fob:
+            report = json.load(fob)
+        assert report["totals"]["index"]["count"] == 1
+        assert {"wall_s", "cpu_s", "read_bytes", "write_bytes"} <= set(
+            report["stages"][0],
+        )
+
+
+class TestBenchmarks:
+    def test_synthetic_deb_is_valid(self, tempdir: str) -> None:
+        # not part of the installed package, so missing from build trees
+        bench = pytest.importorskip("benchmarks.bench")
+        path = join(tempdir, "pkg_1.0-1_amd64.deb")
+        bench.synthetic_deb(path, "pkg", "1.0-1", "amd64", b"x" * 100)
+        result = subprocess.run(
+            ["/usr/bin/dpkg-deb", "--field", path, "Package", "Version"],
+            capture_output=True, text=True, check=True,
+        )
+        assert result.stdout == "Package: pkg\nVersion: 1.0-1\n"
+        assert deb_stanza(path, "pool/main/pkg_1.0-1_amd64.deb").startswith(
+            "Package: pkg\nArchitecture: amd64\nVersion: 1.0-1\n",
+        )
+
+    def test_bench_runs(self, tempdir: str) -> None:
+        output = join(tempdir, "results.json")
+        result = subprocess.run(
+            [
+                "/usr/bin/python3", "-m", "benchmarks.bench",
+                "--sizes", "30", "--no-sign", "--output", output,
+                "--baseline", join(tempdir, "none.json"),
+            ],
+            capture_output=True,
+            text=True,
+            check=False,
+            cwd=os.path.dirname(REPO_SCRIPT),
+        )
+        assert result.returncode == 0, result.stderr
+        with open(output) as fob:
+            metrics = json.load(fob)["results"]["30"]
+        assert metrics["debs"] == 30  # noqa: PLR2004
+        assert metrics["index_debs_per_s"] > 0
+
+
+# seconds a cold CLI run may take beyond the interpreter's own startup
+STARTUP_BUDGET = 0.3
+
+# runs the repo script (argv[1:]) with every process spawn refused
+_NO_SPAWN = """\
+import runpy, subprocess, sys
+def refuse(self, args, *_, **__):
+    raise AssertionError(f"spawned {args}")
+subprocess.Popen.__init__ = refuse
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+class TestStartup:
+    @pytest.fixture
+    def released_root(self, repo_root: str) -> str:
+        Repository(
+            repo_root, "trixie", "pool", "1.0", "origin", quiet=True,
+            backend="native",
+        ).index("main", "amd64")
+        return repo_root
+
+    @staticmethod
+    def _python(*args: str) -> subprocess.CompletedProcess[str]:
+        return subprocess.run(
+            ["/usr/bin/python3", *args],
+            capture_output=True,
+            text=True,
+            check=False,
+            cwd=PROJECT_DIR,
+            env={**os.environ, "PYTHONPATH": PROJECT_DIR},
+        )
+
+    def _best_of(self, runs: int, *args: str) -> float:
+        best = float("inf")
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = self._python(*args)
+            best = min(best, time.perf_counter() - start)
+            assert result.returncode == 0, result.stderr
+        return best
+
+    @pytest.mark.parametrize("command", ["help", "release"])
+    def test_no_process_spawned(
+        self, released_root: str, command: str,
+    ) -> None:
+        args = ["--help"] if command == "help" else [
+            "release", released_root, "trixie", "-q",
+        ]
+        result = self._python("-c", _NO_SPAWN, REPO_SCRIPT, *args)
+        assert result.returncode == 0, result.stderr
+
+    def test_import_configures_no_logging(self) -> None:
+        result = self._python(
+            "-c",
+            "import logging, repo_lib; print(logging.getLogger().handlers)",
+        )
+        assert result.stdout == "[]\n", result.stderr
+
+    def test_host_arch_matches_dpkg(self) -> None:
+        host_arch = runpy.run_path(REPO_SCRIPT, run_name="repo")["host_arch"]
+        dpkg = subprocess.run(
+            ["/usr/bin/dpkg", "--print-architecture"],
+            capture_output=True, text=True, check=True,
+        )
+        assert host_arch() == dpkg.stdout.strip()
+
+    def test_startup_budget(self, released_root: str) -> None:
+        interpreter = self._best_of(5, "-c", "pass")
+        for args in (
+            ["--help"],
+            ["release", released_root, "trixie", "-q"],
+        ):
+            elapsed = self._best_of(5, REPO_SCRIPT, *args)
+            assert elapsed - interpreter < STARTUP_BUDGET, (
+                f"repo {args[0]}: {elapsed:.3f}s"
+                f" (python alone: {interpreter:.3f}s)"
+            )
+
+
+class TestMultiSuite:
+    SUITES = ("bookworm", "trixie", "forky")
+
+    @pytest.fixture
+    def suites_root(self, populated_root: str) -> str:
+        for suite in self.SUITES:
+            Repository(
+                populated_root, suite, "pool", "1.0", "origin", quiet=True,
+                backend="native",
+            ).index("main", "amd64")
+        return populated_root
+
+    def test_release_per_suite(
+        self, suites_root: str, monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        pool_dir = join(suites_root, "pool")
+        listed: list[str] = []
+        real_listdir = os.listdir
+
+        def counting_listdir(path: str) -> list[str]:
+            listed.append(path)
+            return real_listdir(path)
+
+        monkeypatch.setattr("repo_lib.os.listdir", counting_listdir)
+        generate_releases(
+            [
+                Repository(suites_root, suite, "pool", "1.0", "origin")
+                for suite in self.SUITES
+            ],
+        )
+        # the pool is shared, so listed once for all suites
+        assert listed.count(pool_dir) == 1
+        for suite in self.SUITES:
+            release = _read(join(suites_root, "dists", suite), "Release")
+            assert f"Suite: {suite}\n".encode() in release
+            assert b"Components: main\n" in release
+            assert b" main/binary-amd64/Packages\n" in release
+
+    def test_cli_release_several_suites(self, suites_root: str) -> None:
+        result = run_repo("release", suites_root, *self.SUITES, "-q")
+        assert result.returncode == 0, result.stderr
+        for suite in self.SUITES:
+            assert exists(join(suites_root, "dists", suite, "Release"))
+
+    def test_cli_publish_several_suites(self, populated_root: str) -> None:
+        result = run_repo(
+            "publish", populated_root, "bookworm", "trixie", "-q",
+            "--backend", "native", "--staged",
+        )
+        assert result.returncode == 0, result.stderr
+        for suite in ("bookworm", "trixie"):
+            packages = _read(
+                join(populated_root, "dists", suite, "main", "binary-amd64"),
+                "Packages",
+            )
+            assert b"Package: testpkg\n" in packages
+            assert exists(join(populated_root, "dists", suite, "Release"))
+
+
 class TestRelease:
     def test_creates_release_file(self, indexed_root: str) -> None:
         Repository(